@@ -6,8 +6,26 @@ import sys
 import re
 import os
 import inspect
+import traceback
+import types
 
-from manager import cli
+try:
+    basestring
+except NameError:
+    basestring = str
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO  # NOQA
+
+import manager_startup as startup
+from manager import (cache, cli, graph, incremental, introspect, limits,
+    locks, metrics, output, parallel, profiling, scheduler)
+
+# Default --serve-http address, kept here as the server module, importing
+# the HTTP stack, is only loaded to serve.
+DEFAULT_BIND = '127.0.0.1:8000'
 
 
 class Error(Exception):
@@ -20,8 +38,17 @@ def puts(r):
     if type_ == list:
         return [puts(i) for i in r]
     elif type_ == dict:
+        color = cli.terminal().color
         for key in r:
-            puts(cli.blue(cli.min_width(key, 25) + str(r[key])))
+            line = cli.min_width(key, 25) + str(r[key])
+            puts(cli.Colored(cli.BLUE, line) if color else line)
+        return
+    elif type_ == types.GeneratorType:
+        try:
+            for i in r:
+                puts(i)
+        finally:
+            r.close()
         return
     elif type_ == Error:
         return puts(cli.red(str(r)))
@@ -33,14 +60,45 @@ def puts(r):
         return cli.puts(str(r).rstrip('\n'), stream=stdout)
 
 
+def progress(iterable, total=None, label=''):
+    """ Iterates over ```iterable``` while reporting its progress, see
+        ```cli.Progress```. The progress is shown by ```manage --inspect```
+        too.
+
+        >>> for row in progress(rows, label='rows'):
+        ...     migrate(row)
+    """
+    return cli.Progress(iterable, total=total, label=label,
+        counters=introspect.COUNTERS)
+
+
 class Command(object):
     name = None
     namespace = None
     description = 'no description'
     run = None
     capture_all = False
+    map_over = None
+    workers = None
+    executor = 'thread'
+    ordered = True
+    chunksize = 1
+    depends = ()
+    inputs = ()
+    outputs = ()
+    cache = None
+    max_concurrency = None
+    single_flight = False
+    wait_timeout = None
+    max_memory = None
+    max_cpu_seconds = None
+    timeout = None
+    manager = None
+    _parser = None
 
     def __init__(self, **kwargs):
+        if startup.tracer is not None:
+            started = startup.clock()
         for key in kwargs:
             if hasattr(self, key):
                 setattr(self, key, kwargs[key])
@@ -58,6 +116,9 @@ class Command(object):
         if not self.capture_all:
             self.inspect()
 
+        if startup.tracer is not None:
+            self.init_time = startup.clock() - started
+
     def __call__(self, *args, **kwargs):
         return self.run(*args, **kwargs)
 
@@ -80,8 +141,11 @@ class Command(object):
             flag = None
             if type_ == bool and default is True:
                 flag = 'no-{arg_name}'.format(arg_name=arg_name)
+            extra = {}
+            if arg_name == self.map_over:
+                type_, extra['nargs'] = None, '+'
             arg = Arg(arg_name, flag=flag, default=default, type=type_,
-                      required=not arg_name in self.kwargs)
+                      required=not arg_name in self.kwargs, **extra)
             self.add_argument(arg)
 
     def add_argument(self, arg):
@@ -92,6 +156,7 @@ class Command(object):
         if self.has_argument(arg.name):
             raise Exception('Arg {name} already exists'.format(arg.name))
         self.args.append(arg)
+        self.reset_parser()
 
     def get_argument(self, name):
         position = self.get_position(name)
@@ -110,34 +175,247 @@ class Command(object):
     def run(self, *args, **kwargs):
         raise NotImplementedError
 
-    def parse(self, args):
+    def parse(self, args, profile=None, trace_malloc=None,
+            profile_sample=None, output_file=None, compress=None):
+        manager = self.manager
+        event = None
         try:
-            if self.capture_all:
-                args, kwargs = [args], {}
+            args, kwargs, flags = self.parse_args(args)
+            if manager is not None:
+                event = manager.command_started(self, args, kwargs)
+            if (profile is None and trace_malloc is None and
+                    profile_sample is None):
+                r = self.dispatch(args, kwargs, **flags)
             else:
-                parsed_args = self.parser.parse_args(args)
-                kwargs = dict(parsed_args._get_kwargs())
-                args = []
-                position = 0
-                for arg_name in self.arg_names:
-                    arg = self.args[position]
-                    if not isinstance(arg, PromptedArg) and arg.required:
-                        args.append(getattr(parsed_args, arg_name))
-                        del kwargs[arg_name]
-                    if isinstance(arg, PromptedArg):
-                        args.append(arg.prompt())
-                    position += 1
-            r = self(*args, **kwargs)
+                r = profiling.profile(self.dispatch, (args, kwargs), flags,
+                    name=self.path, profile=profile,
+                    trace_malloc=trace_malloc, sample=profile_sample)
             failed = r is False
+            if output_file is not None and not failed:
+                output.write(r, output_file, compress)
+                r = None
         except Error as e:
             r = e
             failed = True
-        puts(r)
+        except BaseException:
+            if event is not None:
+                manager.command_finished(event, 1)
+            raise
+        with cli.paging():
+            puts(r)
+        if event is not None:
+            manager.command_finished(event, 1 if failed else 0)
         if failed:
             sys.exit(1)
 
+    def parse_args(self, argv):
+        """ Parses the command line arguments, prompting the prompted ones.
+
+            Returns the ```(args, kwargs, flags)``` to run the command with,
+            ```flags``` holding the values of its built-in flags.
+        """
+        if self.capture_all:
+            return [argv], {}, {}
+        parsed_args = self.parser.parse_args(argv)
+        kwargs = dict(parsed_args._get_kwargs())
+        args = []
+        position = 0
+        for arg_name in self.arg_names:
+            arg = self.args[position]
+            if not isinstance(arg, PromptedArg) and arg.required:
+                args.append(getattr(parsed_args, arg_name))
+                del kwargs[arg_name]
+            if isinstance(arg, PromptedArg):
+                self.bind_choices(arg)
+                args.append(arg.prompt())
+            position += 1
+        flags = dict((name, kwargs.pop(name)) for name, help in self.flags())
+        return args, kwargs, flags
+
+    def bind(self, values):
+        """ Binds a dict of argument values as ```parse_args``` would parse
+            them, defaulting the missing optional arguments and prompting
+            the missing prompted ones.
+        """
+        values = dict(values)
+        if self.capture_all:
+            return [values.pop('argv', [])], {}, {}
+        flags = dict((name, values.pop(name, False))
+            for name, help in self.flags())
+        args = []
+        for position, arg_name in enumerate(self.arg_names):
+            arg = self.args[position]
+            if isinstance(arg, PromptedArg):
+                self.bind_choices(arg)
+                args.append(self.convert(arg, values.pop(arg_name))
+                    if arg_name in values else arg.prompt())
+            elif arg.required:
+                if arg_name not in values:
+                    raise Error('Missing argument `%s`' % arg_name)
+                args.append(self.convert(arg, values.pop(arg_name)))
+        kwargs = {}
+        for arg in self.args:
+            if not isinstance(arg, PromptedArg) and not arg.required:
+                kwargs[arg.name] = (self.convert(arg, values.pop(arg.name))
+                    if arg.name in values else arg.default)
+        if values:
+            raise Error('Unknown argument %s' % ', '.join(
+                '`%s`' % name for name in sorted(values)))
+        return args, kwargs, flags
+
+    def convert(self, arg, value):
+        """ Checks a bound value against the ```arg```'s choices and
+            converts it with its type, as argparse does for parsed strings.
+        """
+        self.bind_choices(arg)
+        kwargs = arg.kwargs
+        choices = arg._kwargs.get('choices')
+        if isinstance(choices, cli.Choices) and not isinstance(value,
+                basestring):
+            value = str(value)
+        type_ = kwargs.get('type')
+        if type_ is not None and isinstance(value, basestring):
+            try:
+                value = type_(value)
+            except (TypeError, ValueError, argparse.ArgumentTypeError) as e:
+                raise Error('Invalid value for `%s`: %s' % (arg.name, e))
+        if not isinstance(choices, cli.Choices) and choices is not None \
+                and value not in choices:
+            raise Error('Invalid value for `%s`: invalid choice: %r' % (
+                arg.name, value))
+        return value
+
+    def dispatch(self, args, kwargs, cache_stats=False, **flags):
+        if cache_stats:
+            return self.cache.stats(self)
+        run = lambda: self.invoke(args, kwargs, **flags)
+        if (self.max_memory is not None or self.max_cpu_seconds is not None or
+                self.timeout is not None):
+            run = (lambda run: lambda: limits.run(self, run))(run)
+        if self.max_concurrency is not None or self.single_flight:
+            return locks.guard(self, args, kwargs, run)
+        return run()
+
+    def invoke(self, args, kwargs, **flags):
+        if self.inputs or self.outputs:
+            return self.make(args, kwargs, **flags)
+        return self.execute(args, kwargs, **flags)
+
+    def execute(self, args, kwargs, no_cache=False):
+        if self.cache is not None and not no_cache and self.map_over is None:
+            return self.cache.call(self, args, kwargs)
+        if self.map_over is not None:
+            return self.map(args, kwargs)
+        return self(*args, **kwargs)
+
+    def make(self, args, kwargs, force=False, **flags):
+        """ Runs the command unless its ```inputs``` files, its arguments
+            and its registered ENV vars are unchanged since its last
+            successful run and all its ```outputs``` exist.
+
+            The ```--force``` flag always runs the command.
+        """
+        path = self.manager.state_path('state.json')
+        state = incremental.State(path)
+        fingerprint, files = state.fingerprint(self, args, kwargs,
+            self.environment())
+        if not force and state.up_to_date(self, fingerprint):
+            return '%s is up to date' % self.path
+        r = self.execute(args, kwargs, **flags)
+        if r is not False:
+            state = incremental.State(path)  # Merges concurrent updates
+            state.update(self, fingerprint, files)
+            state.save()
+        return r
+
+    def environment(self):
+        """ Returns the current values of the command's registered ENV
+            vars.
+        """
+        if self.manager is None:
+            return {}
+        name = getattr(self.run, '__name__', self.name)
+        return dict(
+            (key.upper(), os.environ.get(key.upper()))
+            for key in self.manager.env_vars.get(name, {})
+        )
+
+    def map(self, args, kwargs):
+        """ Runs the command once per item of the ```map_over``` argument
+            in a ```workers``` sized pool, streaming each result through
+            ```puts```.
+
+            Results are printed in input order when ```ordered``` is set,
+            else as they complete. Failed items are collected and reported
+            as a single ```Error```.
+        """
+        name = self.map_over
+        positional = [
+            arg.name for arg in self.args[:len(self.arg_names)]
+            if isinstance(arg, PromptedArg) or arg.required
+        ]
+        if name in positional:
+            index = positional.index(name)
+            items = args[index]
+        else:
+            index = None
+            items = kwargs.get(name)
+        if items is None:
+            items = []
+        elif isinstance(items, str):
+            items = [item for item in items.split(',') if item]
+
+        def jobs():
+            for item in items:
+                if index is None:
+                    yield item, args, dict(kwargs, **{name: item})
+                else:
+                    yield item, args[:index] + [item] + args[index + 1:], kwargs
+
+        errors = []
+        for item, r, error in parallel.imap(
+                self.map_item, jobs(), executor=self.executor,
+                workers=self.workers, ordered=self.ordered,
+                chunksize=self.chunksize):
+            if error is not None:
+                errors.append('%s: %s' % (item, error))
+            elif r is False:
+                errors.append('%s: FAILED' % item)
+            else:
+                puts(r)
+        if errors:
+            raise Error('%s of %s items failed:\n%s' % (
+                len(errors), len(items), '\n'.join(errors)))
+
+    def map_item(self, item, args, kwargs):
+        try:
+            return item, self(*args, **kwargs), None
+        except Exception as e:
+            return item, None, e
+
     @property
     def parser(self):
+        """ The command's argument parser, built once. Changes to its
+            arguments must reset it through ```reset_parser```.
+        """
+        if self._parser is None:
+            self._parser = self.build_parser()
+        return self._parser
+
+    def reset_parser(self):
+        self._parser = None
+
+    def bind_choices(self, arg):
+        """ Caches the values of the ```arg```'s choices provider in the
+            manager's state directory, named after the command and arg.
+        """
+        choices = arg._kwargs.get('choices')
+        if isinstance(choices, cli.Choices) and choices.directory is None \
+                and self.manager is not None:
+            choices.directory = self.manager.state_path('choices')
+            choices.name = '%s.%s' % (self.path, arg.name)
+
+    def build_parser(self):
         if self.namespace:
             prog = '%s %s.%s' % (sys.argv[0], self.namespace, self.name)
         else:
@@ -145,10 +423,26 @@ class Command(object):
 
         parser = argparse.ArgumentParser(prog=prog, description=self.description)
         for arg in self.args:
+            self.bind_choices(arg)
             if not isinstance(arg, PromptedArg):
                 parser.add_argument(*arg.flags, **arg.kwargs)
+        for name, help in self.flags():
+            parser.add_argument('--%s' % name.replace('_', '-'),
+                action='store_true', help=help)
         return parser
 
+    def flags(self):
+        """ Returns the ```(name, help)``` of the built-in flags enabled by
+            the command's options.
+        """
+        flags = []
+        if self.inputs or self.outputs:
+            flags.append(('force', 'run even if up to date'))
+        if self.cache is not None:
+            flags.append(('no_cache', 'bypass the results cache'))
+            flags.append(('cache_stats', 'show the results cache statistics'))
+        return flags
+
     @property
     def path(self):
         if self.namespace:
@@ -158,12 +452,37 @@ class Command(object):
 
 
 class Manager(object):
-    def __init__(self, base_command=Command, envs=False):
+    def __init__(self, base_command=Command, envs=False,
+            state_dir='.manage', stats=False, worker=False,
+            introspection=False):
         self.base_command = base_command
         self.commands = {}
         self.env_vars = collections.defaultdict(dict)
+        self.state_dir = state_dir
+        self.before_hooks = []
+        self.after_hooks = []
+        self.journal = None
+        self.introspection = introspection
+        self._queue = None
         if envs:
             self.command(self.envs)
+        if stats:
+            # The journal and job queue modules, importing sqlite3, are
+            # only loaded when used.
+            from manager import journal
+
+            self.journal = journal.Journal(self)
+            self.after_command(self.journal.record)
+            self.command(self.stats)
+        if worker:
+            command = self.command(self.worker)
+            self.arg('concurrency', shortcut='c', type=int,
+                help='number of jobs run at once')(command)
+            self.arg('executor', choices=parallel.EXECUTORS,
+                help='run the jobs in processes or threads')(command)
+            self.arg('batch_size', type=int,
+                help='number of jobs claimed at once')(command)
+            self.arg('burst', help='stop once no job is available')(command)
 
     @property
     def Command(self):
@@ -179,8 +498,20 @@ class Manager(object):
         return BoundMeta('BoundCommand', (self.base_command, ), {})
 
     def add_command(self, command):
+        if startup.tracer is not None:
+            startup.tracer.command(command.path,
+                getattr(command, 'init_time', 0.0))
+        command.manager = self
         self.commands[command.path] = command
 
+    def state_path(self, *parts):
+        """Returns a path within the local state directory, relative to the
+        current directory unless ```state_dir``` is absolute."""
+        directory = os.path.join(os.getcwd(), self.state_dir)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return os.path.join(directory, *parts)
+
     @staticmethod
     def arg(name, shortcut=None, positional=True, **kwargs):
         def wrapper(command):
@@ -192,7 +523,10 @@ class Manager(object):
                     if name in command.kwargs:
                         kwargs['default'] = command.kwargs[name]
                         kwargs['required'] = False
+                    if 'choices' in kwargs:
+                        kwargs['choices'] = cli.Choices.wrap(kwargs['choices'])
                     arg._kwargs.update(**kwargs)
+                    command.reset_parser()
                     return command
                 try:
                     command.add_argument(Arg(name, shortcut=shortcut, **kwargs))
@@ -213,16 +547,81 @@ class Manager(object):
                 arg, position = command.get_argument(name)
                 command.args[position] = PromptedArg(name, arg, message,
                     **kwargs)
+                command.reset_parser()
                 return command
             return wrapped(**kwargs)
 
         return wrapper
 
+    def cache(self, ttl=None, max_entries=None, max_bytes=None):
+        """Decorator caching the results of a command on disk.
+
+        Results are keyed on the command's arguments and registered ENV vars
+        and kept for ```ttl``` seconds, the least recently used ones being
+        evicted beyond ```max_entries``` entries or ```max_bytes``` bytes.
+        The command gets ```--no-cache``` and ```--cache-stats``` flags.
+
+        @manager.cache(ttl=3600, max_entries=100)
+        @manager.command
+        def report(month):
+            ...
+        """
+        def wrapper(command):
+            command.cache = cache.Cache(ttl=ttl, max_entries=max_entries,
+                max_bytes=max_bytes)
+            command.reset_parser()
+            return command
+
+        return wrapper
+
+    def before_command(self, hook):
+        """Decorator registering a hook called with the event of each command
+        invocation before it runs.
+
+        The event is a dict holding the command ```path```, its ```args```
+        and ```kwargs```.
+        """
+        self.before_hooks.append(hook)
+        return hook
+
+    def after_command(self, hook):
+        """Decorator registering a hook called with the event of each command
+        invocation once it has run.
+
+        The event also holds the exit ```status```, the ```duration``` and
+        ```cpu_time``` in seconds, the process peak ```max_rss``` and how
+        much the command raised it, ```max_rss_growth```, in bytes.
+        See ```manager.metrics``` for built-in sinks.
+
+        @manager.after_command
+        def log(event):
+            logger.info('%(path)s took %(duration).3fs', event)
+        """
+        self.after_hooks.append(hook)
+        return hook
+
+    def command_started(self, command, args, kwargs):
+        """Runs the before hooks, returning the invocation's event or None
+        when no hook is registered."""
+        if not (self.before_hooks or self.after_hooks):
+            return None
+        event = metrics.start(command.path, args, kwargs)
+        for hook in self.before_hooks:
+            hook(event)
+        return event
+
+    def command_finished(self, event, status):
+        if self.after_hooks:
+            metrics.finish(event, status)
+            for hook in self.after_hooks:
+                hook(event)
+
     def merge(self, manager, namespace=None):
         for command_name in manager.commands:
             command = manager.commands[command_name]
             if namespace is not None:
                 command.namespace = namespace
+                command.reset_parser()
             self.add_command(command)
 
     def command(self, *args, **kwargs):
@@ -234,6 +633,27 @@ class Manager(object):
             The command's help string will be taken from the optional
             ```description``` named argument.
 
+            A ```map_over``` named argument fans the command out over the
+            items of the given list argument, see ```Command.map```.
+
+            The ```depends``` named argument lists the paths of the commands
+            to run beforehand, see ```Manager.run_graph```.
+
+            The ```inputs``` and ```outputs``` named arguments are lists of
+            globs making the command skipped when up to date, see
+            ```Command.make```.
+
+            The ```max_concurrency``` named argument limits the number of
+            runs of the command at once across processes, and
+            ```single_flight``` makes invocations with the same arguments
+            wait for the running one and reuse its result. Waiting fails
+            after ```wait_timeout``` seconds when set, see ```locks```.
+
+            The ```max_memory``` (bytes or e.g. ```'512M'```),
+            ```max_cpu_seconds``` and ```timeout``` named arguments run the
+            command in a forked process within these limits, see
+            ```limits.run```.
+
         """
         def register(fn):
             def wrapped(**kwargs):
@@ -289,11 +709,66 @@ class Manager(object):
         else:
             usage='%(prog)s <command> [<args>]'
 
-        parser = argparse.ArgumentParser(usage=usage)
-        parser.add_argument('command', help='the command to run')
+        try:
+            parser = argparse.ArgumentParser(usage=usage, allow_abbrev=False)
+        except TypeError:  # Python < 3.5
+            parser = argparse.ArgumentParser(usage=usage)
+        parser.add_argument('--parallel', action='store_true',
+            help='run several commands, separated by `--`, in parallel')
+        parser.add_argument('-j', '--jobs', type=int,
+            help='number of commands to run at once')
+        parser.add_argument('--dry-run', action='store_true',
+            help='show the execution plan without running it')
+        parser.add_argument('--profile', nargs='?', const='',
+            metavar='FILE', help='write cProfile stats of the command')
+        parser.add_argument('--profile-sample', nargs='?', const='',
+            metavar='FILE',
+            help='write sampled collapsed stacks of the command')
+        parser.add_argument('--trace-malloc', nargs='?', const=10, type=int,
+            metavar='N', help='report the top N allocation sites')
+        parser.add_argument('--scheduler', metavar='FILE',
+            help='run the commands scheduled in FILE until interrupted')
+        parser.add_argument('--serve-http', action='store_true',
+            help='serve the commands over HTTP, see --bind')
+        parser.add_argument('--bind', default=DEFAULT_BIND,
+            metavar='ADDRESS', help='the address to serve on (default: %s)'
+            % DEFAULT_BIND)
+        parser.add_argument('--inspect', type=int, metavar='PID',
+            help='dump the stacks and progress of a running command')
+        parser.add_argument('--output-file', metavar='PATH',
+            help='write the result of the command to PATH')
+        parser.add_argument('--compress', choices=output.COMPRESSIONS,
+            help='compress the output file')
+        parser.add_argument('command', nargs=argparse.REMAINDER,
+            help='the command to run')
         return parser
 
+    def command_position(self, parser, argv):
+        """Returns the index of the command in ```argv```, the global
+        options coming before it. The command's own arguments are left to
+        its parser."""
+        actions = parser._option_string_actions
+        position = 0
+        while position < len(argv):
+            arg = argv[position]
+            if arg == '--' or not arg.startswith('-') or arg == '-':
+                break
+            action = actions.get(arg)
+            position += 1
+            if action is None or action.nargs == 0:
+                continue  # Flags, `--option=value`, `-jN` or invalid.
+            if action.nargs == '?' and (position == len(argv) or
+                    argv[position] in self.commands or
+                    argv[position].startswith('-')):
+                continue
+            position += 1
+        return position
+
     def usage(self):
+        with cli.paging():
+            self.print_usage()
+
+    def print_usage(self):
         def format_line(command, w):
             return "%s%s" % (
                 cli.min_width(command.name, w), command.description
@@ -323,14 +798,265 @@ class Manager(object):
         if len(args) == 0 or args[0] in ('-h', '--help'):
             return self.usage()
 
-        command = args.get(0)
+        with startup.phase('parse options'):
+            parser = self.parser
+            position = self.command_position(parser, args.all)
+            options = parser.parse_args(args.all[:position])
+            options.command = args.all[position:]
+        if options.inspect is not None:
+            try:
+                return puts(introspect.collect(self, options.inspect))
+            except Error as e:
+                puts(e)
+                sys.exit(1)
+        if options.compress and not options.output_file:
+            self.parser.error('--compress requires --output-file')
+        if self.introspection:
+            introspect.install(self, args.all)
+        if options.scheduler:
+            self.update_env()
+            status = scheduler.main(self, options.scheduler,
+                workers=options.jobs)
+            if status:
+                sys.exit(status)
+            return
+        if options.serve_http:
+            from manager import server
+
+            self.update_env()
+            status = server.serve(self, options.bind, workers=options.jobs)
+            if status:
+                sys.exit(status)
+            return
+        if options.parallel:
+            invocations = [[]]
+            for arg in options.command:
+                if arg == '--':
+                    invocations.append([])
+                else:
+                    invocations[-1].append(arg)
+        else:
+            invocations = [options.command]
+
+        for argv in invocations:
+            command = argv[0] if argv else None
+            if command not in self.commands:
+                puts(cli.red('Invalid command `%s`\n' % command))
+                return self.usage()
+        with startup.phase('update env'):
+            self.update_env()
+
+        use_graph = options.dry_run or any(
+            self.commands[argv[0]].depends for argv in invocations)
+        if options.output_file and (use_graph or options.parallel):
+            self.parser.error('--output-file requires a single command '
+                'without dependencies')
+        if use_graph:
+            status = self.run_graph(invocations, jobs=options.jobs,
+                dry_run=options.dry_run)
+        elif options.parallel:
+            status = self.run_many(invocations, workers=options.jobs)
+        else:
+            argv = invocations[0]
+            with startup.phase('run command'):
+                return self.commands[argv[0]].parse(argv[1:],
+                    profile=options.profile,
+                    trace_malloc=options.trace_malloc,
+                    profile_sample=options.profile_sample,
+                    output_file=options.output_file,
+                    compress=options.compress)
+        if status:
+            sys.exit(status)
+
+    def call(self, path, args=None, capture=False, stream=False):
+        """Runs a command in-process and returns a ```Result``` instead of
+        printing its result and exiting.
+
+        ```args``` is either a list of command line arguments or a dict of
+        argument values by name, checked against the arguments' choices and
+        converted with their type like parsed strings. Generators are run
+        to completion, the returned value replaying their items, unless
+        ```stream``` is set: they are then returned as they go, the after
+        hooks running once they are exhausted or closed. The output that
+        would have been printed, along with stderr, is only rendered into
+        ```Result.output``` when ```capture``` is set.
+
+        >>> manager.call('ns.cmd', {'name': 'value'}).value
+        """
         try:
-            command = self.commands[command]
+            command = self.commands[path]
         except KeyError:
-            puts(cli.red('Invalid command `%s`\n' % command))
-            return self.usage()
-        self.update_env()
-        command.parse(args.all[1:])
+            raise Error('Invalid command `%s`' % path)
+        if isinstance(args, dict):
+            bind = command.bind
+        else:
+            bind = command.parse_args
+            args = list(args or [])
+
+        if capture:
+            streams = sys.stdout, sys.stderr
+            sys.stdout = sys.stderr = output = StringIO()
+        event = items = None
+        status = 1
+        try:
+            try:
+                args, kwargs, flags = bind(args)
+                event = self.command_started(command, args, kwargs)
+                value = command.dispatch(args, kwargs, **flags)
+                if isinstance(value, types.GeneratorType):
+                    if stream and not capture:
+                        value, event = self.stream(value, event), None
+                    else:
+                        items = list(value)
+                        value = (item for item in items)
+                status = 1 if value is False else 0
+            except Error as e:
+                value = e
+            except SystemExit as e:
+                value = None
+                if e.code is None or isinstance(e.code, int):
+                    status = e.code or 0
+                else:
+                    status = 1
+            if capture:
+                puts(value if items is None else items)
+        finally:
+            if event is not None:
+                self.command_finished(event, status)
+            if capture:
+                sys.stdout, sys.stderr = streams
+        return Result(value, status, output.getvalue() if capture else None)
+
+    def stream(self, items, event):
+        """Yields the items of a command's generator, then runs the after
+        hooks with the status it ended with."""
+        status = 1
+        try:
+            for item in items:
+                yield item
+            status = 0
+        finally:
+            if event is not None:
+                self.command_finished(event, status)
+
+    def run_many(self, invocations, workers=None):
+        """Runs several commands in a process pool and returns the combined
+        exit status.
+
+        Each invocation is an argument list starting with the command path,
+        e.g. ``[['build'], ['lint', '--strict']]``. The output of each
+        command is printed once it completes, prefixed with its path.
+
+        :param list invocations: The command lines to run.
+        :param int workers: The pool size, defaults to the number of CPUs.
+        """
+        tasks = parallel.Tasks(self.capture, executor='process',
+            workers=workers)
+        status = 0
+        try:
+            for key, argv in enumerate(invocations):
+                tasks.submit(key, (argv, ))
+            while len(tasks):
+                key, result, error = tasks.get()
+                path = invocations[key][0]
+                code, output = result if error is None else (
+                    1, 'Cannot run `%s`: %s' % (path, error))
+                self.puts_captured(path, output)
+                status = max(status, code)
+            tasks.pool.close()
+        finally:
+            tasks.pool.terminate()
+            tasks.pool.join()
+        return status
+
+    def run_graph(self, invocations, jobs=None, dry_run=False):
+        """Runs the given commands along with their dependencies and returns
+        the combined exit status.
+
+        Dependencies declared through ```depends``` are run without
+        arguments, at most once, before the commands depending on them.
+        Independent commands are run at once in a pool of ```jobs```
+        processes. Nothing is scheduled anymore once a command has failed.
+
+        :param list invocations: The command lines to run.
+        :param int jobs: The pool size, defaults to the number of CPUs.
+        :param bool dry_run: Only print the execution plan.
+        """
+        paths = [argv[0] for argv in invocations]
+        try:
+            dependencies = graph.resolve(self.commands, paths)
+        except Error as e:
+            puts(e)
+            return 1
+
+        # Each invocation runs, even repeated, followed by the dependencies
+        # not invoked explicitly, keyed by position.
+        argvs = list(invocations) + [[path] for path in sorted(dependencies)
+            if path not in paths]
+        keys = {}
+        for key, argv in enumerate(argvs):
+            keys.setdefault(argv[0], []).append(key)
+        pending = dict((key, set(dependency_key
+            for dependency in dependencies[argv[0]]
+            for dependency_key in keys[dependency]))
+            for key, argv in enumerate(argvs))
+
+        if dry_run:
+            for i, stage in enumerate(graph.stages(pending)):
+                puts('%s. %s' % (i + 1,
+                    ', '.join(sorted(argvs[key][0] for key in stage))))
+            return 0
+
+        tasks = parallel.Tasks(lambda key: self.capture(argvs[key]),
+            executor='process', workers=jobs)
+        status = 0
+        try:
+            while True:
+                if not status:
+                    for key in sorted(pending):
+                        if not pending[key]:
+                            del pending[key]
+                            tasks.submit(key, (key, ))
+                if not len(tasks):
+                    break
+                key, result, error = tasks.get()
+                # Failures of the worker itself, e.g. when it died.
+                code, output = result if error is None else (
+                    1, 'Cannot run `%s`: %s' % (argvs[key][0], error))
+                self.puts_captured(argvs[key][0], output)
+                status = max(status, code)
+                for depends in pending.values():
+                    depends.discard(key)
+            tasks.pool.close()
+        finally:
+            tasks.pool.terminate()
+            tasks.pool.join()
+        return status
+
+    def puts_captured(self, path, output):
+        prefix = '[%s] ' % path
+        with cli.indent(len(prefix), quote=prefix):
+            puts(output)
+
+    def capture(self, argv):
+        """Parses and runs the given command line, returning its exit status
+        and captured output."""
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            self.commands[argv[0]].parse(argv[1:])
+            status = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                status = e.code or 0
+            else:
+                sys.stdout.write('%s\n' % e.code)
+                status = 1
+        except Exception:
+            sys.stdout.write(traceback.format_exc())
+            status = 1
+        finally:
+            stdout, sys.stdout = sys.stdout, stdout
+        return status, stdout.getvalue().rstrip('\n')
 
     def env(self, key, value=None):
         """Decorator to register an ENV variable needed for a method.
@@ -377,6 +1103,66 @@ class Manager(object):
                 puts('\t%s%s' % (cli.min_width(var.upper(), 30), default))
             puts('')
 
+    def stats(self, window='7d', command=None):
+        """Show the commands durations over a time window (e.g. 12h, 7d)."""
+        try:
+            stats = self.journal.window_stats(window, path=command)
+        except ValueError as e:
+            raise Error(str(e))
+        if not stats:
+            return 'No invocation recorded in the last %s.' % window
+
+        puts(cli.min_width('command', 30) + ''.join(
+            cli.min_width(title, 10) for title in ('count', 'p50', 'p95', 'p99')
+        ).rstrip())
+        for path in sorted(stats):
+            count, p50, p95, p99 = stats[path]
+            puts(cli.min_width(path, 30) + cli.min_width(count, 10) + ''.join(
+                cli.min_width('%.3fs' % value, 10) for value in (p50, p95, p99)
+            ).rstrip())
+
+    @property
+    def queue(self):
+        """The ```jobqueue.Queue``` of the manager, created on first use."""
+        if self._queue is None:
+            from manager import jobqueue
+
+            self._queue = jobqueue.Queue(self)
+        return self._queue
+
+    def enqueue(self, path, *args, **kwargs):
+        """Queues a run of a command for ```manage worker``` and returns
+        the job id, see ```jobqueue.Queue```.
+
+        >>> job_id = manager.enqueue('ns.cmd', 'value', option=True)
+        >>> manager.queue.get(job_id)['status']
+        """
+        try:
+            command = self.commands[path]
+        except KeyError:
+            raise Error('Invalid command `%s`' % path)
+        values = dict(zip(command.arg_names, args))
+        values.update(kwargs)
+        return self.queue.put(path, values)
+
+    def worker(self, concurrency=1, executor='process', batch_size=None,
+            burst=False):
+        """Run the queued jobs."""
+        self.queue.work(concurrency=concurrency, executor=executor,
+            batch_size=batch_size, burst=burst)
+
+
+class Result(object):
+    """The result of a command run through ```Manager.call```."""
+
+    def __init__(self, value, status=0, output=None):
+        self.value = value
+        self.status = status
+        self.output = output
+
+    def __repr__(self):
+        return '<Result status=%s value=%r>' % (self.status, self.value)
+
 
 class Arg(object):
     defaults = {
@@ -389,6 +1175,9 @@ class Arg(object):
         if kwargs.get('default') and kwargs.get('help'):
             kwargs['help'] = '%s (default: %s)' % (kwargs['help'], kwargs['default'])
 
+        if 'choices' in kwargs:
+            kwargs['choices'] = cli.Choices.wrap(kwargs['choices'])
+
         self.name = name
         self.flag = flag if flag is not None else name
         self.shortcut = shortcut
@@ -429,6 +1218,8 @@ class Arg(object):
                     dict_['action'] = 'store_true'
 
                 dict_.pop('type', None)
+        if isinstance(dict_.get('choices'), cli.Choices):
+            dict_['type'] = dict_.pop('choices').type(dict_.get('type'))
         return dict_
 
 
@@ -441,7 +1232,12 @@ class PromptedArg(Arg):
             'type': str if arg.type is None else arg.type,
             'default': arg.default,
         }
+        if isinstance(arg._kwargs.get('choices'), cli.Choices):
+            self._kwargs['choices'] = arg._kwargs['choices']
         self._kwargs.update(kwargs)
+        choices = self._kwargs.get('choices')
+        if choices is not None and not isinstance(choices, cli.Choices):
+            self._kwargs['choices'] = cli.Choices(choices)
 
     @property
     def kwargs(self):
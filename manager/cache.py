@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+import atexit
+import hashlib
+import json
+import os
+import pickle
+import time
+from multiprocessing.util import Finalize
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # NOQA
+
+from manager.incremental import write_atomic
+from manager.locks import remove
+
+EXTENSION = '.pickle'
+STREAM = 'stream'
+VALUE = 'value'
+# Seconds between the writes of the statistics gathered in memory.
+FLUSH_INTERVAL = 1.0
+
+_caches = []
+
+
+def flush_all():
+    for cache in _caches:
+        cache.flush()
+
+
+class Cache(object):
+    """On-disk cache of a command's results.
+
+    Entries are keyed on the command path, its arguments and its registered
+    ENV vars. They expire after ``ttl`` seconds and the least recently used
+    ones are evicted beyond ``max_entries`` entries or ``max_bytes`` bytes.
+
+    Generators are cached once fully consumed, provided their materialized
+    items fit in ``max_bytes``.
+
+    Hits, misses and the last use of each entry are gathered in memory and
+    merged into ``stats.json`` under a lock at most every
+    ``FLUSH_INTERVAL`` seconds, when evicting and at exit.
+    """
+
+    def __init__(self, ttl=None, max_entries=None, max_bytes=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.pending = {}
+        self.flushed = time.time()
+        if not _caches:
+            atexit.register(flush_all)
+            # Run in the pool workers, which skip atexit.
+            Finalize(None, flush_all, exitpriority=0)
+        _caches.append(self)
+
+    def directory(self, command):
+        directory = command.manager.state_path('cache', command.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return directory
+
+    def key(self, command, args, kwargs):
+        key = repr((command.path, args, sorted(kwargs.items()),
+            sorted(command.environment().items())))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def call(self, command, args, kwargs):
+        """Returns the cached result of the invocation, running the command
+        on cache misses."""
+        directory = self.directory(command)
+        key = self.key(command, args, kwargs)
+        path = os.path.join(directory, key + EXTENSION)
+        try:
+            with open(path, 'rb') as f:
+                created, kind, value = pickle.load(f)
+        except Exception:  # Missing or corrupt entry.
+            kind = None
+        else:
+            if self.ttl is not None and created + self.ttl < time.time():
+                # Another process may be expiring the entry as well.
+                remove(path)
+                kind = None
+
+        if kind is not None:
+            self.count(directory, 'hits', key)
+            if kind == STREAM:
+                return (item for item in value)
+            return value
+
+        self.count(directory, 'misses', key)
+        r = command.execute(args, kwargs, no_cache=True)
+        if hasattr(r, '__next__') or hasattr(r, 'next'):
+            return self.tee(path, r)
+        if r is not False:
+            self.store(path, VALUE, r)
+        return r
+
+    def tee(self, path, iterator):
+        items, size = [], 0
+        for item in iterator:
+            if items is not None:
+                size += len(pickle.dumps(item, pickle.HIGHEST_PROTOCOL))
+                if self.max_bytes is not None and size > self.max_bytes:
+                    items = None
+                else:
+                    items.append(item)
+            yield item
+        if items is not None:
+            self.store(path, STREAM, items)
+
+    def store(self, path, kind, value):
+        try:
+            data = pickle.dumps((time.time(), kind, value),
+                pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return
+        if self.max_bytes is not None and len(data) > self.max_bytes:
+            return
+        write_atomic(path, data, 'wb')
+        self.evict(os.path.dirname(path))
+
+    def entries(self, directory, used=None):
+        """Returns the ``(last use, size, path)`` of the entries, most
+        recently used first."""
+        if used is None:
+            used = self.flush(directory).get('used', {})
+        entries = []
+        for name in os.listdir(directory):
+            if name.endswith(EXTENSION):
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((used.get(name[:-len(EXTENSION)],
+                    stat.st_mtime), stat.st_size, path))
+        return sorted(entries, reverse=True)
+
+    def evict(self, directory):
+        count = size = 0
+        for last_use, bytes_, path in self.entries(directory):
+            count += 1
+            size += bytes_
+            if ((self.max_entries is not None and count > self.max_entries) or
+                    (self.max_bytes is not None and size > self.max_bytes)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def count(self, directory, counter, key):
+        """Records a hit or miss, and the use of the entry ``key``."""
+        pending = self.pending.setdefault(directory, {'hits': 0,
+            'misses': 0, 'used': {}})
+        pending[counter] += 1
+        pending['used'][key] = time.time()
+        if time.time() - self.flushed >= FLUSH_INTERVAL:
+            self.flush()
+
+    def read_stats(self, directory):
+        try:
+            with open(os.path.join(directory, 'stats.json')) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def flush(self, directory=None):
+        """Merges the statistics gathered in memory into the ones on disk
+        of ``directory``, or of every directory, returning the last ones."""
+        if directory is None:
+            for directory in list(self.pending):
+                self.flush(directory)
+            self.flushed = time.time()
+            return None
+        pending = self.pending.pop(directory, None)
+        if pending is None or not os.path.isdir(directory):
+            return self.read_stats(directory)
+        with open(os.path.join(directory, 'stats.lock'), 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            stats = self.read_stats(directory)
+            for counter in ('hits', 'misses'):
+                stats[counter] = stats.get(counter, 0) + pending[counter]
+            used = stats.setdefault('used', {})
+            for key, last_use in pending['used'].items():
+                used[key] = max(used.get(key, 0), last_use)
+            names = set(name[:-len(EXTENSION)] for name in
+                os.listdir(directory) if name.endswith(EXTENSION))
+            stats['used'] = dict((key, last_use) for key, last_use in
+                used.items() if key in names)
+            write_atomic(os.path.join(directory, 'stats.json'),
+                json.dumps(stats))
+        return stats
+
+    def stats(self, command):
+        """Returns the cache statistics of the command."""
+        directory = self.directory(command)
+        stats = {'hits': 0, 'misses': 0}
+        stats.update(self.flush(directory))
+        entries = self.entries(directory, stats.pop('used', {}))
+        stats['entries'] = len(entries)
+        stats['bytes'] = sum(entry[1] for entry in entries)
+        return stats
@@ -1,15 +1,29 @@
 from __future__ import absolute_import
 
+import bisect
+import errno
 import os
 import getpass
+import json
 from glob import glob
+import itertools
+import shlex
+import subprocess
 import sys
+import threading
+import time
+import weakref
 
 try:
     raw_input
 except NameError:
     raw_input = input
 
+try:
+    basestring
+except NameError:
+    basestring = str
+
 try:
     from collections import OrderedDict
 except ImportError:
@@ -20,6 +34,10 @@ __all__ = ('Args', )
 STDOUT = sys.stdout.write
 NEWLINES = ('\n', '\r', '\r\n')
 
+BLUE = '\033[94m'
+GREEN = '\033[92m'
+RED = '\033[91m'
+
 
 class Args(object):
     """CLI Argument management."""
@@ -457,7 +475,8 @@ def process_value(value, empty=False, type=str, default=None, allowed=None,
     :param tuple true_choices: The accpeted values for True.
     :param tuple false_choices: The accepted values for False.
     """
-    if allowed is not None and value not in allowed:
+    if allowed is not None and value not in allowed and not (
+            empty and value in ('', '\n')):
         raise Exception('Invalid input')
 
     if type is bool:
@@ -477,7 +496,7 @@ def process_value(value, empty=False, type=str, default=None, allowed=None,
 
 def prompt(message, empty=False, hidden=False, type=str, default=None,
         allowed=None, true_choices=TRUE_CHOICES, false_choices=FALSE_CHOICES,
-        max_attempt=3, confirm=False):
+        max_attempt=3, confirm=False, choices=None):
     """Prompt user for value.
 
     :param str message: The prompt message.
@@ -491,17 +510,20 @@ def prompt(message, empty=False, hidden=False, type=str, default=None,
     :param int max_attempt: How many times the user is prompted back in case
         of invalid input.
     :param bool confirm: Enforce confirmation.
+    :param choices: The allowed values provider, see ```Choices```.
     """
     from manager import Error
 
-    if allowed is not None and empty:
-        allowed = allowed + ('', '\n')
-
     if type is bool:
-        allowed = true_choices + false_choices
+        allowed = tuple(true_choices) + tuple(false_choices)
 
-    if allowed is not None:
+    if choices is not None:
+        allowed = choices if isinstance(choices, Choices) else \
+            Choices(choices)
+        message = "%s [%s]" % (message, allowed.display())
+    elif allowed is not None:
         message = "%s [%s]" % (message, ", ".join(allowed))
+        allowed = frozenset(allowed)
 
     if default is not None:
         message = "%s (default: %s) " % (message, default)
@@ -513,9 +535,11 @@ def prompt(message, empty=False, hidden=False, type=str, default=None,
     attempt = 0
 
     while attempt < max_attempt:
+        input_ = None
         try:
+            input_ = handler("%s : " % message)
             value = process_value(
-                handler("%s : " % message),
+                input_,
                 empty=empty,
                 type=type,
                 default=default,
@@ -526,6 +550,11 @@ def prompt(message, empty=False, hidden=False, type=str, default=None,
             break
         except:
             attempt = attempt + 1
+            if input_ and isinstance(allowed, Choices):
+                suggestions = allowed.suggest(input_.strip())
+                if suggestions:
+                    puts('Did you mean: %s?' % ', '.join(suggestions),
+                        stream=sys.stdout.write)
 
             if attempt == max_attempt:
                 raise Error('Invalid input')
@@ -534,7 +563,7 @@ def prompt(message, empty=False, hidden=False, type=str, default=None,
         confirmation = prompt("%s (again)" % message, empty=empty,
             hidden=hidden, type=type, default=default, allowed=allowed,
             true_choices=true_choices, false_choices=false_choices,
-            max_attempt=max_attempt)
+            max_attempt=max_attempt, choices=choices)
 
         if value != confirmation:
             raise Error('Values do not match')
@@ -542,30 +571,446 @@ def prompt(message, empty=False, hidden=False, type=str, default=None,
     return value
 
 
+class Choices(object):
+    """Allowed values of an argument, loaded on first use from a provider:
+    an iterable, a file path with one value per line, or a callable
+    returning the values, whose result is cached on disk for ```ttl```
+    seconds as ```directory/name.json``` when both are set.
+
+    Values are checked against a frozenset and suggested, on invalid input,
+    from a sorted index sharing the longest prefix with the input.
+    """
+
+    def __init__(self, provider, ttl=3600, directory=None, name=None):
+        self.provider = provider
+        self.ttl = ttl
+        self.directory = directory
+        self.name = name
+        self._values = self._index = None
+
+    @classmethod
+    def wrap(cls, choices):
+        """Returns ```Choices``` for callables and file paths, argparse
+        handles the other choices."""
+        if callable(choices) or isinstance(choices, basestring):
+            return cls(choices)
+        return choices
+
+    def fetch(self):
+        if isinstance(self.provider, basestring):
+            with open(self.provider) as f:
+                return [line.rstrip('\r\n') for line in f if line.strip()]
+        if not callable(self.provider):
+            return [str(value) for value in self.provider]
+        if self.directory is None or self.name is None:
+            return [str(value) for value in self.provider()]
+
+        from manager.incremental import write_atomic
+
+        path = os.path.join(self.directory, '%s.json' % self.name)
+        try:
+            if time.time() - os.stat(path).st_mtime < self.ttl:
+                with open(path) as f:
+                    return json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+        values = [str(value) for value in self.provider()]
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        write_atomic(path, json.dumps(values))
+        return values
+
+    def load(self):
+        if self._values is None:
+            values = self.fetch()
+            self._values = frozenset(values)
+            self._index = sorted(self._values)
+        return self._index
+
+    def __contains__(self, value):
+        self.load()
+        return value in self._values
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+    def suggest(self, value, limit=5):
+        """Returns up to ```limit``` values sharing the longest prefix with
+        ```value```."""
+        index = self.load()
+        for end in range(len(value), 0, -1):
+            prefix = value[:end]
+            i = bisect.bisect_left(index, prefix)
+            matches = list(itertools.takewhile(
+                lambda choice: choice.startswith(prefix),
+                itertools.islice(index, i, i + limit)))
+            if matches:
+                return matches
+        return []
+
+    def display(self, limit=10):
+        index = self.load()
+        shown = ', '.join(index[:limit])
+        if len(index) > limit:
+            shown = '%s, ... (%s more)' % (shown, len(index) - limit)
+        return shown
+
+    def type(self, type=None):
+        """Returns an argparse ```type``` checking the value is allowed
+        before converting it with ```type```."""
+        import argparse
+
+        def convert(value):
+            if value not in self:
+                suggestions = self.suggest(value)
+                raise argparse.ArgumentTypeError(
+                    'invalid choice: %r%s' % (value,
+                        ' (did you mean: %s?)' % ', '.join(suggestions)
+                        if suggestions else ''))
+            return value if type is None else type(value)
+        convert.__name__ = getattr(type, '__name__', 'str')
+        return convert
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '%dh%02dm%02ds' % (hours, minutes, seconds)
+    elif minutes:
+        return '%dm%02ds' % (minutes, seconds)
+    return '%ds' % seconds
+
+
+class Progress(object):
+    """Iterates over ```iterable``` reporting its progress, redrawn at most
+    ```refresh``` times per second on a TTY, else logged every
+    ```log_interval``` seconds, indented as ```puts``` would.
+
+    The clock is only read every so many items, this stride being sized to
+    last a fraction of the refresh interval. The current progress is also
+    stored in ```counters``` when given.
+    """
+
+    max_stride = 1 << 16
+
+    def __init__(self, iterable, total=None, label='', stream=None,
+            refresh=10, log_interval=10, counters=None):
+        self.iterable = iterable
+        if total is None and hasattr(iterable, '__len__'):
+            total = len(iterable)
+        self.total = total
+        self.label = label
+        self.stream = stream or sys.stdout
+        self.tty = terminal(self.stream).tty
+        self.interval = 1.0 / refresh if self.tty else log_interval
+        self.counters = counters
+        self.count = 0
+        self.rate = None
+
+    def __iter__(self):
+        target = min(self.interval, 1.0) / 10
+        stride = 1
+        started = stride_started = checked = time.time()
+        checked_count = 0
+        next_check = 1
+        try:
+            for item in self.iterable:
+                self.count += 1
+                yield item
+                if self.count < next_check:
+                    continue
+                now = time.time()
+                if now - stride_started < target:
+                    stride = min(stride * 2, self.max_stride)
+                elif stride > 1:
+                    stride //= 2
+                stride_started = now
+                next_check = self.count + stride
+                if now - checked >= self.interval:
+                    rate = (self.count - checked_count) / (now - checked)
+                    self.rate = rate if self.rate is None else (
+                        0.3 * rate + 0.7 * self.rate)
+                    checked, checked_count = now, self.count
+                    self.render(now - started)
+        finally:
+            self.render(time.time() - started, final=True)
+
+    def text(self, elapsed, final=False):
+        throughput = self.count / elapsed if elapsed > 0 else 0.0
+        parts = [str(self.count)]
+        if self.total:
+            parts = ['%s/%s' % (self.count, self.total),
+                '%d%%' % (100 * self.count // self.total)]
+        if final:
+            parts.append('in %s, %.1f/s' % (format_duration(elapsed),
+                throughput))
+        else:
+            rate = self.rate if self.rate is not None else throughput
+            parts.append('%.1f/s (avg %.1f/s)' % (rate, throughput))
+            if self.total and rate > 0:
+                parts.append('ETA %s' % format_duration(
+                    max(self.total - self.count, 0) / rate))
+        return '%s%s' % (self.label + ': ' if self.label else '',
+            ', '.join(parts))
+
+    def render(self, elapsed, final=False):
+        text = self.text(elapsed, final)
+        if self.counters is not None:
+            self.counters[self.label or 'progress'] = text
+        indent = ''.join(Writer.shared['indent_strings'])
+        if self.tty:
+            self.stream.write('\r%s%s\033[K%s' % (indent, text,
+                '\n' if final else ''))
+            self.stream.flush()
+        else:
+            self.stream.write('%s%s\n' % (indent, text))
+
+
+class Terminal(object):
+    """Capabilities of an output stream: whether it is a TTY, and the
+    number of colors to use, 0 when ``NO_COLOR`` is set or the stream is
+    not a TTY, unless ``FORCE_COLOR`` is set."""
+
+    def __init__(self, stream, environ=None):
+        environ = os.environ if environ is None else environ
+        isatty = getattr(stream, 'isatty', None)
+        try:
+            self.tty = bool(isatty and isatty())
+        except ValueError:  # Closed stream.
+            self.tty = False
+        force = environ.get('FORCE_COLOR')
+        if environ.get('NO_COLOR'):
+            self.colors = 0
+        elif force is not None and force.lower() not in ('0', 'false'):
+            self.colors = max(self.depth(environ), 16)
+        elif self.tty:
+            self.colors = self.depth(environ)
+        else:
+            self.colors = 0
+
+    @staticmethod
+    def depth(environ):
+        term = environ.get('TERM', '')
+        if term == 'dumb':
+            return 0
+        if environ.get('COLORTERM') in ('truecolor', '24bit'):
+            return 1 << 24
+        if '256' in term:
+            return 256
+        return 16
+
+    @property
+    def color(self):
+        return self.colors > 0
+
+
+_terminals = weakref.WeakKeyDictionary()
+
+
+def terminal(stream=None):
+    """Returns the ``Terminal`` of ``stream``, ``sys.stdout`` by default,
+    detected on first use only."""
+    stream = stream or sys.stdout
+    try:
+        return _terminals[stream]
+    except KeyError:
+        capabilities = _terminals[stream] = Terminal(stream)
+    except TypeError:  # Not weak referenceable.
+        capabilities = Terminal(stream)
+    return capabilities
+
+
 class Colored(object):
-    def __init__(self, color, string):
+    """A string colored when rendered for a terminal with colors,
+    ``stream`` or else ``sys.stdout``, the escape sequences being added once
+    at construction."""
+
+    def __init__(self, color, string, stream=None):
         self.color = color
         self.string = string
+        self.stream = stream
+        self.rendered = '%s%s\033[0m' % (color, string)
 
     def __len__(self):
         return len(self.string)
 
     def __str__(self):
-        if sys.stdout.isatty():
-            return "%s%s\033[0m" % (self.color, self.string)
-        return self.string
+        if terminal(self.stream).color:
+            return self.rendered
+        return str(self.string)
 
     def __eq__(self, other):
         return self.string == other
 
 
-def blue(string):
-    return Colored('\033[94m', string)
+def colored(color, string, stream=None):
+    """Returns ``string`` as is when ``stream``, ``sys.stdout`` by default,
+    has no colors."""
+    if not terminal(stream).color:
+        return string
+    return Colored(color, string, stream)
+
+
+def blue(string, stream=None):
+    return colored(BLUE, string, stream)
+
+
+def green(string, stream=None):
+    return colored(GREEN, string, stream)
+
+
+def red(string, stream=None):
+    return colored(RED, string, stream)
+
+
+class PagerClosed(Exception):
+    """Raised on writes once the user has quit the pager."""
+
 
+def terminal_height(stream):
+    try:
+        return int(os.environ['LINES'])
+    except (KeyError, ValueError):
+        pass
+    try:
+        import fcntl
+        import struct
+        import termios
+        return struct.unpack('hh', fcntl.ioctl(stream.fileno(),
+            termios.TIOCGWINSZ, b'\0' * 4))[0] or 24
+    except Exception:
+        return 24
 
-def green(string):
-    return Colored('\033[92m', string)
 
+class Pager(object):
+    """Stream holding back the first screen of output, which is piped into
+    ``$PAGER`` along with the rest once it does not fit.
 
-def red(string):
-    return Colored('\033[91m', string)
+    Output produced slowly is written out as it comes once held back for
+    ``delay`` seconds, without a pager. Writes to the pager block while it
+    is not reading, so the output is produced as fast as it is read, and
+    raise ``PagerClosed`` once the user quits.
+    """
+
+    def __init__(self, stream, command, height, delay=0.5):
+        self.stream = stream
+        self.command = command
+        self.height = height
+        self.delay = delay
+        self.buffer = []
+        self.lines = 0
+        self.process = None
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def isatty(self):
+        return True
+
+    def fileno(self):
+        return self.stream.fileno()
+
+    def start(self):
+        self.timer.cancel()
+        try:
+            self.stream.flush()
+            self.process = subprocess.Popen(self.command,
+                stdin=subprocess.PIPE)
+        except OSError:
+            self.process = False  # No pager, writes go to the stream.
+        data, self.buffer = ''.join(self.buffer), None
+        self.send(data)
+
+    def release(self):
+        """Writes out the held back output, the rest going straight to the
+        stream."""
+        with self.lock:
+            if self.process is None:
+                self.process = False
+                self.stream.write(''.join(self.buffer))
+                self.stream.flush()
+                self.buffer = None
+
+    def write(self, data):
+        with self.lock:
+            if self.process is None:
+                self.buffer.append(data)
+                self.lines += data.count('\n')
+                if self.timer is None:
+                    self.timer = threading.Timer(self.delay, self.release)
+                    self.timer.daemon = True
+                    self.timer.start()
+                if self.lines >= self.height:
+                    self.start()
+                return
+        self.send(data)
+
+    def send(self, data):
+        if self.process is False:
+            self.stream.write(data)
+            return
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        try:
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+        except (IOError, OSError, ValueError) as e:
+            if getattr(e, 'errno', errno.EPIPE) == errno.EPIPE:
+                raise PagerClosed()
+            raise
+
+    def flush(self):
+        if self.process:
+            try:
+                self.process.stdin.flush()
+            except (IOError, OSError, ValueError):
+                raise PagerClosed()
+        elif self.process is False:
+            self.stream.flush()
+
+    def close(self):
+        """Writes out the held back output, or waits for the user to quit
+        the pager."""
+        if self.timer is not None:
+            self.timer.cancel()
+        self.release()
+        if self.process:
+            try:
+                self.process.stdin.close()
+            except (IOError, OSError):
+                pass
+            while True:
+                try:
+                    self.process.wait()
+                    break
+                except KeyboardInterrupt:
+                    pass  # The pager handles it.
+
+
+class paging(object):
+    """Pages the output written to ``sys.stdout`` within the block when it
+    is a TTY and ``$PAGER`` (``less -R`` by default) is not empty.
+
+    Quitting the pager ends the block, closing the generators being
+    printed.
+    """
+
+    def __enter__(self):
+        self.pager = None
+        stream = sys.stdout
+        command = shlex.split(os.environ.get('PAGER', 'less -R'))
+        if command and not isinstance(stream, Pager) and \
+                terminal(stream).tty:
+            self.pager = Pager(stream, command, terminal_height(stream) - 1)
+            sys.stdout = self.pager
+        return self.pager
+
+    def __exit__(self, type, value, traceback):
+        if self.pager is None:
+            return False
+        sys.stdout = self.pager.stream
+        self.pager.close()
+        return type is PagerClosed
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+import collections
+import contextlib
+import json
+import math
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+from manager import Command, Error, Manager, cli, puts
+
+CASES = collections.OrderedDict()
+
+# Two-sided 95% critical values of Student's t distribution by degrees of
+# freedom, 1.96 being used beyond.
+T_CRITICAL = (
+    12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+    2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+    2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042,
+)
+
+
+def case(name):
+    """Registers a benchmark case.
+
+    A case is a context manager factory taking the ``scale`` of the synthetic
+    data and yielding the callable to time.
+    """
+    def register(fn):
+        CASES[name] = contextlib.contextmanager(fn)
+        return fn
+    return register
+
+
+class Null(object):
+    def write(self, s):
+        pass
+
+    def isatty(self):
+        return False
+
+
+@contextlib.contextmanager
+def silenced():
+    stdout, sys.stdout = sys.stdout, Null()
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+
+
+def sample_command(name, count=1, verbose=False, prefix=None):
+    return name
+
+
+def synthetic_manager(size):
+    manager = Manager()
+    for i in range(size):
+        manager.add_command(Command(run=sample_command,
+            name='command_%s' % i, namespace='ns_%s' % (i % 50)))
+    return manager
+
+
+@case('command.inspect')
+def command_inspect(scale):
+    yield lambda: Command(run=sample_command)
+
+
+@case('manager.add_command')
+def manager_add_command(scale):
+    size = int(10000 * scale)
+    yield lambda: synthetic_manager(size)
+
+
+@case('command.parse')
+def command_parse(scale):
+    command = Command(run=sample_command)
+    with silenced():
+        yield lambda: command.parse(['name', '--count', '2', '--verbose'])
+
+
+@case('manager.call')
+def manager_call(scale):
+    manager = Manager()
+    manager.add_command(Command(run=sample_command))
+    yield lambda: manager.call('sample_command', {'name': 'name'})
+
+
+@case('manager.usage')
+def manager_usage(scale):
+    manager = synthetic_manager(int(1000 * scale))
+    with silenced():
+        yield manager.usage
+
+
+@case('manager.parse_env')
+def manager_parse_env(scale):
+    content = '\n'.join('KEY_%s="value %s"' % (i, i)
+        for i in range(int(10000 * scale)))
+    yield lambda: list(Manager().parse_env(content))
+
+
+@case('puts.list')
+def puts_list(scale):
+    items = ['line %s' % i for i in range(int(10000 * scale))]
+    with silenced():
+        yield lambda: puts(items)
+
+
+@case('puts.dict')
+def puts_dict(scale):
+    items = dict(('key %s' % i, i) for i in range(int(1000 * scale)))
+    with silenced():
+        yield lambda: puts(items)
+
+
+@case('progress')
+def progress_(scale):
+    items = range(int(100000 * scale))
+    stream = Null()
+    yield lambda: sum(1 for i in cli.Progress(items, stream=stream))
+
+
+@case('cli.tsplit')
+def cli_tsplit(scale):
+    string = 'line\r\n' * int(1000 * scale)
+    yield lambda: cli.tsplit(string, cli.NEWLINES)
+
+
+@case('cli.min_width')
+def cli_min_width(scale):
+    string = 'line\n' * int(100 * scale)
+    yield lambda: cli.min_width(string, 25)
+
+
+@case('cli.args')
+def cli_args(scale):
+    args = cli.Args(['--arg-%s' % i for i in range(int(1000 * scale))])
+    last = args.last
+
+    def lookup():
+        args.first(last)
+        args.first_with(last)
+        args.contains(last)
+        args.value_after('--arg-0')
+        args.all_with('-9')
+
+    yield lookup
+
+
+@case('cli.expand_path')
+def cli_expand_path(scale):
+    directory = tempfile.mkdtemp()
+    try:
+        for i in range(int(500 * scale)):
+            path = os.path.join(directory, 'dir_%s' % (i % 20))
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            open(os.path.join(path, 'file_%s.py' % i), 'w').close()
+        yield lambda: cli.expand_path(directory)
+    finally:
+        shutil.rmtree(directory)
+
+
+def summarize(times):
+    mean = sum(times) / len(times)
+    variance = sum((t - mean) ** 2 for t in times) / max(len(times) - 1, 1)
+    return {
+        'times': times,
+        'mean': mean,
+        'stdev': math.sqrt(variance),
+        'min': min(times),
+    }
+
+
+def run(cases=None, repeat=7, scale=1.0, min_time=0.05):
+    """Runs the benchmark cases and returns their per-call times.
+
+    Each case is calibrated so one measurement takes at least ``min_time``
+    seconds, and measured ``repeat`` times.
+    """
+    results = collections.OrderedDict()
+    for name in cases or CASES:
+        with CASES[name](scale) as fn:
+            timer = timeit.Timer(fn)
+            number, elapsed = 1, timer.timeit(1)
+            while elapsed < min_time:
+                number *= 10
+                elapsed = timer.timeit(number)
+            times = [t / number for t in timer.repeat(repeat, number)]
+        results[name] = summarize(times)
+    return results
+
+
+def welch(a, b):
+    """Returns Welch's t statistic of ``b`` against ``a`` and whether the
+    difference of their means is significant at 95%."""
+    na, nb = len(a['times']), len(b['times'])
+    va, vb = a['stdev'] ** 2 / na, b['stdev'] ** 2 / nb
+    if va + vb == 0:
+        return float('inf'), a['mean'] != b['mean']
+    t = (b['mean'] - a['mean']) / math.sqrt(va + vb)
+    df = (va + vb) ** 2 / (
+        (va ** 2 / max(na - 1, 1)) + (vb ** 2 / max(nb - 1, 1)) or 1)
+    index = int(df) - 1
+    critical = T_CRITICAL[index] if 0 <= index < len(T_CRITICAL) else 1.96
+    return t, abs(t) > critical
+
+
+def format_time(seconds):
+    for unit, factor in (('s', 1), ('ms', 1e3), ('us', 1e6)):
+        if seconds * factor >= 1:
+            return '%.2f %s' % (seconds * factor, unit)
+    return '%.1f ns' % (seconds * 1e9)
+
+
+def benchmark(output=None, match=None, repeat=7, scale=1.0):
+    """Run the benchmark suite of the manager internals.
+
+    Usage::
+
+        from manager import Manager
+        from manager.ext.benchmark import benchmark, compare
+        manager = Manager()
+        manager.command(benchmark)
+        manager.command(compare)
+
+    """
+    cases = [name for name in CASES if not match or match in name]
+    if not cases:
+        raise Error('No benchmark matching `%s`' % match)
+    results = run(cases, repeat=int(repeat), scale=float(scale))
+    for name, result in results.items():
+        puts(cli.min_width(name, 25) + cli.min_width(
+            format_time(result['mean']), 12) + '+- ' +
+            format_time(result['stdev']))
+    if output:
+        with open(output, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'scale': float(scale),
+                'results': results,
+            }, f, indent=2)
+
+
+def compare(baseline, current, threshold=0.05):
+    """Compare two benchmark results files, failing on significant slowdowns.
+
+    Cases slower by more than ``threshold`` (a ratio) with a significant
+    Welch's t-test are reported as slowdowns.
+    """
+    def load(path):
+        try:
+            with open(path) as f:
+                return json.load(f)['results']
+        except (IOError, OSError, ValueError, KeyError) as e:
+            raise Error('Invalid results file %s: %s' % (path, e))
+
+    baseline, current = load(baseline), load(current)
+    slowdowns = 0
+    for name in baseline:
+        if name not in current:
+            continue
+        a, b = baseline[name], current[name]
+        ratio = b['mean'] / a['mean'] if a['mean'] else float('inf')
+        t, significant = welch(a, b)
+        line = cli.min_width(name, 25) + cli.min_width(
+            '%+.1f%%' % ((ratio - 1) * 100), 10)
+        if significant and ratio > 1 + float(threshold):
+            slowdowns += 1
+            puts(cli.red(line + 'slower'))
+        elif significant and ratio < 1 - float(threshold):
+            puts(cli.green(line + 'faster'))
+        else:
+            puts(line + 'unchanged')
+    if slowdowns:
+        raise Error('%s significant slowdown(s)' % slowdowns)
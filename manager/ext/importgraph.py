@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+import ast
+import json
+import os
+import subprocess
+import time
+
+from manager.incremental import digest, write_atomic
+
+PATH = os.path.join('.manage', 'import-graph.json')
+SKIP_DIRS = ('__pycache__', 'node_modules')
+
+
+def module_name(path):
+    """Returns the dotted module name of a relative ``.py`` path."""
+    name = os.path.splitext(path)[0].replace(os.sep, '.')
+    if name.endswith('.__init__'):
+        name = name[:-len('.__init__')]
+    return name
+
+
+def parse_imports(source, name, package=False):
+    """Returns the absolute names of the modules imported by a module
+    source, including ``from`` imported names as they may be modules."""
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError, TypeError):
+        return []
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            base = node.module or ''
+            if node.level:
+                parts = name.split('.')
+                parts = parts[:len(parts) - node.level + bool(package)]
+                base = '.'.join(parts + ([base] if base else []))
+            if base:
+                names.add(base)
+            names.update('%s.%s' % (base, alias.name) if base else alias.name
+                for alias in node.names if alias.name != '*')
+    return sorted(names)
+
+
+def python_files(root):
+    for directory, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs
+            if not d.startswith('.') and d not in SKIP_DIRS)
+        for f in sorted(files):
+            if f.endswith('.py'):
+                yield os.path.relpath(os.path.join(directory, f), root)
+
+
+def git_changed(ref, root='.'):
+    """Returns the files changed in the work tree against ``ref``, and the
+    untracked ones, relative to ``root``."""
+    from manager import Error
+
+    paths = []
+    for command in (['git', 'diff', '--name-only', '--relative', ref],
+            ['git', 'ls-files', '--others', '--exclude-standard']):
+        try:
+            output = subprocess.check_output(command, cwd=root)
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise Error('`%s` failed: %s' % (' '.join(command), e))
+        paths.extend(line for line in output.decode('utf-8').splitlines()
+            if line)
+    return paths
+
+
+class ImportGraph(object):
+    """Import graph of the Python modules below ``root``, cached in
+    ``path``.
+
+    Each file is stored with its mtime, size, content hash and imports, so
+    only files with a new content are parsed again.
+    """
+
+    def __init__(self, root='.', path=PATH):
+        self.root = root
+        self.path = path
+        try:
+            with open(path) as f:
+                self.data = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.data = {}
+        self.files = self.data.setdefault('files', {})
+
+    @property
+    def last_run(self):
+        return self.data.get('last_run')
+
+    def update(self):
+        """Updates the graph from the files on disk."""
+        files = {}
+        for path in python_files(self.root):
+            full_path = os.path.join(self.root, path)
+            stat = os.stat(full_path)
+            entry = self.files.get(path)
+            if entry is not None and entry[:2] == [stat.st_mtime, stat.st_size]:
+                files[path] = entry
+                continue
+            hexdigest = digest(full_path)
+            if entry is not None and entry[2] == hexdigest:
+                imports = entry[3]
+            else:
+                with open(full_path, 'rb') as f:
+                    imports = parse_imports(f.read(), module_name(path),
+                        os.path.basename(path) == '__init__.py')
+            files[path] = [stat.st_mtime, stat.st_size, hexdigest, imports]
+        self.files.clear()
+        self.files.update(files)
+
+    def save(self):
+        self.data['last_run'] = time.time()
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        write_atomic(self.path, json.dumps(self.data, sort_keys=True))
+
+    def modified_since(self, since):
+        return [path for path, entry in self.files.items() if entry[0] > since]
+
+    def index(self):
+        """Returns ``{name: set(paths)}`` of the modules by their full name
+        and each of its dotted suffixes, so modules imported from another
+        ``sys.path`` entry than ``root`` resolve too (conservatively)."""
+        index = {}
+        for path in self.files:
+            parts = module_name(path).split('.')
+            for i in range(len(parts)):
+                index.setdefault('.'.join(parts[i:]), set()).add(path)
+        return index
+
+    def dependents(self, paths):
+        """Returns the files among ``paths`` and the ones transitively
+        importing them."""
+        index = self.index()
+        importers = {}
+        for path, entry in self.files.items():
+            for name in entry[3]:
+                parts = name.split('.')
+                for i in range(1, len(parts) + 1):
+                    for imported in index.get('.'.join(parts[:i]), ()):
+                        importers.setdefault(imported, set()).add(path)
+
+        pending = [os.path.normpath(p) for p in paths]
+        pending = [p for p in pending if p in self.files]
+        seen = set(pending)
+        while pending:
+            for importer in importers.get(pending.pop(), ()):
+                if importer not in seen:
+                    seen.add(importer)
+                    pending.append(importer)
+        return seen
+
+
+def affected(ref=None, root='.', path=PATH):
+    """Returns the absolute paths of the modules affected by the changes
+    since ``ref`` (a git ref) or, without ``ref``, by the files modified
+    since the last run.
+
+    Returns ``None``, meaning every test is affected, when there was no
+    previous run or when a changed file is not in the import graph, such as
+    a deleted module or a data file.
+    """
+    graph = ImportGraph(root, path)
+    last_run = graph.last_run
+    previous = set(graph.files)
+    graph.update()
+    if ref:
+        changed = git_changed(ref, root)
+    elif last_run is None or previous - set(graph.files):
+        changed = None
+    else:
+        changed = graph.modified_since(last_run)
+    graph.save()
+    if changed is None or any(os.path.normpath(p) not in graph.files
+            for p in changed):
+        return None
+    return set(os.path.abspath(os.path.join(root, p))
+        for p in graph.dependents(changed))
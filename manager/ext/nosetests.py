@@ -1,12 +1,33 @@
 # -*- coding: utf-8 -*-
+import os
+import re
+
 from nose.core import run_exit
 from nose.tools import nottest
 
+from manager import puts
+from manager.ext import importgraph
+
+TEST_MATCH = re.compile(r'(?:^|[_.-])[Tt]est')
+
+
+def pop_changed(argv):
+    """Removes ``--changed[=REF]`` from ``argv``, returning the REF, ``''``
+    without one or ``None`` when the option is not given."""
+    for i, arg in enumerate(argv):
+        if arg == '--changed' or arg.startswith('--changed='):
+            del argv[i]
+            return arg.partition('=')[2]
+    return None
+
 
 @nottest
 def test(argv):
     """Run nosetests.
 
+    ``--changed[=REF]`` only runs the test modules importing files changed
+    since the git REF, or modified since the last run.
+
     Usage::
 
         from manager import Manager
@@ -16,6 +37,16 @@ def test(argv):
 
     """
     argv = [''] + argv
+    changed = pop_changed(argv)
+    if changed is not None:
+        paths = importgraph.affected(changed or None)
+        if paths is not None:
+            paths = sorted(os.path.relpath(p) for p in paths
+                if TEST_MATCH.search(os.path.basename(p)))
+            if not paths:
+                puts('No test affected by the changes')
+                return
+            argv.extend(paths)
     all_ = '--all-modules'
     if not all_ in argv:
         argv.append(all_)
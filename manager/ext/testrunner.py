@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+import argparse
+import heapq
+import json
+import multiprocessing
+import os
+import sys
+import time
+import unittest
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # NOQA
+
+from manager import cli, parallel, puts
+from manager.ext import importgraph
+from manager.incremental import write_atomic
+
+DEFAULT_DURATION = 0.1
+OUTCOMES = ('error', 'failure', 'unexpected success')
+
+
+class RecordingResult(unittest.TestResult):
+    """Records the outcome, duration and details of each test, also put on
+    ``queue`` as soon as the test ends when given.
+
+    Failing subtests and class or module fixture errors are recorded without
+    duration.
+    """
+
+    def __init__(self, queue=None):
+        unittest.TestResult.__init__(self)
+        self.buffer = True
+        self.records = []
+        self.queue = queue
+        self.started = None
+
+    def startTest(self, test):
+        self.started = time.time()
+        unittest.TestResult.startTest(self, test)
+
+    def stopTest(self, test):
+        unittest.TestResult.stopTest(self, test)
+        self.started = None
+
+    def record(self, test, outcome, details=None, timed=True):
+        duration = None
+        if timed and self.started is not None:
+            duration = time.time() - self.started
+        record = (test.id(), outcome, duration, details)
+        self.records.append(record)
+        if self.queue is not None:
+            self.queue.put(record)
+
+    def addSuccess(self, test):
+        unittest.TestResult.addSuccess(self, test)
+        self.record(test, 'ok')
+
+    def addError(self, test, err):
+        unittest.TestResult.addError(self, test, err)
+        self.record(test, 'error', self.errors[-1][1])
+
+    def addFailure(self, test, err):
+        unittest.TestResult.addFailure(self, test, err)
+        self.record(test, 'failure', self.failures[-1][1])
+
+    def addSubTest(self, test, subtest, err):
+        unittest.TestResult.addSubTest(self, test, subtest, err)
+        if err is not None:
+            failure = issubclass(err[0], test.failureException)
+            self.record(subtest, 'failure' if failure else 'error',
+                (self.failures if failure else self.errors)[-1][1],
+                timed=False)
+
+    def addSkip(self, test, reason):
+        unittest.TestResult.addSkip(self, test, reason)
+        self.record(test, 'skip', reason)
+
+    def addExpectedFailure(self, test, err):
+        unittest.TestResult.addExpectedFailure(self, test, err)
+        self.record(test, 'expected failure')
+
+    def addUnexpectedSuccess(self, test):
+        unittest.TestResult.addUnexpectedSuccess(self, test)
+        self.record(test, 'unexpected success')
+
+
+def flatten(suite):
+    """Yields the test cases of a (nested) test suite."""
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            for test_ in flatten(test):
+                yield test_
+        else:
+            yield test
+
+
+def group(tests):
+    """Groups the tests by class, so class and module fixtures only run in
+    one worker, keeping the discovery order."""
+    groups = {}
+    order = []
+    for test in tests:
+        key = '%s.%s' % (test.__class__.__module__, test.__class__.__name__)
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append(test)
+    return [groups[key] for key in order]
+
+
+def source_file(test):
+    module = sys.modules.get(test.__class__.__module__)
+    path = getattr(module, '__file__', None) or ''
+    if path.endswith(('.pyc', '.pyo')):
+        path = path[:-1]
+    return os.path.abspath(path)
+
+
+def shard(groups, durations, count):
+    """Distributes the test groups over ``count`` shards by longest
+    processing time first, using the known test durations."""
+    known = sorted(durations.values())
+    default = known[len(known) // 2] if known else DEFAULT_DURATION
+
+    def cost(tests):
+        return sum(durations.get(test.id(), default) for test in tests)
+
+    shards = [[] for i in range(max(count, 1))]
+    heap = [(0.0, i) for i in range(len(shards))]
+    for tests in sorted(groups, key=cost, reverse=True):
+        load, i = heapq.heappop(heap)
+        shards[i].extend(tests)
+        heapq.heappush(heap, (load + cost(tests), i))
+    return [s for s in shards if s]
+
+
+def load_durations(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def discover(names, start_dir='.', pattern='test*.py'):
+    loader = unittest.TestLoader()
+    if names:
+        return list(flatten(loader.loadTestsFromNames(names)))
+    return list(flatten(loader.discover(start_dir, pattern=pattern)))
+
+
+def run_shard(tests, queue=None):
+    """Runs ``tests``, putting each record on ``queue`` when given and
+    ``None`` once the shard is done."""
+    result = RecordingResult(queue)
+    try:
+        unittest.TestSuite(tests)(result)
+    finally:
+        if queue is not None:
+            queue.put(None)
+    return result.records
+
+
+def stream(shards, by_id):
+    """Yields the records of the shards run in worker processes, as soon as
+    each test ends."""
+    records = multiprocessing.Queue()
+    pool, func = parallel.pool(
+        lambda ids: run_shard([by_id[id_] for id_ in ids], records),
+        executor='process', workers=len(shards))
+    try:
+        pending = pool.map_async(func,
+            [([test.id() for test in tests], ) for tests in shards], 1)
+        remaining = len(shards)
+        while remaining:
+            try:
+                record = records.get(timeout=0.1)
+            except queue.Empty:
+                if pending.ready() and not pending.successful():
+                    pending.get()
+                continue
+            if record is None:
+                remaining -= 1
+            else:
+                yield record
+        # Raises the errors of the workers themselves.
+        pending.get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def test(argv):
+    """Run the unittest suite sharded over worker processes.
+
+    Tests are balanced across workers from their durations recorded by the
+    previous runs.
+
+    Usage::
+
+        from manager import Manager
+        from manager.ext.testrunner import test
+        manager = Manager()
+        manager.command(test, capture_all=True)
+
+    """
+    parser = argparse.ArgumentParser(prog='%s test' % sys.argv[0])
+    parser.add_argument('names', nargs='*',
+        help='test modules, classes or methods, discovered if empty')
+    parser.add_argument('-j', '--jobs', type=int,
+        default=multiprocessing.cpu_count(),
+        help='number of worker processes')
+    parser.add_argument('-s', '--start-directory', default='.',
+        help='directory to start discovery from')
+    parser.add_argument('-p', '--pattern', default='test*.py',
+        help='pattern to match test files')
+    parser.add_argument('--durations', default=os.path.join('.manage',
+        'test-durations.json'), help='test durations cache file')
+    parser.add_argument('--changed', nargs='?', const='', metavar='REF',
+        help='only run the test modules importing files changed since the '
+        'git REF, or modified since the last run')
+    options = parser.parse_args(argv)
+
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    tests = discover(options.names, options.start_directory, options.pattern)
+    if options.changed is not None:
+        paths = importgraph.affected(options.changed or None)
+        if paths is not None:
+            tests = [test for test in tests if source_file(test) in paths]
+        if not tests:
+            puts('No test affected by the changes')
+            return
+    durations = load_durations(options.durations)
+    shards = shard(group(tests), durations, options.jobs)
+    by_id = dict((test.id(), test) for test in tests)
+
+    started = time.time()
+    counts = dict.fromkeys(('ok', 'skip', 'expected failure') + OUTCOMES, 0)
+    failed = []
+    for id_, outcome, duration, details in stream(shards, by_id):
+        counts[outcome] += 1
+        if duration is not None:
+            durations[id_] = duration
+        if outcome in OUTCOMES:
+            failed.append((id_, outcome, details))
+            puts(cli.red('%s: %s' % (outcome.upper(), id_)))
+
+    for id_, outcome, details in failed:
+        puts(cli.red('\n%s: %s' % (outcome.upper(), id_)))
+        if details:
+            puts(details)
+
+    directory = os.path.dirname(options.durations)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    write_atomic(options.durations, json.dumps(durations, sort_keys=True))
+
+    puts('\nRan %s tests in %.3fs on %s workers' % (
+        sum(counts.values()), time.time() - started, len(shards)))
+    summary = ', '.join('%s=%s' % (outcome.replace(' ', '_'), counts[outcome])
+        for outcome in ('error', 'failure', 'skip', 'expected failure',
+            'unexpected success') if counts[outcome])
+    if failed:
+        puts(cli.red('FAILED (%s)' % summary))
+        sys.exit(1)
+    puts(cli.green('OK (%s)' % summary if summary else 'OK'))
+
+
+test.__test__ = False
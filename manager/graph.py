@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+
+def resolve(commands, paths):
+    """Returns the dependency graph of the given command paths.
+
+    The graph maps every command path reachable from ``paths`` through the
+    commands' ``depends`` declarations to the set of its direct
+    dependencies.
+
+    :param dict commands: The registered commands, keyed by path.
+    :param list paths: The paths of the requested commands.
+    """
+    from manager import Error
+
+    graph = {}
+    visiting = []
+
+    def visit(path, parent=None):
+        if path in visiting:
+            cycle = visiting[visiting.index(path):] + [path]
+            raise Error('Dependency cycle: %s' % ' -> '.join(cycle))
+        if path in graph:
+            return
+        if path not in commands:
+            if parent is None:
+                raise Error('Invalid command `%s`' % path)
+            raise Error('Invalid dependency `%s` of `%s`' % (path, parent))
+        visiting.append(path)
+        depends = commands[path].depends or ()
+        for dependency in depends:
+            visit(dependency, path)
+        visiting.pop()
+        graph[path] = set(depends)
+
+    for path in paths:
+        visit(path)
+    return graph
+
+
+def stages(graph):
+    """Groups the graph's commands in successive stages, each stage only
+    depending on the previous ones."""
+    pending = dict((path, set(depends)) for path, depends in graph.items())
+    stages_ = []
+    while pending:
+        stage = sorted(path for path in pending if not pending[path])
+        for path in stage:
+            del pending[path]
+        for depends in pending.values():
+            depends.difference_update(stage)
+        stages_.append(stage)
+    return stages_
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import tempfile
+
+from manager import cli, parallel
+
+PARALLEL_THRESHOLD = 32
+BLOCK_SIZE = 1 << 16
+
+
+def expand(patterns):
+    """Returns the sorted files matched by the given globs or directories."""
+    paths = set()
+    for pattern in patterns:
+        paths.update(p for p in cli.expand_path(pattern) if os.path.isfile(p))
+    return sorted(paths)
+
+
+def digest(path):
+    """Returns the sha1 hex digest of the file's content."""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def default_permissions(path):
+    """Gives ``path`` the permissions of a newly created file, as temporary
+    files are only readable by their owner."""
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(path, 0o666 & ~umask)
+
+
+def write_atomic(path, data, mode='w'):
+    """Writes ``data`` to a temporary file renamed over ``path``."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+        prefix='.%s.' % os.path.basename(path))
+    try:
+        with os.fdopen(fd, mode) as f:
+            f.write(data)
+        default_permissions(tmp)
+        os.rename(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+class State(object):
+    """Local store of the commands' last successful fingerprints.
+
+    The content hash of every input file is stored along with its mtime and
+    size so unchanged files do not need to be read again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.data = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.data = {}
+
+    def save(self):
+        write_atomic(self.path, json.dumps(self.data, sort_keys=True))
+
+    def hash_files(self, path, paths, workers=None):
+        """Returns ``{file: [mtime, size, digest]}`` for the given files,
+        reusing the digests recorded for ``path`` when mtime and size are
+        unchanged."""
+        known = self.data.get(path, {}).get('files', {})
+        files, missing = {}, []
+        for p in paths:
+            stat = os.stat(p)
+            entry = known.get(p)
+            if entry is not None and entry[:2] == [stat.st_mtime, stat.st_size]:
+                files[p] = entry
+            else:
+                files[p] = [stat.st_mtime, stat.st_size, None]
+                missing.append(p)
+
+        if len(missing) >= PARALLEL_THRESHOLD:
+            digests = parallel.imap(digest, [(p, ) for p in missing],
+                workers=workers, chunksize=8)
+        else:
+            digests = (digest(p) for p in missing)
+        for p, hexdigest in zip(missing, digests):
+            files[p][2] = hexdigest
+        return files
+
+    def fingerprint(self, command, args, kwargs, env):
+        """Returns the ``(fingerprint, files)`` of a command invocation.
+
+        The fingerprint covers the content of the input files, the
+        invocation's arguments and the given environment variables.
+        """
+        files = self.hash_files(command.path, expand(command.inputs))
+        sha = hashlib.sha1()
+        for value in (
+                [[p, files[p][2]] for p in sorted(files)],
+                repr(args), repr(sorted(kwargs.items())),
+                sorted(env.items())):
+            sha.update(json.dumps(value).encode('utf-8'))
+        return sha.hexdigest(), files
+
+    def up_to_date(self, command, fingerprint):
+        """Tells whether the command last succeeded with ``fingerprint`` and
+        all its declared outputs exist."""
+        if self.data.get(command.path, {}).get('fingerprint') != fingerprint:
+            return False
+        return all(expand([pattern]) for pattern in command.outputs)
+
+    def update(self, command, fingerprint, files):
+        self.data[command.path] = {'fingerprint': fingerprint, 'files': files}
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import atexit
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+from manager import metrics
+from manager.cli import format_duration
+from manager.incremental import write_atomic
+
+# Progress counters reported by the running command, see ``report``.
+COUNTERS = {}
+
+TIMEOUT = 5
+
+_state = {}
+
+
+def report(name, value):
+    """Sets a progress counter shown in the dumps."""
+    COUNTERS[name] = value
+
+
+def rss():
+    """Returns the current resident set size of the process in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return metrics.max_rss()
+
+
+def dump(frame=None):
+    """Returns the report of the threads stacks, elapsed time, RSS and
+    progress counters of the process, the current thread's stack starting
+    from ``frame`` when given."""
+    from manager.limits import format_size
+
+    lines = ['pid %s, `%s` running for %s, RSS %s' % (
+        os.getpid(), ' '.join(_state.get('argv', [])),
+        format_duration(time.time() - _state.get('started', time.time())),
+        format_size(rss() or 0))]
+    if COUNTERS:
+        lines.append('\nProgress:')
+        lines.extend('  %s: %s' % (name, COUNTERS[name])
+            for name in sorted(COUNTERS))
+    names = dict((thread.ident, thread.name) for thread in
+        threading.enumerate())
+    frames = sys._current_frames()
+    if frame is not None:
+        frames[threading.current_thread().ident] = frame
+    for ident, frame in sorted(frames.items()):
+        lines.append('\nThread %s (%s):' % (names.get(ident, '?'), ident))
+        lines.extend(line.rstrip('\n')
+            for line in traceback.format_stack(frame))
+    return '\n'.join(lines) + '\n'
+
+
+def path(manager, pid, extension):
+    directory = manager.state_path('inspect')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return os.path.join(directory, '%s.%s' % (pid, extension))
+
+
+def start_time(pid):
+    """Returns an identifier of when the process ``pid`` started, telling it
+    apart from a later process reusing its pid, or ``None``."""
+    try:
+        with open('/proc/%s/stat' % pid) as f:
+            # The command name in parentheses may contain spaces.
+            return f.read().rpartition(')')[2].split()[19]
+    except (IOError, OSError, IndexError):
+        pass
+    try:
+        output = subprocess.check_output(['ps', '-o', 'lstart=', '-p',
+            str(pid)])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode('utf-8').strip() or None
+
+
+def handle(signum, frame):
+    # The command goes on whatever happens here.
+    try:
+        report_ = dump(frame)
+        sys.stderr.write(report_)
+        write_atomic(_state['path'], report_)
+    except Exception as e:
+        try:
+            sys.stderr.write('Cannot dump the process state: %s\n' % e)
+        except Exception:
+            pass
+
+
+def cleanup(paths=None):
+    for path_ in paths if paths is not None else _state.get('cleanup', ()):
+        if os.path.exists(path_):
+            os.remove(path_)
+
+
+def install(manager, argv):
+    """Installs the SIGUSR1 handler dumping the process state to stderr and
+    to the state directory, without interrupting the command."""
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+    pid = os.getpid()
+    _state.update(argv=argv, started=time.time(),
+        path=path(manager, pid, 'txt'))
+    signal.signal(signal.SIGUSR1, handle)
+    ready = path(manager, pid, 'ready')
+    write_atomic(ready, start_time(pid) or '')
+    if 'cleanup' not in _state:
+        atexit.register(cleanup)
+    _state['cleanup'] = [ready, _state['path']]
+
+
+def collect(manager, pid):
+    """Signals the process ``pid`` to dump its state and returns the dump.
+
+    Only processes which installed the handler are signaled, as SIGUSR1
+    terminates the others.
+    """
+    from manager import Error
+
+    ready = path(manager, pid, 'ready')
+    try:
+        with open(ready) as f:
+            started = f.read()
+    except (IOError, OSError):
+        started = None
+    if started is not None and started != (start_time(pid) or ''):
+        # Left by a killed process, the pid may have been reused since.
+        cleanup([ready])
+        started = None
+    if started is None:
+        raise Error('Process %s is not inspectable, see '
+            '`Manager(introspection=True)`' % pid)
+    dump_path = path(manager, pid, 'txt')
+    cleanup([dump_path])
+    sent = time.time()
+    try:
+        os.kill(pid, signal.SIGUSR1)
+    except OSError as e:
+        raise Error('Cannot signal process %s: %s' % (pid, e))
+    while time.time() < sent + TIMEOUT:
+        if os.path.exists(dump_path):
+            with open(dump_path) as f:
+                return f.read()
+        time.sleep(0.05)
+    raise Error('Process %s did not dump its state within %ss' % (pid,
+        TIMEOUT))
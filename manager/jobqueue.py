@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+import pickle
+import sqlite3
+import time
+import types
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # NOQA
+
+from manager import journal, parallel
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL,
+    args BLOB NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    available_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    finished_at REAL,
+    result BLOB,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_available ON jobs (status, available_at);
+"""
+
+PROTOCOL = 2
+
+
+def dumps(value):
+    return sqlite3.Binary(pickle.dumps(value, PROTOCOL))
+
+
+def loads(blob):
+    return pickle.loads(bytes(blob)) if blob is not None else None
+
+
+class Queue(object):
+    """Durable job queue stored in a SQLite database in WAL mode.
+
+    Claimed jobs are hidden from other workers for ``visibility_timeout``
+    seconds, after which they are claimed again, e.g. when their worker
+    died. Failed jobs are retried up to ``max_attempts`` times, waiting
+    ``backoff * 2 ** (attempts - 1)`` seconds between attempts.
+    """
+
+    def __init__(self, manager, visibility_timeout=300, max_attempts=3,
+            backoff=1.0):
+        self.manager = manager
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+
+    def connect(self):
+        connection = journal.connect(self.manager.state_path('queue.sqlite'))
+        connection.executescript(SCHEMA)
+        return connection
+
+    def put(self, path, values, max_attempts=None, delay=0):
+        """Queues a run of the command with the given argument values and
+        returns the job id."""
+        now = time.time()
+        connection = self.connect()
+        try:
+            with connection:
+                cursor = connection.execute(
+                    'INSERT INTO jobs (path, args, status, max_attempts, '
+                    'available_at, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                    (path, dumps(values), 'queued',
+                        max_attempts or self.max_attempts, now + delay, now))
+            return cursor.lastrowid
+        finally:
+            connection.close()
+
+    def claim(self, count):
+        """Claims up to ``count`` available jobs, returning their
+        ``(id, path, values, attempts)``."""
+        now = time.time()
+        connection = self.connect()
+        connection.isolation_level = None
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.execute(
+                    "UPDATE jobs SET status = 'failed', finished_at = ?, "
+                    "error = 'Visibility timeout expired' WHERE status = "
+                    "'running' AND available_at <= ? AND attempts >= "
+                    "max_attempts", (now, now))
+                rows = connection.execute(
+                    "SELECT id, path, args, attempts FROM jobs WHERE status "
+                    "IN ('queued', 'running') AND available_at <= ? AND "
+                    "attempts < max_attempts ORDER BY available_at, id "
+                    "LIMIT ?", (now, count)).fetchall()
+                connection.executemany(
+                    "UPDATE jobs SET status = 'running', attempts = ?, "
+                    "available_at = ? WHERE id = ?",
+                    [(attempts + 1, now + self.visibility_timeout, id_)
+                        for id_, path, args, attempts in rows])
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        finally:
+            connection.close()
+        return [(id_, path, loads(args), attempts + 1)
+            for id_, path, args, attempts in rows]
+
+    def finish(self, id_, attempts, value=None, error=None):
+        """Stores the result of a job attempt, retrying it later on error
+        when attempts are left."""
+        now = time.time()
+        connection = self.connect()
+        try:
+            with connection:
+                # The claim may have expired and been taken over meanwhile.
+                where = " WHERE id = ? AND attempts = ? AND status = 'running'"
+                if error is None:
+                    connection.execute(
+                        "UPDATE jobs SET status = 'done', finished_at = ?, "
+                        "result = ?, error = NULL" + where,
+                        (now, dumps(value), id_, attempts))
+                else:
+                    connection.execute(
+                        "UPDATE jobs SET status = CASE WHEN attempts < "
+                        "max_attempts THEN 'queued' ELSE 'failed' END, "
+                        "available_at = ?, finished_at = ?, error = ?" + where,
+                        (now + self.backoff * 2 ** (attempts - 1), now, error,
+                            id_, attempts))
+        finally:
+            connection.close()
+
+    def get(self, id_):
+        """Returns the ``status``, ``attempts``, ``result`` and ``error`` of
+        a job, or ``None`` for an unknown job."""
+        connection = self.connect()
+        try:
+            row = connection.execute(
+                'SELECT status, attempts, result, error FROM jobs WHERE id = ?',
+                (id_, )).fetchone()
+        finally:
+            connection.close()
+        if row is None:
+            return None
+        return {'status': row[0], 'attempts': row[1],
+            'result': loads(row[2]), 'error': row[3]}
+
+    def run(self, id_, path, values, attempts):
+        """Runs a job, returning ``(id, attempts, value, error)``."""
+        from manager import Error
+
+        try:
+            result = self.manager.call(path, values)
+            value = result.value
+            if isinstance(value, types.GeneratorType):
+                value = list(value)
+            if isinstance(value, Error):
+                return id_, attempts, None, str(value)
+            if result.status:
+                return id_, attempts, None, 'Exit status %s' % result.status
+            pickle.dumps(value, PROTOCOL)
+            return id_, attempts, value, None
+        except Exception as e:
+            return id_, attempts, None, '%s: %s' % (type(e).__name__, e)
+
+    def work(self, concurrency=1, executor='process', batch_size=None,
+            poll_interval=1.0, burst=False):
+        """Runs the queued jobs in a pool of ``concurrency`` workers, claiming
+        them by batches of ``batch_size``, until interrupted or, with
+        ``burst``, until no job is available.
+
+        An attempt fails when its worker process dies or when it outlives
+        the visibility timeout, freeing its slot.
+        """
+        from manager import puts
+
+        batch_size = batch_size or concurrency
+        tasks = parallel.Tasks(self.run, executor=executor,
+            workers=concurrency)
+        # The attempts and claim time of the running jobs, by id.
+        claimed = {}
+
+        def finish(id_, attempts, value, error):
+            self.finish(id_, attempts, value, error)
+            if error is None:
+                puts('Job %s done' % id_)
+            else:
+                puts('Job %s failed (attempt %s): %s' % (
+                    id_, attempts, error))
+
+        try:
+            while True:
+                if len(tasks) < concurrency:
+                    for job in self.claim(batch_size):
+                        tasks.submit(job[0], job)
+                        claimed[job[0]] = (job[3], time.time())
+                now = time.time()
+                for id_ in sorted(claimed):
+                    attempts, claimed_at = claimed[id_]
+                    if claimed_at + self.visibility_timeout <= now:
+                        tasks.discard(id_)
+                        del claimed[id_]
+                        finish(id_, attempts, None,
+                            'Visibility timeout expired')
+                if not len(tasks):
+                    if burst:
+                        break
+                    time.sleep(poll_interval)
+                    continue
+                try:
+                    id_, result, error = tasks.get(timeout=poll_interval)
+                except queue.Empty:
+                    continue
+                attempts, _ = claimed.pop(id_)
+                if error is None:
+                    id_, attempts, value, error = result
+                else:
+                    value = None
+                finish(id_, attempts, value, error)
+            tasks.pool.close()
+        finally:
+            tasks.pool.terminate()
+            tasks.pool.join()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import atexit
+import hashlib
+import math
+import os
+import re
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS invocations (
+    path TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    start REAL NOT NULL,
+    duration REAL NOT NULL,
+    cpu_time REAL NOT NULL,
+    max_rss INTEGER,
+    status INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS invocations_start ON invocations (start);
+"""
+
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def connect(path, timeout=30):
+    """Returns a connection to a SQLite database in WAL mode."""
+    connection = sqlite3.connect(path, timeout=timeout)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+
+def parse_window(window):
+    """Returns the seconds of a ``<number>[smhdw]`` time window."""
+    match = re.match(r'^(\d+(?:\.\d+)?)([smhdw]?)$', str(window).strip())
+    if match is None:
+        raise ValueError('Invalid time window `%s`' % window)
+    return float(match.group(1)) * UNITS[match.group(2) or 's']
+
+
+def percentile(values, percent):
+    """Returns the nearest-rank percentile of the sorted values."""
+    index = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+
+class Journal(object):
+    """SQLite journal of the commands invocations.
+
+    Invocations are buffered and written by batches of ``batch_size``, and
+    when the process exits.
+    """
+
+    def __init__(self, manager, batch_size=100):
+        self.manager = manager
+        self.batch_size = batch_size
+        self.pending = []
+        self.pid = os.getpid()
+        atexit.register(self.flush)
+
+    def connect(self):
+        connection = connect(self.manager.state_path('journal.sqlite'))
+        connection.executescript(SCHEMA)
+        return connection
+
+    def record(self, event):
+        """Hook buffering the event of a finished invocation."""
+        fingerprint = hashlib.sha1(repr(
+            (event['args'], sorted(event['kwargs'].items()))
+        ).encode('utf-8')).hexdigest()[:16]
+        self.pending.append((
+            event['path'], fingerprint, event['start'], event['duration'],
+            event['cpu_time'], event['max_rss'], event['status'],
+        ))
+        # Forked workers exit without running atexit handlers.
+        if len(self.pending) >= self.batch_size or os.getpid() != self.pid:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        connection = self.connect()
+        try:
+            with connection:
+                connection.executemany(
+                    'INSERT INTO invocations VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    pending)
+        finally:
+            connection.close()
+
+    def stats(self, since=None, path=None):
+        """Returns ``{path: (count, p50, p95, p99)}`` of the invocations
+        durations started after ``since``."""
+        self.flush()
+        query = 'SELECT path, duration FROM invocations WHERE start >= ?'
+        params = [since or 0]
+        if path:
+            query += ' AND path = ?'
+            params.append(path)
+        durations = {}
+        connection = self.connect()
+        try:
+            for path_, duration in connection.execute(query, params):
+                durations.setdefault(path_, []).append(duration)
+        finally:
+            connection.close()
+
+        stats = {}
+        for path_, values in durations.items():
+            values.sort()
+            stats[path_] = (len(values), percentile(values, 50),
+                percentile(values, 95), percentile(values, 99))
+        return stats
+
+    def window_stats(self, window, path=None):
+        return self.stats(since=time.time() - parse_window(window), path=path)
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+import errno
+import math
+import os
+import pickle
+import re
+import select
+import signal
+import sys
+import time
+import traceback
+
+try:
+    import fcntl
+    import resource
+except ImportError:
+    fcntl = resource = None  # NOQA
+
+GRACE_PERIOD = 5
+UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+class Terminated(BaseException):
+    """Raised in the command's process when it has to shut down."""
+
+
+def parse_size(size):
+    """Returns the bytes of a size such as ``1048576``, ``512M`` or
+    ``2G``."""
+    match = re.match(r'^(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?$',
+        str(size).strip().upper())
+    if match is None:
+        raise ValueError('Invalid size `%s`' % size)
+    return int(float(match.group(1)) * UNITS[match.group(2)])
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            break
+        size /= 1024.0
+    return '%.1f %s' % (size, unit)
+
+
+def terminate(signum, frame):
+    raise Terminated('cpu' if signum == signal.SIGXCPU else 'timeout')
+
+
+def child(command, fn, fd):
+    """Runs ``fn`` within the command's limits and writes its pickled
+    ``(kind, value)`` outcome to ``fd``."""
+    from manager import Error
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGXCPU, terminate)
+    if command.max_memory is not None:
+        size = parse_size(command.max_memory)
+        resource.setrlimit(resource.RLIMIT_AS, (size, size))
+    if command.max_cpu_seconds is not None:
+        seconds = int(math.ceil(command.max_cpu_seconds))
+        # SIGXCPU at the soft limit, SIGKILL at the hard one.
+        resource.setrlimit(resource.RLIMIT_CPU,
+            (seconds, seconds + GRACE_PERIOD))
+    try:
+        r = fn()
+        if hasattr(r, '__next__') or hasattr(r, 'next'):
+            outcome = ('stream', list(r))
+        else:
+            outcome = ('value', r)
+    except Error as e:
+        outcome = ('error', str(e))
+    except Terminated as e:
+        outcome = ('limit', e.args[0])
+    except MemoryError:
+        outcome = ('limit', 'memory')
+    except SystemExit as e:
+        outcome = ('exit', e.code)
+    except BaseException as e:
+        traceback.print_exc()
+        outcome = ('exception', '%s: %s' % (type(e).__name__, e))
+    try:
+        data = pickle.dumps(outcome, pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        data = pickle.dumps(('exception', 'Cannot pickle the result: %s' % e),
+            pickle.HIGHEST_PROTOCOL)
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def read(pid, fd, timeout=None):
+    """Reads the child's output until it exits, sending it SIGTERM after
+    ``timeout`` seconds, then SIGKILL after the grace period. Returns the
+    data and whether it timed out."""
+    chunks = []
+    deadline = None if timeout is None else time.time() + timeout
+    signum, timed_out = signal.SIGTERM, False
+    while True:
+        wait = None if deadline is None else max(deadline - time.time(), 0)
+        try:
+            readable = select.select([fd], [], [], wait)[0]
+        except (select.error, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        if readable:
+            chunk = os.read(fd, 1 << 16)
+            if not chunk:
+                return b''.join(chunks), timed_out
+            chunks.append(chunk)
+            continue
+        timed_out = True
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
+        if signum == signal.SIGKILL:
+            deadline = None
+        else:
+            signum, deadline = signal.SIGKILL, time.time() + GRACE_PERIOD
+
+
+def run(command, fn):
+    """Runs ``fn`` in a forked child within the command's ``max_memory``
+    (address space), ``max_cpu_seconds`` and ``timeout`` limits, raising an
+    ``Error`` with its peak RSS and CPU time when one is hit.
+
+    The command gets ``GRACE_PERIOD`` seconds to shut down, as it receives
+    SIGTERM or SIGXCPU, before being killed.
+    """
+    from manager import Error
+
+    if resource is None or not hasattr(os, 'fork'):
+        raise Error('Resource limits are not supported on this platform')
+    sys.stdout.flush()
+    sys.stderr.flush()
+    read_fd, write_fd = os.pipe()
+    fcntl.fcntl(write_fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_fd)
+            child(command, fn, write_fd)
+            os._exit(0)
+        finally:
+            os._exit(1)
+
+    os.close(write_fd)
+    try:
+        data, timed_out = read(pid, read_fd, command.timeout)
+    finally:
+        os.close(read_fd)
+    status, usage = os.wait4(pid, 0)[1:]
+    try:
+        kind, value = pickle.loads(data)
+    except Exception:
+        kind, value = None, None
+
+    rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    cpu_time = usage.ru_utime + usage.ru_stime
+    if timed_out:
+        reason = 'exceeded its timeout of %ss' % command.timeout
+    elif command.max_cpu_seconds is not None and (
+            kind == 'limit' and value == 'cpu' or
+            os.WIFSIGNALED(status) and cpu_time >= command.max_cpu_seconds):
+        reason = 'exceeded its CPU time limit of %ss' % command.max_cpu_seconds
+    elif kind == 'limit' and value == 'memory':
+        if command.max_memory is None:
+            reason = 'ran out of memory'
+        else:
+            reason = 'exceeded its memory limit of %s' % format_size(
+                parse_size(command.max_memory))
+    elif kind == 'limit':
+        reason = 'was terminated by signal %s' % (signal.SIGXCPU
+            if value == 'cpu' else signal.SIGTERM)
+    elif os.WIFSIGNALED(status):
+        reason = 'was killed by signal %s' % os.WTERMSIG(status)
+    elif kind is None:
+        reason = 'exited with status %s' % os.WEXITSTATUS(status)
+    else:
+        reason = None
+    if reason is not None:
+        raise Error('`%s` %s (peak RSS %s, CPU time %.2fs)' % (command.path,
+            reason, format_size(rss), cpu_time))
+
+    if kind in ('error', 'exception'):
+        raise Error(value)
+    elif kind == 'exit':
+        raise SystemExit(value)
+    elif kind == 'stream':
+        return (item for item in value)
+    return value
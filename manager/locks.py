@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+import errno
+import hashlib
+import os
+import pickle
+import sys
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # NOQA
+
+from manager.incremental import write_atomic
+
+POLL_INTERVAL = 0.05
+MAX_POLL_INTERVAL = 0.5
+LOCKED = (errno.EACCES, errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+def try_lock(path, create=True):
+    """Returns a descriptor of ``path`` holding an exclusive ``flock``, or
+    ``None`` when the file is locked by another descriptor (or missing,
+    unless ``create`` is set)."""
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT if create else os.O_RDONLY,
+            0o644)
+    except OSError as e:
+        if e.errno == errno.ENOENT and not create:
+            return None
+        raise
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError) as e:
+        os.close(fd)
+        if e.errno in LOCKED:
+            return None
+        raise
+    return fd
+
+
+def makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class Ticket(object):
+    """A place in the queue of the processes waiting for a lock.
+
+    Tickets are files named by arrival time, locked by their process while
+    it waits so the ones left by dead processes can be told apart.
+    """
+
+    def __init__(self, directory):
+        makedirs(directory)
+        self.directory = directory
+        self.name = '%017.6f-%d' % (time.time(), os.getpid())
+        self.fd = try_lock(os.path.join(directory, self.name))
+
+    def position(self):
+        position = 1
+        for name in sorted(os.listdir(self.directory)):
+            if name >= self.name:
+                break
+            path = os.path.join(self.directory, name)
+            fd = try_lock(path, create=False)
+            if fd is None:
+                position += 1
+            else:
+                remove(path)
+                os.close(fd)
+        return position
+
+    def close(self):
+        remove(os.path.join(self.directory, self.name))
+        os.close(self.fd)
+
+
+def wait(attempt, directory, name, slots=1, timeout=None):
+    """Calls ``attempt`` until it returns a lock, in arrival order among
+    the waiting processes, reporting the queue position on stderr."""
+    from manager import Error
+
+    ticket = Ticket(directory)
+    deadline = None if timeout is None else time.time() + timeout
+    interval = POLL_INTERVAL
+    reported = None
+    try:
+        while True:
+            position = ticket.position()
+            if position <= slots:
+                fd = attempt()
+                if fd is not None:
+                    return fd
+            if position != reported:
+                sys.stderr.write('Waiting for `%s`, position %s in queue\n' % (
+                    name, position))
+                reported = position
+            if deadline is not None:
+                if time.time() >= deadline:
+                    raise Error('Timed out after %ss waiting for `%s`' % (
+                        timeout, name))
+                interval = min(interval, max(deadline - time.time(), 0))
+            time.sleep(interval)
+            interval = min(interval * 2, MAX_POLL_INTERVAL)
+    finally:
+        ticket.close()
+
+
+class Semaphore(object):
+    """Cross-process semaphore made of ``slots`` lock files."""
+
+    def __init__(self, path, slots):
+        self.path = path
+        self.paths = ['%s.%s.lock' % (path, i) for i in range(slots)]
+
+    def try_acquire(self):
+        for path in self.paths:
+            fd = try_lock(path)
+            if fd is not None:
+                return fd
+        return None
+
+    def acquire(self, name, timeout=None):
+        """Returns the descriptor holding a slot, to close to release it."""
+        fd = self.try_acquire()
+        if fd is None:
+            fd = wait(self.try_acquire, self.path + '.waiting', name,
+                slots=len(self.paths), timeout=timeout)
+        return fd
+
+
+def hold(fd, items):
+    """Yields the items, releasing the lock once they are consumed."""
+    try:
+        for item in items:
+            yield item
+    finally:
+        os.close(fd)
+
+
+def limit(command, path, fn):
+    """Runs ``fn`` holding one of the ``max_concurrency`` slots of the
+    command."""
+    fd = Semaphore(path, command.max_concurrency).acquire(command.path,
+        command.wait_timeout)
+    try:
+        r = fn()
+    except BaseException:
+        os.close(fd)
+        raise
+    if hasattr(r, '__next__') or hasattr(r, 'next'):
+        return hold(fd, r)
+    os.close(fd)
+    return r
+
+
+def read_result(path, since):
+    try:
+        if os.stat(path).st_mtime < since:
+            return None
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def replay(result):
+    from manager import Error
+
+    kind, value = result
+    if kind == 'error':
+        raise Error(value)
+    elif kind == 'stream':
+        return (item for item in value)
+    return value
+
+
+def single_flight(command, args, kwargs, path, fn):
+    """Runs ``fn`` unless an invocation with the same arguments is running,
+    in which case its result is waited for and reused."""
+    from manager import Error
+
+    key = hashlib.sha1(repr((args, sorted(kwargs.items()),
+        sorted(command.environment().items()))).encode('utf-8')).hexdigest()
+    path = '%s-%s' % (path, key[:16])
+    started = time.time()
+    fd = try_lock(path + '.lock')
+    if fd is None:
+        fd = wait(lambda: try_lock(path + '.lock'), path + '.waiting',
+            command.path, timeout=command.wait_timeout)
+        result = read_result(path + '.result', started)
+        if result is not None:
+            os.close(fd)
+            return replay(result)
+
+    try:
+        remove(path + '.result')
+        try:
+            r = fn()
+            if hasattr(r, '__next__') or hasattr(r, 'next'):
+                result = ('stream', list(r))
+            else:
+                result = ('value', r)
+        except Error as e:
+            result = ('error', str(e))
+        try:
+            data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            pass  # Not shareable, followers run the command themselves.
+        else:
+            write_atomic(path + '.result', data, 'wb')
+    finally:
+        os.close(fd)
+    return replay(result)
+
+
+def guard(command, args, kwargs, fn):
+    """Runs ``fn`` under the command's ``single_flight`` and
+    ``max_concurrency`` locks, held in the ``run`` state directory."""
+    from manager import Error
+
+    if fcntl is None:
+        raise Error('max_concurrency and single_flight require fcntl')
+    directory = command.manager.state_path('run')
+    makedirs(directory)
+    path = os.path.join(directory, command.path)
+    if command.max_concurrency is not None:
+        fn = (lambda fn: lambda: limit(command, path, fn))(fn)
+    if command.single_flight:
+        return single_flight(command, args, kwargs, path, fn)
+    return fn()
@@ -3,19 +3,29 @@ import os
 import imp
 import sys
 
+import manager_startup as startup
 from manager import cli, puts
 
 
-def main():
-    try:
-        sys.path.append(os.getcwd())
-        imp.load_source('manage_file', os.path.join(os.getcwd(), 'manage.py'))
-    except IOError as exc:
-        return puts(cli.red(exc))
+def run(argv):
+    """Loads ``manage.py`` from the current directory and runs its manager
+    with ``argv``."""
+    with startup.phase('load manage.py'):
+        try:
+            sys.path.append(os.getcwd())
+            imp.load_source('manage_file',
+                os.path.join(os.getcwd(), 'manage.py'))
+        except IOError as exc:
+            return puts(cli.red(exc))
+
+        from manage_file import manager
 
-    from manage_file import manager
+    with startup.phase('Manager.main'):
+        manager.main(argv)
 
-    manager.main()
+
+def main():
+    startup.main()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import atexit
+import json
+import socket
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None  # NOQA
+
+
+def cpu_time():
+    """Returns the user and system CPU seconds used by the process."""
+    if resource is None:
+        if hasattr(time, 'process_time'):
+            return time.process_time()
+        return time.clock()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def max_rss():
+    """Returns the peak resident set size of the process in bytes."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def start(path, args, kwargs):
+    """Returns the event of a starting command invocation."""
+    return {
+        'path': path,
+        'args': args,
+        'kwargs': kwargs,
+        'start': time.time(),
+        'cpu_time': cpu_time(),
+        'max_rss': max_rss(),
+    }
+
+
+def finish(event, status):
+    """Completes the event of an invocation with its exit status, duration,
+    CPU time and RSS.
+
+    ``max_rss`` is the peak of the whole process lifetime, so commands run
+    after a heavier one report its peak; ``max_rss_growth`` is how much the
+    command raised that peak.
+    """
+    event['status'] = status
+    event['duration'] = time.time() - event['start']
+    event['cpu_time'] = cpu_time() - event['cpu_time']
+    peak = max_rss()
+    if peak is not None and event.get('max_rss') is not None:
+        event['max_rss_growth'] = peak - event['max_rss']
+    event['max_rss'] = peak
+    return event
+
+
+class JSONLinesSink(object):
+    """Hook appending the invocations events to a JSON-lines file.
+
+    manager.after_command(JSONLinesSink('metrics.jsonl'))
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, event):
+        line = json.dumps(event, default=repr, sort_keys=True)
+        with open(self.path, 'a') as f:
+            f.write(line + '\n')
+
+
+class StatsdSink(object):
+    """Hook sending the invocations metrics to a StatsD server over UDP.
+
+    Sends ``<prefix>.<path>.duration`` and ``.cpu_time`` timings,
+    ``.max_rss`` and ``.max_rss_growth`` gauges and ``.ok`` or ``.failed``
+    counters. The socket is closed at exit, or by ``close``.
+
+    manager.after_command(StatsdSink('127.0.0.1', 8125))
+    """
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='manage'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        atexit.register(self.close)
+
+    def close(self):
+        self.socket.close()
+
+    def metrics(self, event):
+        name = '%s.%s' % (self.prefix, event['path'])
+        metrics = [
+            '%s.duration:%d|ms' % (name, event['duration'] * 1000),
+            '%s.cpu_time:%d|ms' % (name, event['cpu_time'] * 1000),
+            '%s.%s:1|c' % (name, 'failed' if event['status'] else 'ok'),
+        ]
+        for key in ('max_rss', 'max_rss_growth'):
+            if event.get(key) is not None:
+                metrics.append('%s.%s:%d|g' % (name, key, event[key]))
+        return metrics
+
+    def __call__(self, event):
+        try:
+            self.socket.sendto('\n'.join(self.metrics(event)).encode('utf-8'),
+                self.address)
+        except (IOError, OSError):
+            pass
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+import bz2
+import os
+import tempfile
+import threading
+import types
+import zlib
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # NOQA
+
+try:
+    import lzma
+except ImportError:
+    lzma = None  # NOQA
+
+from manager import cli
+from manager.incremental import default_permissions
+
+COMPRESSIONS = ('gzip', 'bz2', 'xz')
+CHUNK_SIZE = 1 << 16
+# Chunks waiting for the writer thread, bounds the memory in use when the
+# command produces faster than the data is compressed.
+MAX_PENDING = 16
+
+
+def compressor(compression):
+    """Returns an incremental compressor with ``compress`` and ``flush``
+    methods, or ``None`` without compression."""
+    from manager import Error
+
+    if compression is None:
+        return None
+    elif compression == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif compression == 'bz2':
+        return bz2.BZ2Compressor()
+    elif compression == 'xz':
+        if lzma is None:
+            raise Error('xz compression requires the lzma module')
+        return lzma.LZMACompressor()
+    raise Error('Invalid compression `%s`, expected one of %s' % (
+        compression, ', '.join(COMPRESSIONS)))
+
+
+class OutputFile(object):
+    """File written to by a background thread, compressing the data on the
+    way, and renamed over ``path`` once closed.
+
+    >>> with OutputFile('dump.gz', 'gzip') as f:
+    ...     f.write(b'data')
+    """
+
+    def __init__(self, path, compression=None):
+        self.path = path
+        self.compressor = compressor(compression)
+        fd, self.tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+            prefix='.%s.' % os.path.basename(path))
+        self.file = os.fdopen(fd, 'wb')
+        self.chunks = queue.Queue(MAX_PENDING)
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        chunk = b''
+        try:
+            while True:
+                chunk = self.chunks.get()
+                if chunk is None:
+                    break
+                if self.compressor is not None:
+                    chunk = self.compressor.compress(chunk)
+                self.file.write(chunk)
+            if self.compressor is not None:
+                self.file.write(self.compressor.flush())
+        except BaseException as e:
+            self.error = e
+            # Unblocks the producer waiting on a full queue, until the end
+            # marker unless it was already read.
+            while chunk is not None:
+                chunk = self.chunks.get()
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        self.chunks.put(data)
+
+    def close(self):
+        """Waits for the pending data to be written and renames the file
+        over ``path``."""
+        self.chunks.put(None)
+        self.thread.join()
+        try:
+            self.file.close()
+            if self.error is not None:
+                raise self.error
+            default_permissions(self.tmp)
+            os.rename(self.tmp, self.path)
+        except BaseException:
+            self.remove()
+            raise
+
+    def abort(self):
+        """Discards the file, leaving ``path`` untouched."""
+        if self.thread.is_alive():
+            self.chunks.put(None)
+            self.thread.join()
+        self.file.close()
+        self.remove()
+
+    def remove(self):
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def lines(r):
+    """Yields the lines of a command's return value as ``puts`` would print
+    them, without indentation nor colors."""
+    type_ = type(r)
+    if type_ in (list, types.GeneratorType):
+        for i in r:
+            for line in lines(i):
+                yield line
+    elif type_ == dict:
+        for key in r:
+            yield cli.min_width(key, 25) + str(r[key])
+    elif type_ == bool:
+        yield 'OK' if r else 'FAILED'
+    elif r is not None:
+        yield str(r).rstrip('\n')
+
+
+def encode(line):
+    return line if isinstance(line, bytes) else line.encode('utf-8')
+
+
+def write(r, path, compression=None):
+    """Writes the return value of a command to ``path``, by chunks of
+    ``CHUNK_SIZE`` bytes compressed in a background thread."""
+    with OutputFile(path, compression) as f:
+        chunk, size = [], 0
+        for line in lines(r):
+            line = encode(line) + b'\n'
+            chunk.append(line)
+            size += len(line)
+            if size >= CHUNK_SIZE:
+                f.write(b''.join(chunk))
+                chunk, size = [], 0
+        if chunk:
+            f.write(b''.join(chunk))
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+import itertools
+import os
+import time
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+try:
+    from multiprocessing import SimpleQueue
+except ImportError:
+    from multiprocessing.queues import SimpleQueue  # NOQA
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # NOQA
+
+EXECUTORS = ('thread', 'process')
+# Seconds between the checks for lost tasks while waiting for a result.
+POLL_INTERVAL = 0.1
+
+_target = None
+
+
+def _initialize(target):
+    global _target
+    _target = target
+
+
+def _dispatch(args):
+    return _target(*args)
+
+
+def pool(target, executor='thread', workers=None):
+    """Returns a ``(pool, func)`` pair where ``func(args)`` calls
+    ``target(*args)`` inside a worker.
+
+    Process workers are forked with ``target`` already in place, so it does
+    not need to be picklable (only its arguments and return values do).
+
+    :param callable target: The callable to run in the workers.
+    :param str executor: Either ``'thread'`` or ``'process'``.
+    :param int workers: The pool size, defaults to the number of CPUs.
+    """
+    if executor == 'thread':
+        return ThreadPool(workers), lambda args: target(*args)
+    elif executor == 'process':
+        return Pool(workers, _initialize, (target, )), _dispatch
+    raise ValueError('Invalid executor `%s`, expected one of %s' % (
+        executor, ', '.join(EXECUTORS)))
+
+
+def imap(target, iterable, executor='thread', workers=None, ordered=True,
+        chunksize=1):
+    """Maps ``target`` over ``iterable`` (of argument tuples) in a pool.
+
+    Results are yielded in input order when ``ordered`` is set, else as soon
+    as they complete.
+    """
+    pool_, func = pool(target, executor=executor, workers=workers)
+    map_ = pool_.imap if ordered else pool_.imap_unordered
+    try:
+        for result in map_(func, iterable, chunksize):
+            yield result
+        pool_.close()
+    finally:
+        pool_.terminate()
+        pool_.join()
+
+
+class Tasks(object):
+    """Runs ``target`` calls in a pool, like ``pool``, keeping track of the
+    running tasks by key.
+
+    A task whose worker process died (killed, crashed or exited) is reported
+    as failed instead of never completing.
+
+    >>> tasks = Tasks(target, executor='process')
+    >>> tasks.submit('a', (1, ))
+    >>> key, result, error = tasks.get()
+    """
+
+    def __init__(self, target, executor='thread', workers=None):
+        # Written synchronously, so a message put right before the worker
+        # exits is never lost.
+        started = SimpleQueue() if executor == 'process' else None
+
+        def run(seq, args):
+            if started is None:
+                return target(*args)
+            started.put((seq, os.getpid()))
+            try:
+                return target(*args)
+            finally:
+                started.put((seq, None))
+
+        self.started = started
+        self.pool, self.func = pool(run, executor=executor, workers=workers)
+        self.results = queue.Queue()
+        self.counter = itertools.count()
+        self.running = {}
+        self.pids = {}
+
+    def __len__(self):
+        return len(self.running)
+
+    def submit(self, key, args):
+        seq = next(self.counter)
+        self.running[seq] = (key, self.pool.apply_async(self.func,
+            ((seq, args), ), callback=lambda r: self.results.put((seq, r))))
+
+    def discard(self, key):
+        """Stops tracking the task of ``key``, its result being ignored."""
+        for seq in [seq for seq in self.running
+                if self.running[seq][0] == key]:
+            del self.running[seq]
+            self.pids.pop(seq, None)
+
+    def get(self, timeout=None):
+        """Returns the ``(key, result, error)`` of the next finished task,
+        ``error`` being a message when the task failed, or raises
+        ``queue.Empty`` after ``timeout`` seconds."""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            wait = POLL_INTERVAL
+            if deadline is not None:
+                wait = max(min(wait, deadline - time.time()), 0)
+            try:
+                seq, result = self.results.get(timeout=wait)
+            except queue.Empty:
+                failed = self.failed()
+                if failed is not None:
+                    return failed
+                if deadline is not None and time.time() >= deadline:
+                    raise
+                continue
+            if seq in self.running:
+                key, _ = self.running.pop(seq)
+                self.pids.pop(seq, None)
+                return key, result, None
+
+    def receive(self):
+        """Reads which worker pid runs which task."""
+        while self.started is not None and not self.started.empty():
+            seq, pid = self.started.get()
+            if pid is None:
+                self.pids.pop(seq, None)
+            elif seq in self.running:
+                self.pids[seq] = pid
+
+    def failed(self):
+        """Returns the ``(key, None, error)`` of a task which raised or lost
+        its worker, if any."""
+        self.receive()
+        recorded, alive = dict(self.pids), None
+        if self.started is not None:
+            # The pool replaces its dead workers, removing them from _pool.
+            alive = set(process.pid for process in self.pool._pool
+                if process.exitcode is None)
+            # A worker dead by now wrote all its messages, so a task it
+            # completed is not mistaken for lost.
+            self.receive()
+        for seq in sorted(self.running):
+            key, result = self.running[seq]
+            if result.ready():
+                if result.successful():
+                    continue
+                del self.running[seq]
+                self.pids.pop(seq, None)
+                try:
+                    result.get()
+                except Exception as e:
+                    return key, None, '%s: %s' % (type(e).__name__, e)
+            elif (seq in recorded and seq in self.pids and
+                    recorded[seq] not in alive):
+                del self.running[seq]
+                return key, None, 'Worker process %s died' % (
+                    self.pids.pop(seq), )
+        return None
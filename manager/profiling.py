@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import collections
+import cProfile
+import os
+import sys
+import threading
+import types
+
+from manager import cli
+
+SAMPLE_INTERVAL = 0.005
+
+
+class Sampler(threading.Thread):
+    """Samples the stack of a thread at regular intervals, counting the
+    collapsed stacks for flamegraphs."""
+
+    def __init__(self, ident, interval=SAMPLE_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.ident_ = ident
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.ident_)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%s)' % (code.co_name,
+                    os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('%s %s\n' % (stack, count))
+
+
+def profile(fn, args=(), kwargs=None, name='manage', profile=None,
+        trace_malloc=None, sample=None, stream=None):
+    """Calls ``fn`` under the requested profilers, consuming the result if it
+    is a generator, and reports to stderr.
+
+    :param str profile: The cProfile stats file, ``name.prof`` if empty.
+    :param int trace_malloc: How many top allocation sites to report.
+    :param str sample: The collapsed stacks file, ``name.folded`` if empty.
+    """
+    from manager import Error
+
+    stream = stream or sys.stderr.write
+    kwargs = kwargs or {}
+    if trace_malloc is not None:
+        try:
+            import tracemalloc
+        except ImportError:
+            raise Error('--trace-malloc requires Python 3.4+')
+        tracemalloc.start()
+    sampler = profiler = None
+    if sample is not None:
+        sampler = Sampler(threading.current_thread().ident)
+        sampler.start()
+    if profile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        r = fn(*args, **kwargs)
+        if isinstance(r, types.GeneratorType):
+            r = list(r)
+        return r
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            path = profile or '%s.prof' % name
+            profiler.dump_stats(path)
+            cli.puts('profile written to %s' % path, stream=stream)
+        if sampler is not None:
+            sampler.stop()
+            path = sample or '%s.folded' % name
+            sampler.write(path)
+            cli.puts('%s stack samples written to %s' % (
+                sum(sampler.stacks.values()), path), stream=stream)
+        if trace_malloc is not None:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            cli.puts('peak memory: %.1f KiB, top %s allocation sites:' % (
+                peak / 1024.0, trace_malloc), stream=stream)
+            with cli.indent(2):
+                for stat in snapshot.statistics('lineno')[:trace_malloc]:
+                    cli.puts(str(stat), stream=stream)
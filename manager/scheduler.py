@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+import datetime
+import heapq
+import itertools
+import json
+import random
+import shlex
+import threading
+import time
+
+from manager import parallel
+from manager.incremental import write_atomic
+
+CATCH_UP = ('none', 'once')
+
+# Cron fields with their bounds, Sunday being either 0 or 7.
+FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+# Longest month lengths, February counting leap years.
+MONTH_DAYS = (31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+ALIASES = {
+    '@hourly': '0 * * * *',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@weekly': '0 0 * * 0',
+    '@monthly': '0 0 1 * *',
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+}
+
+
+def parse_field(field, low, high):
+    """Returns the values matched by a cron field, e.g. ``1-10/2,30``."""
+    values = set()
+    for part in field.split(','):
+        range_, _, step = part.partition('/')
+        if range_ == '*':
+            start, end = low, high
+        elif '-' in range_:
+            start, end = [int(v) for v in range_.split('-', 1)]
+        else:
+            start = int(range_)
+            end = high if step else start
+        step = int(step) if step else 1
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError('Invalid cron field `%s`' % field)
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+class Cron(object):
+    """A 5-field cron expression (minute, hour, day of month, month, day of
+    week) or one of the ``@daily`` like aliases, in local time."""
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != 5:
+            raise ValueError('Invalid cron expression `%s`, expected 5 '
+                'fields' % expression)
+        try:
+            (self.minutes, self.hours, self.days, self.months,
+                weekdays) = [parse_field(field, low, high)
+                    for field, (low, high) in zip(fields, FIELDS)]
+        except ValueError:
+            raise ValueError('Invalid cron expression `%s`' % expression)
+        self.weekdays = frozenset(day % 7 for day in weekdays)
+        # As in cron, when both days are restricted either one matches.
+        self.any_day = fields[2].startswith('*') or fields[4].startswith('*')
+        if self.any_day and not any(day <= MONTH_DAYS[month - 1]
+                for month in self.months for day in self.days):
+            raise ValueError('Cron expression `%s` never matches' %
+                expression)
+
+    def match_day(self, dt):
+        weekday = (dt.weekday() + 1) % 7
+        if self.any_day:
+            return dt.day in self.days and weekday in self.weekdays
+        return dt.day in self.days or weekday in self.weekdays
+
+    def next(self, after):
+        """Returns the timestamp of the first match after ``after``."""
+        dt = datetime.datetime.fromtimestamp(after).replace(second=0,
+            microsecond=0) + datetime.timedelta(minutes=1)
+        limit = dt.year + 8
+        while dt.year <= limit:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) +
+                    datetime.timedelta(days=32)).replace(day=1)
+            elif not self.match_day(dt):
+                dt = dt.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + datetime.timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += datetime.timedelta(minutes=1)
+            else:
+                return time.mktime(dt.timetuple())
+        raise ValueError('Cron expression `%s` never matches' %
+            self.expression)
+
+
+class Interval(object):
+    """Runs every ``<number>[smhdw]``."""
+
+    def __init__(self, every):
+        from manager.journal import parse_window
+
+        self.seconds = parse_window(every)
+        if self.seconds <= 0:
+            raise ValueError('Invalid interval `%s`' % every)
+
+    def next(self, after):
+        return after + self.seconds
+
+
+class Job(object):
+    def __init__(self, name, argv, trigger, jitter=0, catch_up='once'):
+        self.name = name
+        self.argv = argv
+        self.trigger = trigger
+        self.jitter = jitter
+        self.catch_up = catch_up
+        self.running = False
+
+
+def load(path):
+    """Loads a schedule from a TOML (Python 3.11+, or with the toml or tomli
+    packages) or JSON file."""
+    from manager import Error
+
+    try:
+        with open(path, 'rb') as f:
+            content = f.read().decode('utf-8')
+    except (IOError, OSError) as e:
+        raise Error('Cannot read schedule %s: %s' % (path, e))
+    if path.endswith('.json'):
+        loads = json.loads
+    else:
+        try:
+            from tomllib import loads
+        except ImportError:
+            try:
+                from toml import loads
+            except ImportError:
+                try:
+                    from tomli import loads
+                except ImportError:
+                    raise Error('Reading %s requires Python 3.11+ or the '
+                        'toml package, or use a .json schedule' % path)
+    try:
+        return loads(content)
+    except Exception as e:
+        raise Error('Invalid schedule %s: %s' % (path, e))
+
+
+def jobs(manager, config):
+    """Returns the jobs of a schedule.
+
+    ``config`` holds a ``jobs`` list of ``{command, args, cron | every,
+    jitter, catch_up, name}`` tables, ``jitter`` and ``catch_up`` defaulting
+    to the top level values.
+    """
+    from manager import Error
+
+    jobs_ = []
+    for entry in config.get('jobs', []):
+        path = entry.get('command')
+        if path not in manager.commands:
+            raise Error('Invalid command `%s` in schedule' % path)
+        name = entry.get('name', path)
+        if name in [job.name for job in jobs_]:
+            raise Error('Duplicate job `%s`, set distinct names' % name)
+        if ('cron' in entry) == ('every' in entry):
+            raise Error('Job `%s` needs either `cron` or `every`' % name)
+        catch_up = entry.get('catch_up', config.get('catch_up', 'once'))
+        if catch_up not in CATCH_UP:
+            raise Error('Invalid catch_up `%s`, expected one of %s' % (
+                catch_up, ', '.join(CATCH_UP)))
+        args = entry.get('args', [])
+        if not isinstance(args, list):
+            args = shlex.split(args)
+        try:
+            if 'cron' in entry:
+                trigger = Cron(entry['cron'])
+            else:
+                trigger = Interval(entry['every'])
+        except ValueError as e:
+            raise Error('Job `%s`: %s' % (name, e))
+        jobs_.append(Job(name, [path] + [str(arg) for arg in args], trigger,
+            jitter=float(entry.get('jitter', config.get('jitter', 0))),
+            catch_up=catch_up))
+    return jobs_
+
+
+class Scheduler(object):
+    """Runs jobs from a timer heap in a bounded pool of forked workers.
+
+    A job still running when it is due again is skipped. The last run of
+    each job is persisted, so on restart a job which missed runs is run once
+    right away when its ``catch_up`` policy is ``once``. Runs are logged as
+    JSON lines in the manager's state directory.
+    """
+
+    def __init__(self, manager, jobs, workers=None):
+        self.manager = manager
+        self.jobs = jobs
+        self.workers = workers
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.log_path = manager.state_path('scheduler.jsonl')
+        self.state_path = manager.state_path('scheduler.json')
+        try:
+            with open(self.state_path) as f:
+                self.last_runs = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.last_runs = {}
+
+    def first_due(self, job, now):
+        last = self.last_runs.get(job.name)
+        if (last is not None and job.catch_up == 'once' and
+                job.trigger.next(last) <= now):
+            return now
+        return job.trigger.next(now)
+
+    def push(self, heap, counter, job, scheduled):
+        heapq.heappush(heap, (scheduled + random.uniform(0, job.jitter),
+            next(counter), scheduled, job))
+
+    def log(self, record):
+        line = json.dumps(record, sort_keys=True)
+        with self.lock:
+            with open(self.log_path, 'a') as f:
+                f.write(line + '\n')
+
+    def launch(self, pool, func, job, scheduled):
+        with self.lock:
+            running, job.running = job.running, True
+        if running:
+            self.log({'job': job.name, 'scheduled': scheduled,
+                'event': 'skipped'})
+            return
+        self.last_runs[job.name] = scheduled
+        write_atomic(self.state_path, json.dumps(self.last_runs,
+            sort_keys=True))
+        start = time.time()
+        pool.apply_async(func, ((job.argv, ), ),
+            callback=lambda result: self.finished(job, scheduled, start,
+                result))
+
+    def finished(self, job, scheduled, start, result):
+        status, output = result
+        with self.lock:
+            job.running = False
+        self.log({'job': job.name, 'scheduled': scheduled, 'event': 'run',
+            'start': start, 'duration': time.time() - start,
+            'status': status})
+        if output:
+            self.manager.puts_captured(job.name, output)
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self, until=None):
+        """Runs the jobs until ``stop`` is called or, when given, until the
+        ``until`` timestamp, then waits for the running ones."""
+        heap, counter = [], itertools.count()
+        now = time.time()
+        for job in self.jobs:
+            self.push(heap, counter, job, self.first_due(job, now))
+
+        pool, func = parallel.pool(self.manager.capture, executor='process',
+            workers=self.workers)
+        completed = False
+        try:
+            while heap and not self.stopped.is_set():
+                due, _, scheduled, job = heap[0]
+                if until is not None and due > until:
+                    break
+                delay = due - time.time()
+                if delay > 0:
+                    # Short waits keep the loop interruptible on Python 2.
+                    self.stopped.wait(min(delay, 1.0))
+                    continue
+                heapq.heappop(heap)
+                self.launch(pool, func, job, scheduled)
+                now = time.time()
+                scheduled = job.trigger.next(scheduled)
+                if scheduled <= now:
+                    scheduled = job.trigger.next(now)
+                self.push(heap, counter, job, scheduled)
+            completed = True
+        finally:
+            if completed:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+
+
+def main(manager, path, workers=None):
+    """Runs the schedule in ``path`` until interrupted, returning the exit
+    status."""
+    from manager import Error, puts
+
+    try:
+        config = load(path)
+        scheduler = Scheduler(manager, jobs(manager, config),
+            workers=workers or config.get('workers'))
+    except Error as e:
+        puts(e)
+        return 1
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        pass
+    return 0
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+import json
+import sys
+import threading
+import traceback
+import types
+from multiprocessing.pool import ThreadPool
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer  # NOQA
+
+DEFAULT_WORKERS = 16
+
+
+def parse_address(bind):
+    """Returns the ``(host, port)`` of a ``host:port`` address."""
+    from manager import Error
+
+    host, _, port = bind.rpartition(':')
+    try:
+        return host or '127.0.0.1', int(port)
+    except ValueError:
+        raise Error('Invalid address `%s`, expected host:port' % bind)
+
+
+def missing(command, values):
+    """Returns the names of the required or prompted arguments missing from
+    ``values``, as the server cannot prompt for them."""
+    from manager import PromptedArg
+
+    if command.capture_all:
+        return []
+    return [name for name, arg in zip(command.arg_names, command.args)
+        if name not in values and (isinstance(arg, PromptedArg) or
+            arg.required)]
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Runs ``POST /<command path>`` requests with the JSON object body as
+    the argument values, see ``Manager.call``.
+
+    Results are sent as ``{"result": value}``, generators as chunked JSON
+    lines, and failures as ``{"error": message}``.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # Closes idle keep-alive connections, which hold a pool thread.
+    timeout = 60
+
+    def send_json(self, code, data):
+        body = (json.dumps(data, default=str) + '\n').encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def write_chunk(self, data):
+        data = (json.dumps(data, default=str) + '\n').encode('utf-8')
+        self.wfile.write(('%x\r\n' % len(data)).encode('ascii') + data +
+            b'\r\n')
+
+    def send_stream(self, items):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for item in items:
+                self.write_chunk(item)
+        except Exception as e:
+            traceback.print_exc()
+            self.write_chunk({'error': str(e)})
+        finally:
+            items.close()
+        self.wfile.write(b'0\r\n\r\n')
+
+    def do_POST(self):
+        from manager import Error
+
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        path = self.path.split('?', 1)[0].strip('/')
+        manager = self.server.manager
+        if path not in manager.commands:
+            return self.send_json(404, {'error': 'Invalid command `%s`' %
+                path})
+        try:
+            values = json.loads(body.decode('utf-8')) if body.strip() else {}
+        except ValueError as e:
+            return self.send_json(400, {'error': 'Invalid JSON: %s' % e})
+        if not isinstance(values, dict):
+            return self.send_json(400, {'error': 'Expected a JSON object'})
+        names = missing(manager.commands[path], values)
+        if names:
+            return self.send_json(400, {'error': 'Missing argument%s %s' % (
+                's' if len(names) > 1 else '',
+                ', '.join('`%s`' % name for name in names))})
+
+        try:
+            manager.commands[path].bind(values)
+        except Error as e:
+            return self.send_json(400, {'error': str(e)})
+
+        semaphore = self.server.semaphore(manager.commands[path])
+        if semaphore is not None and not semaphore.acquire(False):
+            return self.send_json(429, {'error': 'Too many concurrent runs '
+                'of `%s`' % path})
+        try:
+            try:
+                result = manager.call(path, values, stream=True)
+            except Exception as e:
+                traceback.print_exc()
+                return self.send_json(500, {'error': '%s: %s' % (
+                    type(e).__name__, e)})
+            if result.status:
+                error = result.value if isinstance(result.value, Error) \
+                    else 'Exit status %s' % result.status
+                self.send_json(500, {'error': str(error),
+                    'status': result.status})
+            elif isinstance(result.value, types.GeneratorType):
+                self.send_stream(result.value)
+            else:
+                self.send_json(200, {'result': result.value})
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
+
+class Server(HTTPServer):
+    """HTTP server handling the connections in a bounded thread pool.
+
+    Commands registered with ``max_concurrency`` get 429 responses once
+    that many runs are in progress.
+    """
+
+    def __init__(self, manager, address, workers=None):
+        HTTPServer.__init__(self, address, Handler)
+        self.manager = manager
+        self.pool = ThreadPool(workers or DEFAULT_WORKERS)
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def semaphore(self, command):
+        if command.max_concurrency is None:
+            return None
+        with self.lock:
+            if command.path not in self.semaphores:
+                self.semaphores[command.path] = threading.BoundedSemaphore(
+                    command.max_concurrency)
+            return self.semaphores[command.path]
+
+    def process_request(self, request, client_address):
+        self.pool.apply_async(self.process_request_thread,
+            (request, client_address))
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.pool.terminate()
+        self.pool.join()
+
+
+def serve(manager, bind=None, workers=None):
+    """Serves the manager's commands over HTTP until interrupted, on
+    ``bind`` defaulting to ``DEFAULT_BIND``."""
+    from manager import DEFAULT_BIND, Error, puts
+
+    try:
+        server = Server(manager, parse_address(bind or DEFAULT_BIND),
+            workers)
+    except Error as e:
+        puts(e)
+        return 1
+    host, port = server.server_address[:2]
+    sys.stderr.write('Serving on http://%s:%s\n' % (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import sys
+import threading
+import traceback
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO  # NOQA
+
+from manager import Result, cli
+
+NOT_SET = object()
+
+
+class RunResult(Result):
+    """The result of a command line run through ``CommandRunner.invoke``."""
+
+    def __init__(self, status, output, errors, exception=None,
+            exc_info=None):
+        Result.__init__(self, None, status, output)
+        self.errors = errors
+        self.exception = exception
+        self.exc_info = exc_info
+
+    @property
+    def exit_code(self):
+        return self.status
+
+    def __repr__(self):
+        return '<RunResult exit_code=%s>' % self.status
+
+
+class Prompter(object):
+    """Answers ``cli.prompt`` from a mapping of message patterns to answers,
+    then from a list of answers in order."""
+
+    def __init__(self, prompts=None, answers=None):
+        self.prompts = [(re.compile(key), value)
+            for key, value in (prompts or {}).items()]
+        self.answers = list(answers or [])
+
+    def __call__(self, message=''):
+        sys.stdout.write(message + '\n')
+        for pattern, value in self.prompts:
+            if pattern.search(message):
+                return value
+        if self.answers:
+            return self.answers.pop(0)
+        raise EOFError('No answer scripted for prompt `%s`' % message)
+
+
+class HiddenPrompter(object):
+    def __init__(self, prompter):
+        self.getpass = prompter
+
+
+class CommandRunner(object):
+    """Runs the commands of a manager in-process, as ``manage`` would.
+
+    Standard output and error are captured, ``sys.exit`` calls become the
+    result's exit code, ``cli.prompt`` is answered from scripted values and
+    changes to ``os.environ`` are reverted.
+
+    Invocations are serialized within a process since they swap process
+    wide state, so test suites should be parallelized across processes.
+
+    runner = CommandRunner(manager)
+    result = runner.invoke(['config.set', 'key', 'value'])
+    assert result.exit_code == 0
+    assert result.output == 'OK\\n'
+    """
+
+    lock = threading.RLock()
+
+    def __init__(self, manager, env=None):
+        self.manager = manager
+        self.env = env or {}
+
+    def invoke(self, args, answers=None, prompts=None, env=None,
+            catch_exceptions=True):
+        """Runs the given command line.
+
+        :param list args: The command line, without the program name.
+        :param list answers: Values answering prompts in order.
+        :param dict prompts: Values answering prompts whose message matches
+            the key regexp.
+        :param dict env: Environment variables set during the run.
+        :param bool catch_exceptions: Return unexpected exceptions in the
+            result instead of raising them.
+        """
+        prompter = Prompter(prompts, answers)
+        with self.lock:
+            environ = os.environ.copy()
+            stdout, stderr = sys.stdout, sys.stderr
+            raw_input = cli.__dict__.get('raw_input', NOT_SET)
+            getpass = cli.getpass
+            sys.stdout, sys.stderr = StringIO(), StringIO()
+            cli.raw_input, cli.getpass = prompter, HiddenPrompter(prompter)
+            exception = exc_info = None
+            try:
+                os.environ.update(self.env)
+                os.environ.update(env or {})
+                self.manager.main(list(args))
+                status = 0
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    status = e.code or 0
+                else:
+                    sys.stderr.write('%s\n' % e.code)
+                    status = 1
+            except Exception as e:
+                if not catch_exceptions:
+                    raise
+                exception, exc_info = e, sys.exc_info()
+                sys.stderr.write(traceback.format_exc())
+                status = 1
+            finally:
+                output, errors = sys.stdout.getvalue(), sys.stderr.getvalue()
+                sys.stdout, sys.stderr = stdout, stderr
+                cli.getpass = getpass
+                if raw_input is NOT_SET:  # Python 2 builtin
+                    del cli.raw_input
+                else:
+                    cli.raw_input = raw_input
+                os.environ.clear()
+                os.environ.update(environ)
+        return RunResult(status, output, errors, exception, exc_info)
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""Entry point of the ``manage`` script.
+
+Only the standard library is imported here, so ``--profile-startup``
+starts tracing before the ``manager`` package and its modules are
+imported.
+"""
+import json
+import os
+import sys
+import time
+
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins  # NOQA
+
+PROFILE_STARTUP = '--profile-startup'
+
+clock = getattr(time, 'perf_counter', time.time)
+
+tracer = None
+
+
+class NoPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+
+NO_PHASE = NoPhase()
+
+
+class Phase(object):
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.entry = [len(self.tracer.open), self.name, None]
+        self.tracer.phases.append(self.entry)
+        self.tracer.open.append(self)
+        self.start = clock()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.entry[2] = clock() - self.start
+        self.tracer.open.pop()
+
+
+class StartupTracer(object):
+    """Collects the startup phases durations, the modules import times and
+    the commands registration times."""
+
+    def __init__(self):
+        self.phases = []
+        self.open = []
+        self.imports = {}
+        self.commands = []
+        self.stack = []
+        self.original_import = None
+        self.start = clock()
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def install(self):
+        self.original_import = builtins.__import__
+        builtins.__import__ = self.trace_import
+
+    def uninstall(self):
+        if self.original_import is not None:
+            builtins.__import__ = self.original_import
+            self.original_import = None
+
+    def trace_import(self, name, globals=None, locals=None, fromlist=(),
+            level=0):
+        if level in (0, -1) and name in sys.modules:
+            return self.original_import(name, globals, locals, fromlist,
+                level)
+        key = '.' * max(level, 0) + name
+        self.stack.append(0.0)
+        start = clock()
+        try:
+            return self.original_import(name, globals, locals, fromlist,
+                level)
+        finally:
+            elapsed = clock() - start
+            children = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += elapsed
+            cumulative, own = self.imports.get(key, (0.0, 0.0))
+            self.imports[key] = (cumulative + elapsed,
+                own + elapsed - children)
+
+    def command(self, path, duration):
+        self.commands.append((path, duration))
+
+    def report(self):
+        return {
+            'total': clock() - self.start,
+            'phases': [
+                {'name': name, 'depth': depth, 'duration': duration}
+                for depth, name, duration in self.phases
+            ],
+            'imports': [
+                {'module': module, 'cumulative': cumulative, 'self': own}
+                for module, (cumulative, own) in sorted(
+                    self.imports.items(), key=lambda i: -i[1][1])
+            ],
+            'commands': [
+                {'path': path, 'duration': duration}
+                for path, duration in sorted(
+                    self.commands, key=lambda c: -c[1])
+            ],
+        }
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def puts(self, limit=20, stream=None):
+        from manager import cli
+
+        stream = stream or sys.stderr.write
+        report = self.report()
+
+        def line(name, *durations):
+            cli.puts((cli.min_width(name, 50) + ''.join(
+                cli.min_width('%.2f ms' % (d * 1000), 14) for d in durations
+            )).rstrip(), stream=stream)
+
+        line('total (traced)', report['total'])
+        cli.puts('\nphases:', stream=stream)
+        with cli.indent(2):
+            for phase in report['phases']:
+                line('  ' * phase['depth'] + phase['name'],
+                    phase['duration'] or 0)
+        cli.puts('\nimports (self, cumulative):', stream=stream)
+        with cli.indent(2):
+            for module in report['imports'][:limit]:
+                line(module['module'], module['self'], module['cumulative'])
+        cli.puts('\ncommands (%s registered):' % len(report['commands']),
+            stream=stream)
+        with cli.indent(2):
+            for command in report['commands'][:limit]:
+                line(command['path'], command['duration'])
+
+
+def process_age():
+    """Returns the seconds elapsed since the process started, if known."""
+    try:
+        with open('/proc/self/stat') as f:
+            stat = f.read()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (IOError, OSError):
+        return None
+    started = float(stat.rsplit(')', 1)[1].split()[19])
+    return max(uptime - started / os.sysconf('SC_CLK_TCK'), 0.0)
+
+
+def start():
+    """Starts tracing the startup and returns the tracer."""
+    global tracer
+    tracer = StartupTracer()
+    age = process_age()
+    if age is not None:
+        tracer.phases.append([0, 'interpreter', age])
+    tracer.install()
+    return tracer
+
+
+def stop():
+    global tracer
+    tracer_, tracer = tracer, None
+    if tracer_ is not None:
+        tracer_.uninstall()
+    return tracer_
+
+
+def phase(name):
+    """Returns a context manager timing the ``name`` phase of the startup
+    when it is being traced."""
+    if tracer is None:
+        return NO_PHASE
+    return tracer.phase(name)
+
+
+def main():
+    argv = sys.argv[1:]
+    report = None
+    for i, arg in enumerate(argv):
+        if not arg.startswith('-'):
+            break
+        if arg.split('=', 1)[0] == PROFILE_STARTUP:
+            report = arg.partition('=')[2] or '-'
+            del argv[i]
+            break
+
+    if report is not None:
+        tracer_ = start()
+    try:
+        with phase('import manager'):
+            from manager.main import run
+        return run(argv)
+    finally:
+        if report is not None:
+            stop()
+            if report == '-':
+                tracer_.puts()
+            else:
+                tracer_.write(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,10 +11,11 @@ setup(
     author_email='jps@birdback.com',
     url='https://github.com/Birdback/manage.py',
     packages=find_packages(),
+    py_modules=['manager_startup'],
     install_requires=[],
     entry_points={
         'console_scripts': [
-            'manage = manager.main:main',
+            'manage = manager_startup:main',
         ]
     },
     classifiers=[
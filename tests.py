@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import os
+import shutil
 import sys
+import tempfile
 import unittest
 import re
 
@@ -9,7 +11,7 @@ try:
 except ImportError:
     from io import StringIO  # NOQA
 
-from manager import Arg, Command, Error, Manager, PromptedArg, puts
+from manager import Arg, Command, Error, Manager, PromptedArg, Result, puts
 from manager.cli import process_value, prompt, TRUE_CHOICES, FALSE_CHOICES
 
 
@@ -107,10 +109,24 @@ class CommandTest(unittest.TestCase):
 usage: manage.py [<namespace>.]<command> [<args>]
 
 positional arguments:
-  command     the command to run
+  command               the command to run
 
 optional arguments:
-  -h, --help  show this help message and exit
+  -h, --help            show this help message and exit
+  --parallel            run several commands, separated by `--`, in parallel
+  -j JOBS, --jobs JOBS  number of commands to run at once
+  --dry-run             show the execution plan without running it
+  --profile [FILE]      write cProfile stats of the command
+  --profile-sample [FILE]
+                        write sampled collapsed stacks of the command
+  --trace-malloc [N]    report the top N allocation sites
+  --scheduler FILE      run the commands scheduled in FILE until interrupted
+  --serve-http          serve the commands over HTTP, see --bind
+  --bind ADDRESS        the address to serve on (default: 127.0.0.1:8000)
+  --inspect PID         dump the stacks and progress of a running command
+  --output-file PATH    write the result of the command to PATH
+  --compress {gzip,bz2,xz}
+                        compress the output file
 
 available commands:
   class_based              no description
@@ -328,6 +344,738 @@ class ManagerTest(unittest.TestCase):
                 manager.commands['new_command'].parse, list()
             )
 
+    def test_map_over(self):
+        new_manager = Manager()
+
+        @new_manager.command(map_over='items', workers=2)
+        def new_command(items, suffix='!'):
+            return items + suffix
+
+        with capture() as c:
+            new_command.parse(['a', 'b', 'c', '--suffix', '?'])
+
+        self.assertEqual(c.getvalue(), 'a?\nb?\nc?\n')
+
+    def test_map_over_process_unordered(self):
+        new_manager = Manager()
+
+        @new_manager.command(map_over='items', executor='process',
+            ordered=False)
+        def new_command(items=None):
+            return int(items) * 2
+
+        with capture() as c:
+            new_command.parse(['--items', '1', '2', '3'])
+
+        self.assertEqual(sorted(c.getvalue().split()), ['2', '4', '6'])
+
+    def test_map_over_errors(self):
+        new_manager = Manager()
+
+        @new_manager.command(map_over='items')
+        def new_command(items):
+            if items == 'bad':
+                raise Error('bad item')
+            return items
+
+        with capture() as c:
+            self.assertRaises(SystemExit, new_command.parse,
+                ['good', 'bad'])
+
+        self.assertEqual(c.getvalue(),
+            'good\n1 of 2 items failed:\nbad: bad item\n')
+
+    def test_capture(self):
+        status, output = manager.capture(['raises'])
+        self.assertEqual(status, 1)
+        self.assertEqual(output, 'No way dude!')
+
+    def test_run_many(self):
+        with capture() as c:
+            status = manager.run_many([
+                ['simple_command', 'first'],
+                ['simple_command', 'second', '--capitalyze'],
+            ])
+
+        self.assertEqual(status, 0)
+        self.assertEqual(sorted(c.getvalue().splitlines()), [
+            '[simple_command] SECOND',
+            '[simple_command] first',
+        ])
+
+    def test_main_parallel(self):
+        with capture() as c:
+            try:
+                manager.main(['--parallel', 'raises', '--',
+                    'my_namespace.namespaced', 'value'])
+            except SystemExit as e:
+                self.assertEqual(e.code, 1)
+            else:
+                self.fail('SystemExit not raised')
+
+        self.assertEqual(sorted(c.getvalue().splitlines()), [
+            '[my_namespace.namespaced] value',
+            '[raises] No way dude!',
+        ])
+
+    def test_run_many_lost_worker(self):
+        new_manager = Manager()
+
+        @new_manager.command
+        def crash():
+            os._exit(3)
+
+        with capture() as c:
+            status = new_manager.run_many([['crash'], ['crash']])
+
+        self.assertEqual(status, 1)
+        self.assertEqual(c.getvalue().count(
+            '[crash] Cannot run `crash`: Worker process '), 2)
+
+    def test_main_command_options(self):
+        new_manager = Manager()
+
+        @new_manager.command
+        def pages(pages=1, force='n'):
+            return '%s %s' % (pages, force)
+
+        with capture() as c:
+            new_manager.main(['pages', '--p', '5'])
+            new_manager.main(['--jobs', '2', 'pages', '--f', 'y'])
+        self.assertEqual(c.getvalue().splitlines(), ['5 n', '1 y'])
+
+    def graph_manager(self):
+        new_manager = Manager()
+
+        @new_manager.command
+        def build():
+            return 'built'
+
+        @new_manager.command(depends=['build'])
+        def migrate():
+            return 'migrated'
+
+        @new_manager.command(depends=['build'])
+        def collectstatic():
+            return 'collected'
+
+        @new_manager.command(depends=['migrate', 'collectstatic'])
+        def deploy(target):
+            return 'deployed %s' % target
+
+        return new_manager
+
+    def test_run_graph(self):
+        with capture() as c:
+            status = self.graph_manager().run_graph([['deploy', 'prod']],
+                jobs=2)
+
+        self.assertEqual(status, 0)
+        lines = c.getvalue().splitlines()
+        self.assertEqual(lines[0], '[build] built')
+        self.assertEqual(sorted(lines[1:3]), [
+            '[collectstatic] collected',
+            '[migrate] migrated',
+        ])
+        self.assertEqual(lines[3], '[deploy] deployed prod')
+
+    def test_run_graph_repeated_commands(self):
+        with capture() as c:
+            status = self.graph_manager().run_graph([['deploy', 'prod'],
+                ['deploy', 'staging'], ['build']], jobs=2)
+
+        self.assertEqual(status, 0)
+        lines = c.getvalue().splitlines()
+        self.assertEqual(lines.count('[build] built'), 1)
+        self.assertEqual(lines.count('[migrate] migrated'), 1)
+        self.assertEqual(sorted(lines[-2:]), [
+            '[deploy] deployed prod',
+            '[deploy] deployed staging',
+        ])
+
+    def test_run_graph_worker_error(self):
+        new_manager = self.graph_manager()
+
+        def capture_(argv):
+            raise RuntimeError('boom')
+        new_manager.capture = capture_
+
+        with capture() as c:
+            status = new_manager.run_graph([['build']])
+
+        self.assertEqual(status, 1)
+        self.assertEqual(c.getvalue(),
+            '[build] Cannot run `build`: RuntimeError: boom\n')
+
+    def test_run_graph_lost_worker(self):
+        new_manager = Manager()
+
+        @new_manager.command
+        def crash():
+            os._exit(3)
+
+        @new_manager.command(depends=['crash'])
+        def after():
+            return 'after'
+
+        with capture() as c:
+            status = new_manager.run_graph([['after']])
+
+        self.assertEqual(status, 1)
+        self.assertIn('[crash] Cannot run `crash`: Worker process ',
+            c.getvalue())
+        self.assertNotIn('[after]', c.getvalue())
+
+    def test_run_graph_dry_run(self):
+        with capture() as c:
+            self.graph_manager().main(['--dry-run', 'deploy', 'prod'])
+
+        self.assertEqual(c.getvalue(),
+            '1. build\n2. collectstatic, migrate\n3. deploy\n')
+
+    def test_run_graph_cycle(self):
+        new_manager = self.graph_manager()
+        new_manager.commands['build'].depends = ['deploy']
+
+        with capture() as c:
+            status = new_manager.run_graph([['deploy', 'prod']])
+
+        self.assertEqual(status, 1)
+        self.assertIn('Dependency cycle: deploy -> ', c.getvalue())
+
+    def test_make(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        source = os.path.join(directory, 'source.txt')
+        target = os.path.join(directory, 'target.txt')
+        with open(source, 'w') as f:
+            f.write('content')
+
+        new_manager = Manager(state_dir=os.path.join(directory, 'state'))
+        calls = []
+
+        @new_manager.command(inputs=[source], outputs=[target])
+        def build(suffix=''):
+            calls.append(suffix)
+            with open(target, 'w') as f:
+                f.write('built')
+
+        with capture() as c:
+            build.parse([])
+            build.parse([])
+            build.parse(['--suffix', 'changed'])
+            build.parse(['--suffix', 'changed', '--force'])
+            with open(source, 'w') as f:
+                f.write('new content')
+            build.parse(['--suffix', 'changed'])
+            os.remove(target)
+            build.parse(['--suffix', 'changed'])
+
+        self.assertEqual(calls, ['', 'changed', 'changed', 'changed',
+            'changed'])
+        self.assertEqual(c.getvalue(), 'build is up to date\n')
+
+    def test_state_hash_files_parallel(self):
+        from manager.incremental import PARALLEL_THRESHOLD, State, digest
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        paths = []
+        for i in range(PARALLEL_THRESHOLD + 1):
+            paths.append(os.path.join(directory, '%s.txt' % i))
+            with open(paths[-1], 'w') as f:
+                f.write(str(i))
+
+        state = State(os.path.join(directory, 'state.json'))
+        files = state.hash_files('command', paths)
+        self.assertEqual(files[paths[1]][2], digest(paths[1]))
+        state.data['command'] = {'files': files}
+        files[paths[1]][2] = 'cached'
+        self.assertEqual(state.hash_files('command', paths)[paths[1]][2],
+            'cached')
+
+    def cache_manager(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return Manager(state_dir=directory)
+
+    def test_cache(self):
+        new_manager = self.cache_manager()
+        calls = []
+
+        @new_manager.cache(max_entries=2)
+        @new_manager.command
+        def report(month):
+            calls.append(month)
+            return 'report %s' % month
+
+        with capture() as c:
+            for month in ('jan', 'jan', 'feb', 'mar', 'jan', 'mar'):
+                report.parse([month])
+            report.parse(['mar', '--no-cache'])
+            report.parse(['--cache-stats', 'mar'])
+
+        self.assertEqual(calls, ['jan', 'feb', 'mar', 'jan', 'mar'])
+        directory = new_manager.state_path('cache', 'report')
+        sizes = [os.path.getsize(os.path.join(directory, name))
+            for name in os.listdir(directory) if name.endswith('.pickle')]
+        self.assertEqual(len(sizes), 2)
+        self.assertEqual(report.cache.stats(report), {
+            'hits': 2, 'misses': 4, 'entries': 2, 'bytes': sum(sizes),
+        })
+        self.assertIn('entries', c.getvalue())
+
+    def test_cache_concurrent_stats(self):
+        from manager import parallel
+
+        new_manager = self.cache_manager()
+
+        @new_manager.cache()
+        @new_manager.command
+        def report(month):
+            return 'report %s' % month
+
+        def hit(i):
+            report.cache.call(report, ['jan'], {})
+            report.cache.flush()
+            return i
+
+        hit(0)
+        self.assertEqual(sorted(parallel.imap(hit, [(i, ) for i in range(8)],
+            executor='process', workers=4)), list(range(8)))
+        stats = report.cache.stats(report)
+        self.assertEqual((stats['hits'], stats['misses']), (8, 1))
+
+    def test_cache_corrupt_entry(self):
+        new_manager = self.cache_manager()
+        calls = []
+
+        @new_manager.cache()
+        @new_manager.command
+        def report():
+            calls.append(None)
+            return 'report'
+
+        with capture():
+            report.parse([])
+        directory = new_manager.state_path('cache', 'report')
+        for name in os.listdir(directory):
+            if name.endswith('.pickle'):
+                with open(os.path.join(directory, name), 'wb') as f:
+                    f.write(b'\x80\x02cmissing_module\nmissing\nq\x00.')
+        with capture() as c:
+            report.parse([])
+        self.assertEqual((len(calls), c.getvalue()), (2, 'report\n'))
+
+    def test_cache_eviction_order(self):
+        new_manager = self.cache_manager()
+
+        @new_manager.cache(max_entries=2)
+        @new_manager.command
+        def report(month):
+            return 'report %s' % month
+
+        with capture():
+            for month in ('jan', 'feb', 'jan', 'mar'):
+                report.parse([month])
+        directory = new_manager.state_path('cache', 'report')
+        keys = [report.cache.key(report, [month], {}) + '.pickle'
+            for month in ('jan', 'mar')]
+        self.assertEqual(sorted(name for name in os.listdir(directory)
+            if name.endswith('.pickle')), sorted(keys))
+
+    def test_cache_ttl(self):
+        new_manager = self.cache_manager()
+        calls = []
+
+        @new_manager.cache(ttl=-1)
+        @new_manager.command
+        def report():
+            calls.append(None)
+            return 'report'
+
+        with capture():
+            report.parse([])
+            report.parse([])
+
+        self.assertEqual(len(calls), 2)
+
+    def test_cache_ttl_concurrent_expiry(self):
+        import pickle
+        from manager import cache
+
+        new_manager = self.cache_manager()
+
+        @new_manager.cache(ttl=-1)
+        @new_manager.command
+        def report():
+            return 'report'
+
+        class Pickle(object):
+            # Another process expires the entry once it has been read.
+            def load(self, f):
+                value = pickle.load(f)
+                os.remove(f.name)
+                return value
+
+            def __getattr__(self, name):
+                return getattr(pickle, name)
+
+        with capture() as c:
+            report.parse([])
+            cache.pickle = Pickle()
+            self.addCleanup(setattr, cache, 'pickle', pickle)
+            report.parse([])
+
+        self.assertEqual(c.getvalue(), 'report\n' * 2)
+
+    def test_cache_stream(self):
+        new_manager = self.cache_manager()
+        calls = []
+
+        @new_manager.cache()
+        @new_manager.command
+        def report():
+            calls.append(None)
+            for i in range(3):
+                yield i
+
+        with capture() as c:
+            report.parse([])
+            report.parse([])
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(c.getvalue(), '0\n1\n2\n' * 2)
+
+    def test_profile_startup(self):
+        import manager_startup as startup
+
+        sys.modules.pop('colorsys', None)
+        tracer = startup.start()
+        try:
+            with startup.phase('load'):
+                import colorsys  # NOQA
+                new_manager = Manager()
+
+                @new_manager.command
+                def new_command():
+                    pass
+        finally:
+            startup.stop()
+
+        report = tracer.report()
+        self.assertEqual(report['phases'][-1]['name'], 'load')
+        self.assertIn('colorsys',
+            [module['module'] for module in report['imports']])
+        self.assertEqual(report['commands'][0]['path'], 'new_command')
+        self.assertTrue(startup.phase('noop') is startup.NO_PHASE)
+
+    def test_profile_startup_imports(self):
+        import json
+        import subprocess
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, 'manage.py'), 'w') as f:
+            f.write('\n'.join([
+                'from manager import Manager',
+                'manager = Manager()',
+                '@manager.command',
+                'def hello():',
+                '    return "hello"',
+            ]))
+        report = os.path.join(directory, 'report.json')
+        code = ('import sys\n'
+            'sys.path.insert(0, %r)\n'
+            'import manager_startup\n'
+            'manager_startup.main()\n') % os.path.dirname(
+                os.path.abspath(__file__))
+        output = subprocess.check_output([sys.executable, '-c', code,
+            '--profile-startup=%s' % report, 'hello'], cwd=directory)
+        self.assertEqual(output.decode('utf-8'), 'hello\n')
+        with open(report) as f:
+            report = json.load(f)
+        self.assertEqual([phase['name'] for phase in report['phases']][1:3],
+            ['import manager', 'load manage.py'])
+        self.assertIn('manager.main',
+            [module['module'] for module in report['imports']])
+
+    def test_profile(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        stats = os.path.join(directory, 'stats.prof')
+        stacks = os.path.join(directory, 'stacks.folded')
+        stderr, sys.stderr = sys.stderr, StringIO()
+        self.addCleanup(setattr, sys, 'stderr', stderr)
+
+        @manager.command
+        def new_command():
+            import time
+            time.sleep(0.05)
+            yield 'done'
+
+        with capture() as c:
+            manager.main(['--profile', stats, '--profile-sample', stacks,
+                'new_command'])
+
+        self.assertEqual(c.getvalue(), 'done\n')
+        self.assertTrue(os.path.getsize(stats) > 0)
+        with open(stacks) as f:
+            self.assertIn('new_command', f.read())
+        self.assertIn('profile written to %s' % stats, sys.stderr.getvalue())
+
+    def test_profile_default_path(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cwd = os.getcwd()
+        os.chdir(directory)
+        self.addCleanup(os.chdir, cwd)
+        stderr, sys.stderr = sys.stderr, StringIO()
+        self.addCleanup(setattr, sys, 'stderr', stderr)
+
+        @manager.command
+        def new_command():
+            return 'done'
+
+        with capture() as c:
+            manager.main(['--profile', 'new_command'])
+            manager.main(['--profile-sample', 'new_command'])
+        self.assertEqual(c.getvalue().count('done'), 2)
+        self.assertIn('profile written to new_command.prof',
+            sys.stderr.getvalue())
+        self.assertEqual(sorted(os.listdir('.')),
+            ['new_command.folded', 'new_command.prof'])
+
+    def test_trace_malloc(self):
+        stderr, sys.stderr = sys.stderr, StringIO()
+        self.addCleanup(setattr, sys, 'stderr', stderr)
+
+        @manager.command
+        def new_command():
+            return len([object() for i in range(1000)])
+
+        with capture() as c:
+            try:
+                new_command.parse([], trace_malloc=3)
+            except SystemExit:
+                self.assertLess(sys.version_info, (3, 4))
+                self.assertIn('requires Python 3.4', c.getvalue())
+            else:
+                self.assertEqual(c.getvalue(), '1000\n')
+                self.assertIn('top 3 allocation sites',
+                    sys.stderr.getvalue())
+
+    def test_command_hooks(self):
+        new_manager = Manager()
+        events = []
+
+        @new_manager.before_command
+        def before(event):
+            events.append(('before', dict(event)))
+
+        @new_manager.after_command
+        def after(event):
+            events.append(('after', dict(event)))
+
+        @new_manager.command
+        def new_command(name, fail=False):
+            if fail:
+                raise Error('failed')
+            return name
+
+        with capture():
+            new_command.parse(['first'])
+            self.assertRaises(SystemExit, new_command.parse,
+                ['second', '--fail'])
+
+        self.assertEqual([(when, event['path'], event['args'])
+            for when, event in events], [
+            ('before', 'new_command', ['first']),
+            ('after', 'new_command', ['first']),
+            ('before', 'new_command', ['second']),
+            ('after', 'new_command', ['second']),
+        ])
+        self.assertEqual(events[1][1]['status'], 0)
+        self.assertEqual(events[3][1]['status'], 1)
+        self.assertEqual(events[3][1]['kwargs'], {'fail': True})
+        self.assertTrue(events[1][1]['duration'] >= 0)
+        self.assertTrue(events[1][1]['max_rss'] > 0)
+        self.assertTrue(events[1][1]['max_rss_growth'] >= 0)
+
+    def test_metrics_sinks(self):
+        import json
+        import socket
+        from manager.metrics import JSONLinesSink, StatsdSink
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'metrics.jsonl')
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(listener.close)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(5)
+
+        new_manager = Manager()
+        new_manager.after_command(JSONLinesSink(path))
+        sink = StatsdSink(*listener.getsockname())
+        self.addCleanup(sink.close)
+        new_manager.after_command(sink)
+
+        @new_manager.command(namespace='ns')
+        def new_command():
+            return True
+
+        with capture():
+            new_command.parse([])
+
+        with open(path) as f:
+            event = json.loads(f.read())
+        self.assertEqual(event['path'], 'ns.new_command')
+        self.assertEqual(event['status'], 0)
+        lines = listener.recv(4096).decode('utf-8').splitlines()
+        self.assertTrue(lines[0].startswith('manage.ns.new_command.duration:'))
+        self.assertIn('manage.ns.new_command.ok:1|c', lines)
+        self.assertTrue([line for line in lines
+            if line.startswith('manage.ns.new_command.max_rss_growth:')])
+
+    def test_stats(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        new_manager = Manager(state_dir=directory, stats=True)
+
+        @new_manager.command
+        def new_command():
+            return True
+
+        with capture() as c:
+            for i in range(3):
+                new_manager.main(['new_command'])
+            c.truncate(0)
+            c.seek(0)
+            new_manager.main(['stats', '--window', '1h'])
+
+        lines = c.getvalue().splitlines()
+        self.assertEqual(lines[0].split(),
+            ['command', 'count', 'p50', 'p95', 'p99'])
+        self.assertEqual(lines[1].split()[:2], ['new_command', '3'])
+        self.assertEqual(len(new_manager.journal.window_stats('1d')), 2)
+
+    def test_journal_percentile(self):
+        from manager.journal import parse_window, percentile
+
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 95), 95)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([1], 99), 1)
+        self.assertEqual(parse_window('2h'), 7200)
+        self.assertRaises(ValueError, parse_window, 'soon')
+
+    def test_call(self):
+        result = manager.call('simple_command', ['name', '--capitalyze'])
+        self.assertTrue(isinstance(result, Result))
+        self.assertEqual(result.value, 'NAME')
+        self.assertEqual(result.status, 0)
+        self.assertTrue(result.output is None)
+
+        result = manager.call('simple_command', {'name': 'name'})
+        self.assertEqual(result.value, 'name')
+
+        result = manager.call('my_namespace.namespaced', {'name': 'name'},
+            capture=True)
+        self.assertEqual(result.output, 'name\n')
+
+    def test_call_errors(self):
+        result = manager.call('raises', capture=True)
+        self.assertEqual(result.status, 1)
+        self.assertEqual(str(result.value), 'No way dude!')
+        self.assertEqual(result.output, 'No way dude!\n')
+
+        self.assertEqual(manager.call('simple_command', {}).status, 1)
+        self.assertRaises(Error, manager.call, 'invalid')
+
+    def test_lazy_sqlite(self):
+        import subprocess
+
+        code = ('import sys, manager\n'
+            'new_manager = manager.Manager(worker=True)\n'
+            'print("sqlite3" in sys.modules)\n'
+            'new_manager.queue\n'
+            'print("sqlite3" in sys.modules)\n')
+        output = subprocess.check_output([sys.executable, '-c', code],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.decode('ascii').split(), ['False', 'True'])
+
+    def test_call_exit(self):
+        new_manager = Manager()
+
+        @new_manager.command
+        def done(code=None):
+            sys.exit(code if code is None else int(code))
+
+        self.assertEqual(new_manager.call('done', {}).status, 0)
+        self.assertEqual(new_manager.call('done', {'code': '3'}).status, 3)
+
+    def test_call_bind_validation(self):
+        new_manager = Manager(state_dir=tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, new_manager.state_dir)
+
+        @new_manager.arg('tenant', choices=lambda: ['acme', 'globex'])
+        @new_manager.arg('size', type=int, choices=[1, 2])
+        @new_manager.command
+        def show(tenant, size=1):
+            return '%s %r' % (tenant, size)
+
+        self.assertEqual(new_manager.call('show',
+            {'tenant': 'acme', 'size': '2'}).value, "acme 2")
+        result = new_manager.call('show', {'tenant': 'not-a-tenant'})
+        self.assertEqual(result.status, 1)
+        self.assertIn('invalid choice', str(result.value))
+        result = new_manager.call('show', {'tenant': 'acme', 'size': 'x'})
+        self.assertEqual(str(result.value),
+            "Invalid value for `size`: invalid literal for int() with base "
+            "10: 'x'")
+        result = new_manager.call('show', {'tenant': 'acme', 'size': 3})
+        self.assertEqual(result.status, 1)
+        result = new_manager.call('show', {'tenant': 'acme', 'colour': 'x'})
+        self.assertEqual(str(result.value), 'Unknown argument `colour`')
+
+    def test_call_generators(self):
+        new_manager = Manager()
+        events = []
+        new_manager.after_command(events.append)
+
+        @new_manager.command
+        def rows(fail=False):
+            yield 'first'
+            if fail:
+                raise Error('broken')
+            yield 'second'
+
+        result = new_manager.call('rows', capture=True)
+        self.assertEqual(events[-1]['status'], 0)
+        self.assertEqual(list(result.value), ['first', 'second'])
+        self.assertEqual(result.output, 'first\nsecond\n')
+
+        result = new_manager.call('rows', ['--fail'], capture=True)
+        self.assertEqual((result.status, str(result.value)), (1, 'broken'))
+        self.assertEqual(events[-1]['status'], 1)
+        self.assertEqual(result.output, 'broken\n')
+
+        result = new_manager.call('rows', ['--unknown'], capture=True)
+        self.assertEqual(result.status, 2)
+        self.assertIn('unrecognized arguments: --unknown', result.output)
+
+    def test_parser_cached(self):
+        @manager.command
+        def new_command(first_arg=None):
+            return first_arg
+
+        parser = new_command.parser
+        self.assertTrue(new_command.parser is parser)
+        manager.arg('first_arg', help='first help')(new_command)
+        self.assertFalse(new_command.parser is parser)
+
     def test_parse_env_simple(self):
         env = "key=value"
         self.assertEqual(dict(manager.parse_env(env)), dict(key='value'))
@@ -367,6 +1115,1251 @@ another_key=another value"""
         self.assertEqual(opt, 'bar')
 
 
+class BenchmarkTest(unittest.TestCase):
+    def test_benchmark_compare(self):
+        import json
+        from manager.ext.benchmark import benchmark, compare
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        baseline = os.path.join(directory, 'baseline.json')
+        current = os.path.join(directory, 'current.json')
+
+        with capture() as c:
+            benchmark(output=baseline, match='cli.', repeat=3, scale=0.1)
+        self.assertIn('cli.tsplit', c.getvalue())
+
+        with open(baseline) as f:
+            results = json.load(f)
+        self.assertIn('cli.args', results['results'])
+        for result in results['results'].values():
+            result['times'] = [t * 2 for t in result['times']]
+            result['mean'] *= 2
+            result['stdev'] *= 2
+        with open(current, 'w') as f:
+            json.dump(results, f)
+
+        with capture():
+            compare(baseline, baseline)
+            self.assertRaises(Error, compare, baseline, current)
+
+
+class CommandRunnerTest(unittest.TestCase):
+    def setUp(self):
+        from manager.testing import CommandRunner
+
+        self.runner = CommandRunner(manager)
+
+    def test_invoke(self):
+        result = self.runner.invoke(['simple_command', 'name',
+            '--capitalyze'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(result.output, 'NAME\n')
+
+    def test_invoke_exit(self):
+        result = self.runner.invoke(['raises'])
+        self.assertEqual(result.exit_code, 1)
+        self.assertEqual(result.output, 'No way dude!\n')
+
+        result = self.runner.invoke(['simple_command'])
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn('too few arguments' if sys.version_info < (3, )
+            else 'required: name', result.errors)
+
+    def test_invoke_prompts_and_env(self):
+        from manager.testing import CommandRunner
+
+        new_manager = Manager()
+
+        @new_manager.prompt('password', hidden=True)
+        @new_manager.command
+        def connect(username, password):
+            os.environ['CONNECTED'] = username
+            return '%s:%s:%s' % (username, password, os.environ['HOST'])
+
+        result = CommandRunner(new_manager).invoke(['connect', 'user'],
+            prompts={'password': 'secret'}, env={'HOST': 'db'})
+        self.assertEqual(result.output.splitlines()[-1], 'user:secret:db')
+        self.assertNotIn('CONNECTED', os.environ)
+        self.assertNotIn('HOST', os.environ)
+
+    def test_invoke_exception(self):
+        from manager.testing import CommandRunner
+
+        new_manager = Manager()
+
+        @new_manager.command
+        def new_command():
+            raise ValueError('unexpected')
+
+        runner = CommandRunner(new_manager)
+        result = runner.invoke(['new_command'])
+        self.assertEqual(result.exit_code, 1)
+        self.assertTrue(isinstance(result.exception, ValueError))
+        self.assertRaises(ValueError, runner.invoke, ['new_command'],
+            catch_exceptions=False)
+
+
+class TestRunnerTest(unittest.TestCase):
+    def test_shard_longest_processing_time(self):
+        from manager.ext.testrunner import group, shard
+
+        class Case(unittest.TestCase):
+            def test_a(self):
+                pass
+
+            def test_b(self):
+                pass
+
+        class Other(unittest.TestCase):
+            def test_c(self):
+                pass
+
+        tests = [Case('test_a'), Case('test_b'), Other('test_c')]
+        groups = group(tests)
+        self.assertEqual([len(g) for g in groups], [2, 1])
+        durations = dict((test.id(), 1.0) for test in tests)
+        durations[tests[2].id()] = 3.0
+        shards = shard(groups, durations, 2)
+        self.assertEqual(shards, [[tests[2]], tests[:2]])
+        self.assertEqual(len(shard(groups, {}, 8)), 2)
+
+    def test_run_shard_streams(self):
+        from manager.ext.testrunner import run_shard
+
+        records = []
+
+        class Case(unittest.TestCase):
+            def test_a(self):
+                pass
+
+            def test_b(self):
+                # The previous test was reported before this one ends.
+                assert [r[:2] for r in records] == [(Case('test_a').id(),
+                    'ok')]
+
+        class Queue(object):
+            put = records.append
+
+        run_shard([Case('test_a'), Case('test_b')], Queue())
+        self.assertEqual([r and r[1] for r in records], ['ok', 'ok', None])
+
+    def test_run(self):
+        import json
+        from manager.ext.testrunner import test
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(sys.modules.pop, 'test_sharded_sample', None)
+        self.addCleanup(lambda: directory in sys.path and
+            sys.path.remove(directory))
+        with open(os.path.join(directory, 'test_sharded_sample.py'), 'w') as f:
+            f.write('\n'.join([
+                'import unittest',
+                'class PassingTest(unittest.TestCase):',
+                '    def test_pass(self):',
+                '        pass',
+                'class FailingTest(unittest.TestCase):',
+                '    def test_fail(self):',
+                '        self.fail("boom")',
+            ]))
+        durations = os.path.join(directory, 'durations.json')
+        argv = ['-j', '2', '-s', directory, '--durations', durations]
+
+        with capture() as c:
+            self.assertRaises(SystemExit, test, argv)
+        self.assertIn('FAILURE: test_sharded_sample.FailingTest.test_fail',
+            c.getvalue())
+        self.assertIn('boom', c.getvalue())
+        self.assertIn('Ran 2 tests', c.getvalue())
+        with open(durations) as f:
+            self.assertEqual(sorted(json.load(f)), [
+                'test_sharded_sample.FailingTest.test_fail',
+                'test_sharded_sample.PassingTest.test_pass',
+            ])
+
+        with capture() as c:
+            test(argv + ['test_sharded_sample.PassingTest'])
+        self.assertIn('OK', c.getvalue())
+
+    def test_run_fixture_errors_and_subtests(self):
+        from manager.ext.testrunner import test
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(sys.modules.pop, 'test_fixture_sample', None)
+        self.addCleanup(lambda: directory in sys.path and
+            sys.path.remove(directory))
+        lines = [
+            'import unittest',
+            'class BrokenTest(unittest.TestCase):',
+            '    @classmethod',
+            '    def setUpClass(cls):',
+            '        raise RuntimeError("no fixture")',
+            '    def test_pass(self):',
+            '        pass',
+        ]
+        if hasattr(unittest.TestCase, 'subTest'):
+            lines += [
+                'class SubTest(unittest.TestCase):',
+                '    def test_values(self):',
+                '        for i in range(2):',
+                '            with self.subTest(i=i):',
+                '                self.assertEqual(i, 0)',
+            ]
+        with open(os.path.join(directory, 'test_fixture_sample.py'),
+                'w') as f:
+            f.write('\n'.join(lines))
+        argv = ['-j', '2', '-s', directory, '--durations',
+            os.path.join(directory, 'durations.json')]
+
+        with capture() as c:
+            self.assertRaises(SystemExit, test, argv)
+        self.assertIn('ERROR: setUpClass', c.getvalue())
+        self.assertIn('no fixture', c.getvalue())
+        if hasattr(unittest.TestCase, 'subTest'):
+            self.assertIn('FAILURE: test_fixture_sample.SubTest.test_values '
+                '(i=1)', c.getvalue())
+
+
+class ImportGraphTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.cache = os.path.join(self.root, '.manage', 'graph.json')
+        for path, source in (
+                ('pkg/__init__.py', ''),
+                ('pkg/core.py', 'import os\n'),
+                ('pkg/util.py', 'from . import core\n'),
+                ('tests/test_util.py', 'from pkg.util import *\n'),
+                ('tests/test_other.py', 'import pkg\n')):
+            self.write(path, source)
+
+    def write(self, path, source):
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(source)
+        return path
+
+    def test_parse_imports(self):
+        from manager.ext.importgraph import parse_imports
+
+        self.assertEqual(parse_imports('from .. import a\nimport b.c',
+            'pkg.sub.mod'), ['b.c', 'pkg', 'pkg.a'])
+        self.assertEqual(parse_imports('from .mod import x', 'pkg', True),
+            ['pkg.mod', 'pkg.mod.x'])
+        self.assertEqual(parse_imports('def (', 'mod'), [])
+
+    def test_dependents(self):
+        from manager.ext.importgraph import ImportGraph
+
+        graph = ImportGraph(self.root, self.cache)
+        graph.update()
+        self.assertEqual(sorted(graph.dependents(['pkg/core.py'])), [
+            os.path.join('pkg', 'core.py'),
+            os.path.join('pkg', 'util.py'),
+            os.path.join('tests', 'test_util.py'),
+        ])
+        graph.save()
+
+        self.write('tests/test_other.py', 'import pkg.core\n')
+        graph = ImportGraph(self.root, self.cache)
+        graph.update()
+        self.assertIn(os.path.join('tests', 'test_other.py'),
+            graph.dependents(['pkg/core.py']))
+
+    def test_affected_since_last_run(self):
+        from manager.ext.importgraph import affected
+
+        self.assertEqual(affected(root=self.root, path=self.cache), None)
+        path = self.write('pkg/util.py', 'from . import core\n\n')
+        future = os.stat(path).st_mtime + 60
+        os.utime(path, (future, future))
+        self.assertEqual(sorted(affected(root=self.root, path=self.cache)), [
+            path, os.path.join(self.root, 'tests', 'test_util.py')])
+
+    def test_affected_unmapped_changes(self):
+        from manager.ext import importgraph
+
+        importgraph.affected(root=self.root, path=self.cache)
+        os.remove(os.path.join(self.root, 'pkg', 'core.py'))
+        self.assertEqual(importgraph.affected(root=self.root,
+            path=self.cache), None)
+
+        git_changed = importgraph.git_changed
+        self.addCleanup(setattr, importgraph, 'git_changed', git_changed)
+        importgraph.git_changed = lambda ref, root: ['pkg/util.py']
+        self.assertEqual(len(importgraph.affected('HEAD', self.root,
+            self.cache)), 2)
+        importgraph.git_changed = lambda ref, root: ['pkg/util.py',
+            'tests/fixtures/data.json']
+        self.assertEqual(importgraph.affected('HEAD', self.root, self.cache),
+            None)
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.manager = Manager(state_dir=tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.manager.state_dir)
+
+        @self.manager.command
+        def tick(label='tick'):
+            return label
+
+    def test_cron_next(self):
+        import datetime
+        import time
+        from manager.scheduler import Cron
+
+        def next_(expression, *start):
+            after = time.mktime(datetime.datetime(*start).timetuple())
+            return datetime.datetime.fromtimestamp(Cron(expression).next(after))
+
+        self.assertEqual(next_('*/15 * * * *', 2024, 1, 1, 10, 7),
+            datetime.datetime(2024, 1, 1, 10, 15))
+        self.assertEqual(next_('@daily', 2024, 1, 31, 0, 0),
+            datetime.datetime(2024, 2, 1, 0, 0))
+        self.assertEqual(next_('30 6 * * 1-5', 2024, 1, 5, 7, 0),
+            datetime.datetime(2024, 1, 8, 6, 30))
+        self.assertEqual(next_('0 0 29 2 *', 2023, 3, 1, 0, 0),
+            datetime.datetime(2024, 2, 29, 0, 0))
+        self.assertRaises(ValueError, Cron, '* * *')
+        self.assertRaises(ValueError, Cron, '60 * * * *')
+        self.assertRaises(ValueError, Cron, '0 0 30 2 *')
+        self.assertRaises(ValueError, Cron, '0 0 31 4,6 *')
+        Cron('0 0 30 2 1')
+
+    def test_jobs_validation(self):
+        from manager.scheduler import jobs
+
+        self.assertRaises(Error, jobs, self.manager,
+            {'jobs': [{'command': 'unknown', 'every': '1m'}]})
+        self.assertRaises(Error, jobs, self.manager,
+            {'jobs': [{'command': 'tick', 'every': '1m', 'cron': '* * * * *'}]})
+        self.assertRaises(Error, jobs, self.manager,
+            {'jobs': [{'command': 'tick', 'cron': '* * 31 2 7x'}]})
+        self.assertRaises(Error, jobs, self.manager,
+            {'jobs': [{'command': 'tick', 'cron': '0 0 30 2 *'}]})
+        job, = jobs(self.manager, {'jitter': 2, 'jobs': [
+            {'command': 'tick', 'args': '--label hello', 'every': '30s'}]})
+        self.assertEqual(job.argv, ['tick', '--label', 'hello'])
+        self.assertEqual(job.jitter, 2)
+
+    def test_run_and_catch_up(self):
+        import json
+        import time
+        from manager.scheduler import Scheduler, jobs
+
+        config = {'jobs': [{'command': 'tick', 'every': '0.2s'},
+            {'command': 'tick', 'name': 'hourly', 'every': '1h'}]}
+        scheduler = Scheduler(self.manager, jobs(self.manager, config), 2)
+        with capture() as c:
+            scheduler.run(until=time.time() + 0.5)
+        self.assertIn('[tick] tick', c.getvalue())
+        with open(self.manager.state_path('scheduler.jsonl')) as f:
+            runs = [json.loads(line) for line in f]
+        self.assertTrue(runs)
+        self.assertEqual(set(run['job'] for run in runs), set(['tick']))
+        self.assertTrue(all(run['status'] == 0 for run in runs))
+
+        with open(self.manager.state_path('scheduler.json'), 'w') as f:
+            json.dump({'hourly': time.time() - 7200}, f)
+        scheduler = Scheduler(self.manager, jobs(self.manager, config), 2)
+        now = time.time()
+        self.assertEqual(scheduler.first_due(scheduler.jobs[1], now), now)
+        scheduler.jobs[1].catch_up = 'none'
+        self.assertEqual(scheduler.first_due(scheduler.jobs[1], now),
+            now + 3600)
+
+
+class JobQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.manager = Manager(state_dir=tempfile.mkdtemp(), worker=True)
+        self.addCleanup(shutil.rmtree, self.manager.state_dir)
+        self.manager.queue.backoff = 0
+
+        @self.manager.command
+        def add(a, b=1):
+            return int(a) + int(b)
+
+        @self.manager.command
+        def fails():
+            raise Error('Failed')
+
+    def test_enqueue_and_work(self):
+        ids = [self.manager.enqueue('add', 1, b=2),
+            self.manager.enqueue('add', a=3), self.manager.enqueue('fails')]
+        self.assertEqual(self.manager.queue.get(ids[0])['status'], 'queued')
+        self.assertRaises(Error, self.manager.enqueue, 'unknown')
+
+        with capture() as c:
+            self.manager.main(['worker', '-c', '2', '--burst'])
+        self.assertIn('Job 1 done', c.getvalue())
+        self.assertIn('Job 3 failed (attempt 3): Failed', c.getvalue())
+
+        jobs = [self.manager.queue.get(id_) for id_ in ids]
+        self.assertEqual([job['status'] for job in jobs],
+            ['done', 'done', 'failed'])
+        self.assertEqual([job['result'] for job in jobs], [3, 4, None])
+        self.assertEqual(jobs[2]['attempts'], 3)
+
+    def test_visibility_timeout(self):
+        queue = self.manager.queue
+        id_ = queue.put('add', {'a': 1}, max_attempts=2)
+        self.assertEqual(queue.claim(10), [(id_, 'add', {'a': 1}, 1)])
+        self.assertEqual(queue.claim(10), [])
+
+        queue.visibility_timeout = 0
+        connection = queue.connect()
+        with connection:
+            connection.execute('UPDATE jobs SET available_at = 0')
+        connection.close()
+        self.assertEqual(queue.claim(10), [(id_, 'add', {'a': 1}, 2)])
+        queue.finish(id_, 1, 'stale')
+        self.assertEqual(queue.get(id_)['status'], 'running')
+        queue.claim(10)
+        self.assertEqual(queue.get(id_)['status'], 'failed')
+
+    def test_work_threads(self):
+        id_ = self.manager.enqueue('add', 5)
+        with capture():
+            self.manager.queue.work(executor='thread', burst=True)
+        self.assertEqual(self.manager.queue.get(id_)['result'], 6)
+
+
+    def test_work_lost_worker(self):
+        @self.manager.command
+        def crash():
+            os._exit(3)
+
+        @self.manager.command
+        def ok():
+            return 'ok'
+
+        crash_id = self.manager.queue.put('crash', {}, max_attempts=1)
+        ok_id = self.manager.queue.put('ok', {})
+        with capture() as c:
+            self.manager.queue.work(concurrency=1, poll_interval=0.1,
+                burst=True)
+        self.assertEqual(self.manager.queue.get(crash_id)['status'], 'failed')
+        self.assertIn('died', self.manager.queue.get(crash_id)['error'])
+        self.assertEqual(self.manager.queue.get(ok_id)['result'], 'ok')
+        self.assertIn('Job %s done' % ok_id, c.getvalue())
+
+    def test_work_visibility_timeout(self):
+        import time
+
+        @self.manager.command
+        def hang():
+            time.sleep(5)
+
+        id_ = self.manager.queue.put('hang', {}, max_attempts=1)
+        self.manager.queue.visibility_timeout = 0.2
+        with capture():
+            self.manager.queue.work(poll_interval=0.1, burst=True)
+        self.assertEqual(self.manager.queue.get(id_)['error'],
+            'Visibility timeout expired')
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        import threading
+        from manager.server import Handler, Server
+
+        class QuietHandler(Handler):
+            def log_message(self, *args):
+                pass
+
+        self.manager = Manager(state_dir=tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.manager.state_dir)
+        self.started, self.release = threading.Event(), threading.Event()
+
+        @self.manager.command
+        def add(a, b=1):
+            return int(a) + int(b)
+
+        @self.manager.command(namespace='ns')
+        def count(n):
+            for i in range(int(n)):
+                yield {'i': i}
+
+        @self.manager.prompt('password', hidden=True)
+        @self.manager.command
+        def login(user, password=None):
+            return user
+
+        @self.manager.command(max_concurrency=1)
+        def slow():
+            self.started.set()
+            self.release.wait(5)
+            return 'done'
+
+        self.server = Server(self.manager, ('127.0.0.1', 0), workers=4)
+        self.server.RequestHandlerClass = QuietHandler
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def connect(self):
+        try:
+            from httplib import HTTPConnection
+        except ImportError:
+            from http.client import HTTPConnection
+
+        connection = HTTPConnection(*self.server.server_address[:2],
+            timeout=5)
+        self.addCleanup(connection.close)
+        return connection
+
+    def post(self, connection, path, body=None):
+        import json
+
+        connection.request('POST', path, body=json.dumps(body or {}),
+            headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        return response.status, response.read().decode('utf-8')
+
+    def test_call_keep_alive(self):
+        import json
+
+        connection = self.connect()
+        status, body = self.post(connection, '/add', {'a': 1, 'b': 2})
+        self.assertEqual((status, json.loads(body)), (200, {'result': 3}))
+        socket = connection.sock
+        status, body = self.post(connection, '/ns.count', {'n': 3})
+        self.assertEqual(status, 200)
+        self.assertTrue(connection.sock is socket)
+        self.assertEqual([json.loads(line) for line in body.splitlines()],
+            [{'i': 0}, {'i': 1}, {'i': 2}])
+
+    def test_errors(self):
+        connection = self.connect()
+        self.assertEqual(self.post(connection, '/unknown')[0], 404)
+        status, body = self.post(connection, '/add')
+        self.assertEqual(status, 400)
+        self.assertIn('Missing argument `a`', body)
+        self.assertEqual(self.post(connection, '/add', [1])[0], 400)
+
+    def test_invalid_arguments(self):
+        connection = self.connect()
+        status, body = self.post(connection, '/add', {'a': 1, 'c': 2})
+        self.assertEqual(status, 400)
+        self.assertIn('Unknown argument `c`', body)
+
+    def test_streamed(self):
+        import json
+        import threading
+
+        events, release = [], threading.Event()
+        self.addCleanup(release.set)
+        self.manager.after_command(events.append)
+
+        @self.manager.command
+        def follow():
+            yield {'i': 0}
+            release.wait(5)
+            yield {'i': 1}
+
+        connection = self.connect()
+        connection.request('POST', '/follow', body='{}')
+        response = connection.getresponse()
+        first = (json.dumps({'i': 0}) + '\n').encode('utf-8')
+        self.assertEqual(response.read(len(first)), first)
+        self.assertEqual(events, [])
+        release.set()
+        self.assertEqual(json.loads(response.read().decode('utf-8')),
+            {'i': 1})
+        self.assertEqual([event['status'] for event in events], [0])
+
+    def test_missing_prompted_argument(self):
+        import json
+
+        connection = self.connect()
+        status, body = self.post(connection, '/login', {'user': 'me'})
+        self.assertEqual(status, 400)
+        self.assertIn('Missing argument `password`', body)
+        status, body = self.post(connection, '/login', {'user': 'me',
+            'password': 'secret'})
+        self.assertEqual((status, json.loads(body)), (200, {'result': 'me'}))
+
+    def test_max_concurrency(self):
+        import threading
+
+        responses = []
+        thread = threading.Thread(target=lambda: responses.append(
+            self.post(self.connect(), '/slow')))
+        thread.start()
+        self.started.wait(5)
+        try:
+            self.assertEqual(self.post(self.connect(), '/slow')[0], 429)
+        finally:
+            self.release.set()
+            thread.join()
+        self.assertEqual(responses[0][0], 200)
+
+
+class LocksTest(unittest.TestCase):
+    def setUp(self):
+        self.manager = Manager(state_dir=tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.manager.state_dir)
+        stderr, sys.stderr = sys.stderr, StringIO()
+        self.addCleanup(setattr, sys, 'stderr', stderr)
+
+    def test_ticket_position(self):
+        from manager.locks import Ticket
+
+        directory = self.manager.state_path('waiting')
+        first, second = Ticket(directory), Ticket(directory)
+        self.assertEqual((first.position(), second.position()), (1, 2))
+        open(os.path.join(directory, '0' * 17 + '-1'), 'w').close()
+        self.assertEqual(first.position(), 1)
+        first.close()
+        self.assertEqual(second.position(), 1)
+        second.close()
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_max_concurrency_timeout(self):
+        from manager.locks import Semaphore
+
+        @self.manager.command(max_concurrency=2, wait_timeout=0.2)
+        def heavy():
+            return 'done'
+
+        self.manager.call('heavy')
+        semaphore = Semaphore(self.manager.state_path('run', 'heavy'), 2)
+        fds = [semaphore.acquire('heavy'), semaphore.acquire('heavy')]
+        result = self.manager.call('heavy')
+        self.assertEqual(result.status, 1)
+        self.assertIn('Timed out after 0.2s waiting for `heavy`',
+            str(result.value))
+        self.assertIn('position 1 in queue', sys.stderr.getvalue())
+        os.close(fds.pop())
+        self.assertEqual(self.manager.call('heavy').value, 'done')
+        os.close(fds.pop())
+
+    def test_single_flight(self):
+        import glob
+        import threading
+        import time
+
+        started, release = threading.Event(), threading.Event()
+        runs = []
+
+        @self.manager.command(single_flight=True)
+        def refresh(table):
+            runs.append(table)
+            count = len(runs)
+            if table == 'users':
+                started.set()
+                release.wait(5)
+            return 'refreshed %s %s' % (table, count)
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(
+            self.manager.call('refresh', {'table': 'users'}).value))
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=lambda: results.append(
+            self.manager.call('refresh', {'table': 'users'}).value))
+        follower.start()
+        self.assertEqual(self.manager.call('refresh', {'table': 'x'}).value,
+            'refreshed x 2')
+        for i in range(100):  # Until the follower waits
+            if glob.glob(self.manager.state_path('run', '*.waiting', '*')):
+                break
+            time.sleep(0.05)
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(results, ['refreshed users 1'] * 2)
+        self.assertEqual(runs, ['users', 'x'])
+
+
+class LimitsTest(unittest.TestCase):
+    def setUp(self):
+        self.manager = Manager()
+
+    def test_within_limits(self):
+        @self.manager.command(timeout=5, max_memory='1G')
+        def pid(fail=False):
+            if fail:
+                raise Error('Failed in %s' % os.getpid())
+            return os.getpid()
+
+        @self.manager.command(max_cpu_seconds=5)
+        def items():
+            for i in range(3):
+                yield i
+
+        self.assertNotEqual(self.manager.call('pid').value, os.getpid())
+        self.assertIn('Failed in', str(self.manager.call('pid', ['--fail'])
+            .value))
+        with capture() as c:
+            self.manager.commands['items'].parse([])
+        self.assertEqual(c.getvalue(), '0\n1\n2\n')
+
+    def test_timeout(self):
+        import time
+
+        @self.manager.command(timeout=0.2)
+        def sleep():
+            time.sleep(10)
+
+        started = time.time()
+        result = self.manager.call('sleep')
+        self.assertLess(time.time() - started, 5)
+        self.assertEqual(result.status, 1)
+        self.assertTrue(re.match(r'^`sleep` exceeded its timeout of 0.2s '
+            r'\(peak RSS .+ MB, CPU time \d+\.\d+s\)$', str(result.value)))
+
+    def test_max_memory(self):
+        @self.manager.command(max_memory='256M')
+        def allocate():
+            return len(b' ' * (1 << 30))
+
+        result = self.manager.call('allocate')
+        self.assertIn('exceeded its memory limit of 256.0 MB',
+            str(result.value))
+
+    def test_max_cpu_seconds(self):
+        @self.manager.command(max_cpu_seconds=0.5)
+        def spin():
+            while True:
+                pass
+
+        result = self.manager.call('spin')
+        self.assertIn('exceeded its CPU time limit of 0.5s',
+            str(result.value))
+
+    def test_unrelated_limits(self):
+        import signal
+
+        @self.manager.command(timeout=5)
+        def oom():
+            raise MemoryError()
+
+        @self.manager.command(timeout=5)
+        def terminated():
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        self.assertTrue(str(self.manager.call('oom').value).startswith(
+            '`oom` ran out of memory (peak RSS'))
+        self.assertTrue(str(self.manager.call('terminated').value).startswith(
+            '`terminated` was terminated by signal %s (' % signal.SIGTERM))
+
+
+class IntrospectTest(unittest.TestCase):
+    def setUp(self):
+        import signal
+
+        self.manager = Manager(state_dir=tempfile.mkdtemp(),
+            introspection=True)
+        self.addCleanup(shutil.rmtree, self.manager.state_dir)
+        self.addCleanup(signal.signal, signal.SIGUSR1,
+            signal.getsignal(signal.SIGUSR1))
+        stderr, sys.stderr = sys.stderr, StringIO()
+        self.addCleanup(setattr, sys, 'stderr', stderr)
+
+    def test_not_inspectable(self):
+        with capture() as c:
+            self.assertRaises(SystemExit, self.manager.main,
+                ['--inspect', str(os.getpid())])
+        self.assertIn('is not inspectable', c.getvalue())
+
+    def test_inspect(self):
+        from manager import introspect
+
+        @self.manager.command
+        def migrate():
+            introspect.report('rows', '10/20')
+            with capture() as c:
+                self.manager.main(['--inspect', str(os.getpid())])
+            return c.getvalue()
+
+        with capture() as c:
+            self.manager.main(['migrate'])
+        self.assertIn('pid %s, `migrate` running for 0s, RSS' %
+            os.getpid(), c.getvalue())
+        self.assertIn('Progress:\n  rows: 10/20', c.getvalue())
+        self.assertIn('Thread MainThread', c.getvalue())
+        self.assertIn('in migrate', c.getvalue())
+        self.assertIn('Thread MainThread', sys.stderr.getvalue())
+        introspect.COUNTERS.clear()
+
+    def test_stale_marker(self):
+        from manager import introspect
+
+        ready = introspect.path(self.manager, os.getpid(), 'ready')
+        with open(ready, 'w') as f:
+            f.write('a previous process')
+        with capture() as c:
+            self.assertRaises(SystemExit, self.manager.main,
+                ['--inspect', str(os.getpid())])
+        self.assertIn('is not inspectable', c.getvalue())
+        self.assertFalse(os.path.exists(ready))
+
+    def test_handler_errors(self):
+        from manager import introspect
+
+        introspect.install(self.manager, ['migrate'])
+        introspect.install(self.manager, ['migrate'])
+        self.assertEqual(len(introspect._state['cleanup']), 2)
+        introspect._state['path'] = os.path.join(self.manager.state_dir,
+            'missing', 'dump.txt')
+        introspect.handle(None, None)
+        self.assertIn('Cannot dump the process state', sys.stderr.getvalue())
+        introspect.cleanup()
+
+
+class ProgressTest(unittest.TestCase):
+    def test_log_lines(self):
+        from manager import cli, introspect, progress
+
+        with capture() as c:
+            with cli.indent(2):
+                items = list(progress(range(5), label='rows'))
+        self.assertEqual(items, list(range(5)))
+        self.assertTrue(re.match(r'^  rows: 5/5, 100%, in 0s, [\d.]+/s\n$',
+            c.getvalue()))
+        self.assertIn('rows', introspect.COUNTERS)
+        introspect.COUNTERS.clear()
+
+    def test_tty_redraw(self):
+        from manager.cli import Progress
+
+        class TTY(StringIO):
+            def isatty(self):
+                return True
+
+        stream = TTY()
+        progress = Progress(iter(range(100)), total=100, stream=stream,
+            refresh=1e9)
+        self.assertEqual(sum(progress), sum(range(100)))
+        lines = stream.getvalue().split('\r')[1:]
+        self.assertTrue(len(lines) > 1)
+        self.assertTrue(re.match(r'^\d+/100, \d+%, [\d.]+/s \(avg [\d.]+/s\), '
+            r'ETA \d+s\x1b\[K$', lines[0]))
+        self.assertTrue(lines[-1].startswith('100/100, 100%, in 0s'))
+        self.assertTrue(lines[-1].endswith('\n'))
+
+    def test_early_exit(self):
+        from manager.cli import Progress
+
+        stream = StringIO()
+        for i in Progress(range(10), stream=stream, log_interval=1e9):
+            if i == 3:
+                break
+        self.assertTrue(re.match(r'^4/10, 40%, in 0s', stream.getvalue()))
+
+    def test_no_read_ahead(self):
+        from manager.cli import Progress
+
+        read = []
+
+        def items():
+            for i in range(10000):
+                read.append(i)
+                yield i
+
+        for i in Progress(items(), stream=StringIO()):
+            self.assertEqual(len(read), i + 1)
+
+
+class TerminalTest(unittest.TestCase):
+    class TTY(StringIO):
+        calls = 0
+
+        def isatty(self):
+            self.calls += 1
+            return True
+
+    def test_capabilities(self):
+        from manager.cli import Terminal
+
+        tty, pipe = self.TTY(), StringIO()
+        self.assertEqual(Terminal(tty, {'TERM': 'xterm'}).colors, 16)
+        self.assertEqual(Terminal(tty, {'TERM': 'xterm-256color'}).colors,
+            256)
+        self.assertEqual(Terminal(tty, {'COLORTERM': 'truecolor'}).colors,
+            1 << 24)
+        self.assertFalse(Terminal(tty, {'TERM': 'dumb'}).color)
+        self.assertFalse(Terminal(tty, {'NO_COLOR': '1'}).color)
+        self.assertFalse(Terminal(pipe, {}).color)
+        self.assertTrue(Terminal(pipe, {'FORCE_COLOR': '1'}).color)
+        self.assertFalse(Terminal(pipe, {'FORCE_COLOR': '0'}).color)
+        self.assertFalse(Terminal(pipe, {}).tty)
+
+    def test_detected_once_per_stream(self):
+        from manager import cli
+
+        stream = self.TTY()
+        first = cli.terminal(stream)
+        self.assertTrue(cli.terminal(stream) is first)
+        self.assertEqual(stream.calls, 1)
+        self.assertFalse(cli.terminal(StringIO()) is first)
+
+    def test_colors(self):
+        from manager import cli
+
+        old = sys.stdout
+        sys.stdout = stream = self.TTY()
+        cli._terminals[stream] = cli.Terminal(stream, {'TERM': 'xterm'})
+        try:
+            self.assertEqual(str(cli.red('no')), '\033[91mno\033[0m')
+            puts({'key': 'value'})
+            self.assertEqual(stream.getvalue(), '\033[94m' +
+                'key'.ljust(25) + 'value\033[0m\n')
+        finally:
+            sys.stdout = old
+
+        with capture() as c:
+            self.assertEqual(cli.red('no'), 'no')
+            self.assertTrue(type(cli.red('no')) is str)
+            puts({'key': 'value'})
+        self.assertEqual(c.getvalue(), 'key'.ljust(25) + 'value\n')
+
+    def test_colored_target_stream(self):
+        from manager import cli
+
+        tty, pipe = self.TTY(), StringIO()
+        cli._terminals[tty] = cli.Terminal(tty, {'TERM': 'xterm'})
+        colored = cli.Colored(cli.GREEN, 'ok', stream=tty)
+        self.assertEqual(str(colored), '\033[92mok\033[0m')
+        self.assertEqual(str(cli.Colored(cli.GREEN, 'ok', stream=pipe)), 'ok')
+        self.assertEqual(str(cli.red('no', stream=pipe)), 'no')
+        with capture():
+            self.assertEqual(str(cli.Colored(cli.GREEN, 'ok')), 'ok')
+
+
+class OutputTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'out')
+        self.manager = Manager()
+
+        @self.manager.command
+        def rows(n=3, fail=False):
+            for i in range(int(n)):
+                if fail and i == 1:
+                    raise Error('broken')
+                yield 'row %s' % i
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_plain(self):
+        with capture() as c:
+            self.manager.main(['--output-file', self.path, 'rows'])
+        self.assertEqual(c.getvalue(), '')
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'row 0\nrow 1\nrow 2\n')
+        self.assertEqual(os.listdir(self.directory), ['out'])
+
+    def test_compress(self):
+        import bz2
+        import gzip
+
+        self.manager.main(['--output-file', self.path, '--compress', 'gzip',
+            'rows', '--n', '20000'])
+        f = gzip.open(self.path)
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        self.assertEqual(data.splitlines()[-1], b'row 19999')
+        self.manager.main(['--output-file', self.path, '--compress', 'bz2',
+            'rows'])
+        with open(self.path, 'rb') as f:
+            self.assertEqual(bz2.decompress(f.read()), b'row 0\nrow 1\nrow 2\n')
+
+    def test_atomic(self):
+        with open(self.path, 'w') as f:
+            f.write('previous')
+        with capture() as c:
+            with self.assertRaises(SystemExit):
+                self.manager.main(['--output-file', self.path, 'rows',
+                    '--fail'])
+        self.assertEqual(c.getvalue(), 'broken\n')
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'previous')
+        self.assertEqual(os.listdir(self.directory), ['out'])
+
+    def test_requires_output_file(self):
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            with capture():
+                with self.assertRaises(SystemExit):
+                    self.manager.main(['--compress', 'gzip', 'rows'])
+            self.assertIn('--compress requires --output-file',
+                sys.stderr.getvalue())
+        finally:
+            sys.stderr = stderr
+
+    def test_permissions(self):
+        import stat
+
+        umask = os.umask(0o022)
+        try:
+            self.manager.main(['--output-file', self.path, 'rows'])
+        finally:
+            os.umask(umask)
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o644)
+
+
+    def test_flush_error(self):
+        import errno
+        import threading
+        from manager.output import OutputFile
+
+        class Compressor(object):
+            def compress(self, data):
+                return data
+
+            def flush(self):
+                raise IOError(errno.ENOSPC, 'No space left on device')
+
+        f = OutputFile(self.path)
+        f.compressor = Compressor()
+        f.write(b'data')
+        errors = []
+
+        def close():
+            try:
+                f.close()
+            except IOError as e:
+                errors.append(e.errno)
+
+        thread = threading.Thread(target=close)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(errors, [errno.ENOSPC])
+        self.assertEqual(os.listdir(self.directory), [])
+
+class PagerTest(unittest.TestCase):
+    class TTY(StringIO):
+        def isatty(self):
+            return True
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'paged')
+        self.environ = dict(os.environ)
+        os.environ['LINES'] = '10'
+        self.stdout, sys.stdout = sys.stdout, self.TTY()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.directory)
+
+    def pager(self, lines=None):
+        read = 'sys.stdin.read()' if lines is None else \
+            'itertools.islice(sys.stdin, %s)' % lines
+        os.environ['PAGER'] = '%s -c "import itertools, sys; open(%r, ' \
+            '\'w\').write(\'\'.join(%s))"' % (sys.executable, self.path,
+                read)
+
+    def test_short_output(self):
+        from manager import cli
+
+        self.pager()
+        with cli.paging():
+            puts(['line %s' % i for i in range(5)])
+        self.assertEqual(sys.stdout.getvalue().count('\n'), 5)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_long_output(self):
+        from manager import cli
+
+        self.pager()
+        with cli.paging():
+            puts(['line %s' % i for i in range(100)])
+        self.assertEqual(sys.stdout.getvalue(), '')
+        with open(self.path) as f:
+            self.assertEqual(f.read().splitlines(),
+                ['line %s' % i for i in range(100)])
+
+    def test_quit_early(self):
+        from manager import cli
+
+        produced = []
+
+        def lines():
+            try:
+                for i in range(10 ** 6):
+                    produced.append(i)
+                    yield 'line %s' % i
+            finally:
+                produced.append('closed')
+
+        self.pager(lines=1)
+        with cli.paging():
+            puts(lines())
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'line 0\n')
+        self.assertEqual(produced[-1], 'closed')
+        self.assertTrue(len(produced) < 10 ** 6)
+
+    def wait_for(self, condition):
+        import time
+
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_slow_output(self):
+        from manager import cli
+
+        self.pager()
+
+        stream = sys.stdout
+
+        def lines():
+            yield 'first'
+            self.assertTrue(self.wait_for(lambda: stream.getvalue()))
+            yield 'second'
+
+        with cli.paging():
+            puts(lines())
+        self.assertEqual(sys.stdout.getvalue(), 'first\nsecond\n')
+
+    def test_pager_flushed(self):
+        from manager import cli
+
+        os.environ['PAGER'] = '%s -c "import sys; f = open(%r, \'w\'); ' \
+            '[(f.write(line), f.flush()) for line in iter(sys.stdin.readline, ' \
+            '\'\')]"' % (sys.executable, self.path)
+
+        def read():
+            if not os.path.exists(self.path):
+                return ''
+            with open(self.path) as f:
+                return f.read()
+
+        def lines():
+            for i in range(20):
+                yield 'line %s' % i
+            self.assertTrue(self.wait_for(lambda: 'line 19' in read()))
+            yield 'last'
+
+        with cli.paging():
+            puts(lines())
+        self.assertEqual(read().splitlines()[-1], 'last')
+
+    def test_disabled(self):
+        from manager import cli
+
+        os.environ['PAGER'] = ''
+        with cli.paging() as pager:
+            puts(['line %s' % i for i in range(100)])
+        self.assertTrue(pager is None)
+        self.assertEqual(sys.stdout.getvalue().count('\n'), 100)
+
+
+class ChoicesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_index(self):
+        from manager.cli import Choices
+
+        choices = Choices(lambda: ['t%03d' % i for i in range(200)])
+        self.assertTrue('t042' in choices)
+        self.assertFalse('t42' in choices)
+        self.assertEqual(choices.suggest('t04x', limit=3),
+            ['t040', 't041', 't042'])
+        self.assertEqual(choices.suggest('zzz'), [])
+        self.assertEqual(Choices(['b', 'a', 'c']).display(limit=2),
+            'a, b, ... (1 more)')
+
+    def test_providers(self):
+        from manager.cli import Choices
+
+        path = os.path.join(self.directory, 'tenants.txt')
+        with open(path, 'w') as f:
+            f.write('first\nsecond\n\n')
+        self.assertEqual(list(Choices(path)), ['first', 'second'])
+
+        calls = []
+
+        def tenants():
+            calls.append(1)
+            return ['first']
+
+        for i in range(2):
+            choices = Choices(tenants, directory=self.directory,
+                name='tenants')
+            self.assertTrue('first' in choices)
+        self.assertEqual(len(calls), 1)
+
+    def test_arg(self):
+        manager = Manager(state_dir=os.path.join(self.directory, 'state'))
+
+        @manager.arg('tenant', choices=lambda: ['first', 'second'])
+        @manager.command
+        def show(tenant):
+            return tenant
+
+        with capture() as c:
+            manager.main(['show', 'second'])
+        self.assertEqual(c.getvalue(), 'second\n')
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            with self.assertRaises(SystemExit):
+                manager.main(['show', 'secnd'])
+            self.assertIn("invalid choice: 'secnd' (did you mean: second?)",
+                sys.stderr.getvalue())
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(os.listdir(os.path.join(self.directory, 'state',
+            'choices')), ['show.tenant.json'])
+
+    def test_lambda_providers(self):
+        manager = Manager(state_dir=os.path.join(self.directory, 'state'))
+
+        @manager.arg('tenant', choices=lambda: ['a', 'b'])
+        @manager.command
+        def one(tenant):
+            return tenant
+
+        @manager.arg('region', choices=lambda: ['eu', 'us'])
+        @manager.command
+        def two(region):
+            return region
+
+        with capture() as c:
+            manager.main(['one', 'a'])
+            manager.main(['two', 'eu'])
+        self.assertEqual(c.getvalue(), 'a\neu\n')
+        self.assertEqual(sorted(os.listdir(os.path.join(self.directory,
+            'state', 'choices'))), ['one.tenant.json', 'two.region.json'])
+
+    def test_prompt(self):
+        choices = ['t%03d' % i for i in range(100)]
+        with capture(prompts=[(r'\[t000, .*t009, \.\.\. \(90 more\)\]',
+                't042')]):
+            self.assertEqual(prompt('Tenant', choices=choices), 't042')
+        with capture(prompts=[('Tenant', 't04x')]) as c:
+            self.assertRaises(Error, prompt, 'Tenant', choices=choices)
+        self.assertIn('Did you mean: t040, t041, t042, t043, t044?',
+            c.getvalue())
+
+    def test_allowed_list(self):
+        with capture(prompts=[('Simple prompt', '\n')]):
+            self.assertEqual(prompt('Simple prompt', empty=True,
+                allowed=['first', 'second']), None)
+
+
 class PutsTest(unittest.TestCase):
     def test_none(self):
         with capture() as c: